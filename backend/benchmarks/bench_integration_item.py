@@ -0,0 +1,68 @@
+"""Memory per 100k contact-like items: dict-backed class vs slotted IntegrationItem vs IntegrationItemBatch.
+
+Run from backend/: python -m benchmarks.bench_integration_item
+"""
+import gc
+import tracemalloc
+
+import pyarrow as pa
+
+from integrations.integration_item import IntegrationItem, IntegrationItemBatch
+
+N_ITEMS = 100_000
+
+
+class DictIntegrationItem:
+    """The IntegrationItem layout before __slots__, kept here as the baseline"""
+
+    def __init__(self, **fields):
+        for field in IntegrationItem.__slots__:
+            setattr(self, field, None)
+        self.directory = False
+        self.visibility = True
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+
+def _fields(i: int) -> dict:
+    # contact-shaped payload, the strings are built up front so only the containers get measured
+    return {
+        'id': f'{i}_Contact',
+        'type': 'Contact',
+        'name': f'First{i} Last{i}',
+        'email': f'first{i}@example.com',
+        'creation_time': '2024-01-01T00:00:00Z',
+        'last_modified_time': '2024-06-01T00:00:00Z',
+    }
+
+
+def _measure(build, rows):
+    gc.collect()
+    # the batch copies the strings into arrow buffers, which tracemalloc does not see, so it is measured with them
+    arrow_before = pa.total_allocated_bytes()
+    tracemalloc.start()
+    result = build(rows)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    current += pa.total_allocated_bytes() - arrow_before
+    del result
+    return current
+
+
+def main():
+    rows = [_fields(i) for i in range(N_ITEMS)]
+    results = {
+        'dict': _measure(lambda rows: [DictIntegrationItem(**row) for row in rows], rows),
+        'slots': _measure(lambda rows: [IntegrationItem(**row) for row in rows], rows),
+        'batch': _measure(lambda rows: IntegrationItemBatch.from_dicts(rows), rows),
+    }
+    baseline = results['dict']
+    for name, used in results.items():
+        print(
+            f'{name:>6}: {used / 2**20:8.2f} MiB per {N_ITEMS} items '
+            f'({used / N_ITEMS:6.1f} B/item, saves {(baseline - used) / 2**20:7.2f} MiB vs dict)'
+        )
+
+
+if __name__ == '__main__':
+    main()
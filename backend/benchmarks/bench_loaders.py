@@ -0,0 +1,190 @@
+"""Throughput of the provider loaders against local stand-in APIs (see standins.py), no live accounts needed.
+
+Every loader runs in its own process so its peak RSS is its own. Redis is fakeredis (needs lupa for the
+Lua scripts) unless --redis-url points at a real server. Results are written as JSON, and --baseline
+compares them with an earlier run and exits non-zero on a regression.
+
+Run from backend/: python -m benchmarks.bench_loaders --items 5000 --latency 0.01 --output results.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+# loader name -> (provider, module, function, keyword arguments)
+LOADERS = {
+    'airtable': ('airtable', 'integrations.airtable', 'get_items_airtable', {}),
+    'airtable_records': ('airtable', 'benchmarks.bench_loaders', 'collect_airtable_records', {}),
+    'notion': ('notion', 'integrations.notion', 'get_items_notion', {}),
+    'notion_deep': ('notion', 'integrations.notion', 'get_items_notion', {'deep': True}),
+    'hubspot': ('hubspot', 'integrations.hubspot', 'get_items_hubspot', {}),
+}
+# metrics where a higher value is the better one, the rest are better lower
+HIGHER_IS_BETTER = ('items_per_second',)
+COMPARED = ('items_per_second', 'p50_seconds', 'p99_seconds', 'peak_rss_mb', 'upstream_requests_per_load')
+
+
+async def collect_airtable_records(credentials):
+    from integrations.airtable import stream_records_airtable
+    return [item async for item in stream_records_airtable(credentials)]
+
+
+def _percentile(values, percent):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def _configure(args) -> None:
+    if not args.real_rate_limits:
+        # the stand-ins answer instantly, the real per-token limits would only measure the rate limiter
+        for provider in ('AIRTABLE', 'NOTION', 'HUBSPOT', 'AIRTABLE_BASE', 'HUBSPOT_SEARCH'):
+            os.environ.setdefault(f'{provider}_RATE_PER_SECOND', '100000')
+            os.environ.setdefault(f'{provider}_RATE_BURST', '100000')
+
+    import redis_client
+    if args.redis_url:
+        import redis.asyncio as redis
+        redis_client.redis_client = redis.Redis.from_url(args.redis_url)
+    else:
+        import fakeredis
+        redis_client.redis_client = fakeredis.aioredis.FakeRedis()
+
+
+def run_loader(name: str, args: argparse.Namespace) -> dict:
+    """Runs one loader warmup + rounds times in the current process and returns its measurements"""
+    _configure(args)
+    import httpx
+
+    import http_client
+    import resilience
+    import upstream
+    from benchmarks.standins import STANDINS, StandInConfig
+
+    provider, module, function, kwargs = LOADERS[name]
+    config = StandInConfig(
+        items=args.items,
+        page_size=args.page_size,
+        latency=args.latency,
+        slow_ratio=args.slow_ratio,
+        slow_latency=args.slow_latency,
+        rate_limit_ratio=args.rate_limit_ratio,
+        retry_after=args.retry_after,
+        records_per_table=args.records_per_table,
+    )
+    standin = STANDINS[provider](config)
+    http_client.set_http_transport(provider, httpx.ASGITransport(app=standin.app))
+    loader = getattr(importlib.import_module(module), function)
+    credentials = json.dumps({'access_token': f'bench-{name}'})
+
+    async def measure():
+        latencies, items = [], 0
+        for round_number in range(args.warmup + args.rounds):
+            started = time.perf_counter()
+            # the loaders print their whole result, which is not what is being measured here
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                result = await loader(credentials, **kwargs)
+            elapsed = time.perf_counter() - started
+            if round_number >= args.warmup:
+                latencies.append(elapsed)
+                items = len(result)
+        await http_client.close_http_clients()
+        return latencies, items
+
+    latencies, items = asyncio.run(measure())
+    loads = args.warmup + args.rounds
+    return {
+        'items': items,
+        'rounds': args.rounds,
+        'items_per_second': round(items * len(latencies) / sum(latencies), 1),
+        'p50_seconds': round(_percentile(latencies, 50), 4),
+        'p99_seconds': round(_percentile(latencies, 99), 4),
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10), 1),
+        'upstream_requests_per_load': round(standin.stats.requests / loads, 1),
+        'rate_limited_per_load': round(standin.stats.rate_limited / loads, 1),
+        'upstream_stats': upstream.upstream_stats()[provider],
+        'hedging': resilience.resilience_stats()['endpoints'].get(provider, {}),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Lists every metric that got worse than the baseline by more than tolerance (a fraction)"""
+    regressions = []
+    for name, current in results['loaders'].items():
+        previous = baseline.get('loaders', {}).get(name)
+        if previous is None:
+            continue
+        for metric in COMPARED:
+            before, after = previous.get(metric), current.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > tolerance:
+                regressions.append(f'{name}.{metric}: {before} -> {after} ({change:+.1%})')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loaders', nargs='+', choices=sorted(LOADERS), default=sorted(LOADERS))
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--records-per-table', type=int, default=20, help='records per table for airtable_records, --items is the number of bases')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every stand-in response')
+    parser.add_argument('--slow-ratio', type=float, default=0.0, help='share of stand-in responses delayed by --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=1.0)
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='share of requests answered with a 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--redis-url', help='use this Redis instead of fakeredis')
+    parser.add_argument('--real-rate-limits', action='store_true', help='keep the production per-token rate limits')
+    parser.add_argument('--output', default='bench_loaders.json')
+    parser.add_argument('--baseline', help='results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'loaders')},
+        'loaders': {},
+    }
+    context = multiprocessing.get_context('spawn')
+    for name in args.loaders:
+        # a fresh process per loader, so peak RSS and module state belong to that loader alone
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            measured = results['loaders'][name] = pool.submit(run_loader, name, args).result()
+        print(
+            f'{name:>12}: {measured["items"]:>7} items  {measured["items_per_second"]:>10,.0f} items/s  '
+            f'p50 {measured["p50_seconds"]:.3f}s  p99 {measured["p99_seconds"]:.3f}s  '
+            f'rss {measured["peak_rss_mb"]:.0f} MiB  {measured["upstream_requests_per_load"]:.0f} requests/load'
+        )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Items/sec of the per-item create_integration_item_metadata_object functions vs the compiled ItemMappings.
+
+The payloads are copies of real Notion /v1/search and HubSpot /crm/v3/objects/contacts pages with the
+ids and text varied per item. Run from backend/: python -m benchmarks.bench_normalize
+"""
+import asyncio
+import copy
+import gc
+import time
+
+from integrations.hubspot import CONTACT_MAPPING
+from integrations.integration_item import IntegrationItem
+from integrations.notion import NOTION_MAPPING, _recursive_dict_search
+
+N_ITEMS = 50_000
+PAGE_SIZE = 100
+ROUNDS = 5
+
+NOTION_PAGE = {
+    'object': 'page',
+    'id': '59833787-2cf9-4fdf-8782-e53db20768a5',
+    'created_time': '2022-03-01T19:05:00.000Z',
+    'last_edited_time': '2022-07-06T20:25:00.000Z',
+    'created_by': {'object': 'user', 'id': 'ee5f0f84-409a-440f-983a-a5315961c6e4'},
+    'last_edited_by': {'object': 'user', 'id': '0c3e9826-b8f7-4f73-927d-2caaf86f1103'},
+    'cover': None,
+    'icon': {'type': 'emoji', 'emoji': '\U0001F4DD'},
+    'parent': {'type': 'database_id', 'database_id': 'd9824bdc-8445-4327-be8b-5b47500af6ce'},
+    'archived': False,
+    'properties': {
+        'Store availability': {
+            'id': '%3AUPp',
+            'type': 'multi_select',
+            'multi_select': [
+                {'id': 't|O@', 'name': "Gus's Community Market", 'color': 'yellow'},
+                {'id': '{Ml\\', 'name': 'Rainbow Grocery', 'color': 'gray'},
+            ],
+        },
+        'Food group': {'id': 'A%40Hk', 'type': 'select', 'select': {'id': '5e8e7e8f', 'name': 'Vegetable', 'color': 'green'}},
+        'Price': {'id': 'BJXS', 'type': 'number', 'number': 2.5},
+        'Responsible Person': {'id': 'Iowm', 'type': 'people', 'people': []},
+        'Last ordered': {'id': 'Jsfb', 'type': 'date', 'date': {'start': '2022-02-22', 'end': None, 'time_zone': None}},
+        'Cost of next trip': {'id': 'WOd%3B', 'type': 'formula', 'formula': {'type': 'number', 'number': 0}},
+        'Description': {
+            'id': '_Tc_',
+            'type': 'rich_text',
+            'rich_text': [{
+                'type': 'text',
+                'text': {'content': 'A dark green leafy vegetable', 'link': None},
+                'annotations': {'bold': False, 'italic': False, 'strikethrough': False, 'underline': False, 'code': False, 'color': 'default'},
+                'plain_text': 'A dark green leafy vegetable',
+                'href': None,
+            }],
+        },
+        'In stock': {'id': '%60%5Bq%3F', 'type': 'checkbox', 'checkbox': True},
+        'Name': {
+            'id': 'title',
+            'type': 'title',
+            'title': [{
+                'type': 'text',
+                'text': {'content': 'Tuscan kale', 'link': None},
+                'annotations': {'bold': False, 'italic': False, 'strikethrough': False, 'underline': False, 'code': False, 'color': 'default'},
+                'plain_text': 'Tuscan kale',
+                'href': None,
+            }],
+        },
+    },
+    'url': 'https://www.notion.so/Tuscan-kale-598337872cf94fdf8782e53db20768a5',
+}
+
+HUBSPOT_CONTACT = {
+    'id': '512',
+    'properties': {
+        'createdate': '2019-10-30T03:30:17.883Z',
+        'email': 'bcooper@biglytics.net',
+        'firstname': 'Bryan',
+        'hs_object_id': '512',
+        'lastmodifieddate': '2019-12-07T16:50:06.678Z',
+        'lastname': 'Cooper',
+    },
+    'createdAt': '2019-10-30T03:30:17.883Z',
+    'updatedAt': '2019-12-07T16:50:06.678Z',
+    'archived': False,
+}
+
+
+def _pages(template, vary):
+    items = []
+    for i in range(N_ITEMS):
+        item = copy.deepcopy(template)
+        vary(item, i)
+        items.append(item)
+    return [items[i:i + PAGE_SIZE] for i in range(0, N_ITEMS, PAGE_SIZE)]
+
+
+def _vary_notion(page, i):
+    page['id'] = f'page-{i}'
+    page['properties']['Name']['title'][0]['text']['content'] = f'Item {i}'
+    page['properties']['Name']['title'][0]['plain_text'] = f'Item {i}'
+
+
+def _vary_hubspot(contact, i):
+    contact['id'] = str(i)
+    contact['properties']['firstname'] = f'First{i}'
+
+
+def notion_before(response_json):
+    """notion.create_integration_item_metadata_object before the mapping engine, kept here as the baseline"""
+    name = _recursive_dict_search(response_json['properties'], 'content')
+    parent_type = '' if response_json['parent']['type'] is None else response_json['parent']['type']
+    parent_id = None if response_json['parent']['type'] == 'workspace' else response_json['parent'][parent_type]
+    name = _recursive_dict_search(response_json, 'content') if name is None else name
+    name = 'multi_select' if name is None else name
+    name = response_json['object'] + ' ' + name
+    return IntegrationItem(
+        id=response_json['id'],
+        type=response_json['object'],
+        name=name,
+        creation_time=response_json['created_time'],
+        last_modified_time=response_json['last_edited_time'],
+        parent_id=parent_id,
+    )
+
+
+async def hubspot_before(response_json, item_type):
+    """hubspot.create_integration_item_metadata_object before the mapping engine, kept here as the baseline"""
+    item_id = str(response_json.get('id', ''))
+    properties = response_json.get('properties', {})
+    first_name = properties.get('firstname', '')
+    last_name = properties.get('lastname', '')
+    name = f'{first_name} {last_name}'.strip() if first_name or last_name else f'Contact {item_id}'
+    return IntegrationItem(
+        id=f'{item_id}_{item_type}',
+        name=name,
+        email=name,
+        type=item_type,
+        creation_time=response_json.get('createdAt'),
+        last_modified_time=response_json.get('updatedAt'),
+    )
+
+
+async def _hubspot_before_pages(pages):
+    return [[await hubspot_before(contact, 'Contact') for contact in page] for page in pages]
+
+
+def _items_per_second(run, pages):
+    best = float('inf')
+    gc.disable()  # like timeit, so a collection landing in one variant does not decide the comparison
+    try:
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            run(pages)
+            best = min(best, time.perf_counter() - started)
+    finally:
+        gc.enable()
+    return N_ITEMS / best
+
+
+def main():
+    notion_pages = _pages(NOTION_PAGE, _vary_notion)
+    hubspot_pages = _pages(HUBSPOT_CONTACT, _vary_hubspot)
+    results = [
+        ('notion', 'before', _items_per_second(lambda pages: [[notion_before(r) for r in page] for page in pages], notion_pages)),
+        ('notion', 'mapping', _items_per_second(lambda pages: [NOTION_MAPPING.map_page(page) for page in pages], notion_pages)),
+        ('hubspot', 'before', _items_per_second(lambda pages: asyncio.run(_hubspot_before_pages(pages)), hubspot_pages)),
+        ('hubspot', 'mapping', _items_per_second(lambda pages: [CONTACT_MAPPING.map_page(page) for page in pages], hubspot_pages)),
+    ]
+    baselines = {provider: rate for provider, variant, rate in results if variant == 'before'}
+    for provider, variant, rate in results:
+        print(f'{provider:>8} {variant:>8}: {rate:12,.0f} items/s ({rate / baselines[provider]:5.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
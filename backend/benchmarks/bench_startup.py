@@ -0,0 +1,130 @@
+"""Cold start of one API worker: time to the first answered request and resident memory, per provider setup.
+
+Every round starts a fresh `uvicorn main:app` process and measures:
+  - time_to_first_request: from spawning the process to the first 200 from GET /
+  - first_provider_request: the first request to each enabled provider, which imports it unless preloaded
+  - rss after startup and after every enabled provider has been used
+No Redis or provider account is needed, the provider requests are OAuth callbacks answered with an error.
+
+Run from backend/: python -m benchmarks.bench_startup --rounds 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# setup name -> environment of the worker
+SETUPS = {
+    'lazy': {},
+    'preload': {'PRELOAD_PROVIDERS': '1'},
+    'hubspot_only': {'ENABLED_PROVIDERS': 'hubspot'},
+}
+PROVIDERS = ('airtable', 'notion', 'hubspot')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb(pid: int) -> float:
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 2**20
+    except ImportError:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 2**10
+    raise RuntimeError('Cannot read the RSS of the worker, install psutil.')
+
+
+def _get(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_round(env: dict, timeout: float) -> dict:
+    port = _free_port()
+    base = f'http://127.0.0.1:{port}'
+    enabled = env.get('ENABLED_PROVIDERS', ','.join(PROVIDERS)).split(',')
+    started = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+        env={**os.environ, 'ITEM_INDEX_PATH': '', **env},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if worker.poll() is not None:
+                raise RuntimeError(f'The worker exited with {worker.returncode} before answering, run uvicorn main:app to see why.')
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError(f'The worker did not answer within {timeout} seconds.')
+            try:
+                if _get(f'{base}/') == 200:
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        measured = {'time_to_first_request': time.perf_counter() - started, 'rss_mb_started': _rss_mb(worker.pid)}
+        for provider in enabled:
+            request_started = time.perf_counter()
+            status = _get(f'{base}/integrations/{provider}/oauth2callback?error=benchmark')
+            if status != 400:
+                raise RuntimeError(f'Unexpected status {status} from the {provider} callback.')
+            measured[f'first_request_{provider}'] = time.perf_counter() - request_started
+        measured['rss_mb_all_used'] = _rss_mb(worker.pid)
+        return measured
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--setups', nargs='+', choices=sorted(SETUPS), default=list(SETUPS))
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', default='bench_startup.json')
+    args = parser.parse_args(argv)
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'rounds': args.rounds,
+        'setups': {},
+    }
+    for name in args.setups:
+        rounds = [run_round(SETUPS[name], args.timeout) for _ in range(args.rounds)]
+        # medians, a cold start is noisy
+        measured = results['setups'][name] = {
+            metric: round(statistics.median(r[metric] for r in rounds), 4) for metric in rounds[0]
+        }
+        first_requests = '  '.join(
+            f'{metric[len("first_request_"):]} {value * 1000:.1f}ms' for metric, value in measured.items()
+            if metric.startswith('first_request_')
+        )
+        print(
+            f'{name:>12}: first request {measured["time_to_first_request"]:.3f}s  '
+            f'rss {measured["rss_mb_started"]:.1f} MiB -> {measured["rss_mb_all_used"]:.1f} MiB  first per provider: {first_requests}'
+        )
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Vector index at scale: build time, file size and top-k query latency over one account's items.
+
+Synthetic items (names, emails, parents and types like the loaders produce) are written in batches the way
+the item index writer does, then random queries are timed against the memory-mapped file:
+  - build: items vectorized and appended per second
+  - query: p50/p99 of search_vectors, with the file in the page cache
+  - update: rewriting and deleting a batch of existing items
+No Redis, SQLite or provider account is needed.
+
+Run from backend/: python -m benchmarks.bench_vector_index --items 1000000 --output vector_index.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+WORDS = (
+    'acme', 'projects', 'roadmap', 'quarterly', 'report', 'sales', 'pipeline', 'invoice', 'design', 'review',
+    'marketing', 'launch', 'customer', 'feedback', 'hiring', 'budget', 'meeting', 'notes', 'engineering', 'support',
+)
+TYPES = ('Contact', 'Record', 'Table', 'Base', 'page', 'database')
+
+
+def _item(rng: random.Random, i: int) -> dict:
+    name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+    return {
+        'id': str(i),
+        'name': f'{name} {i}',
+        'email': f'{rng.choice(WORDS)}.{i}@example.com' if rng.random() < 0.3 else None,
+        'type': rng.choice(TYPES),
+        'parent_path_or_name': rng.choice(WORDS).title(),
+    }
+
+
+def _percentile(values, percent):
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=1_000_000)
+    parser.add_argument('--batch', type=int, default=10_000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--dimensions', type=int, help='VECTOR_INDEX_DIMENSIONS, 128 by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_vector_index.json')
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix='bench-vector-index-')
+    os.environ['VECTOR_INDEX_PATH'] = directory
+    if args.dimensions:
+        os.environ['VECTOR_INDEX_DIMENSIONS'] = str(args.dimensions)
+    import vector_index  # configured from the environment when imported
+
+    rng = random.Random(args.seed)
+    try:
+        started = time.perf_counter()
+        for first in range(0, args.items, args.batch):
+            keys = list(range(first, min(first + args.batch, args.items)))
+            vector_index.update_vectors('org', 'user', keys, [_item(rng, key) for key in keys])
+        build_seconds = time.perf_counter() - started
+        path = vector_index._path('org', 'user')
+
+        queries = [f'{rng.choice(WORDS)[:-1]} {rng.choice(WORDS)}' for _ in range(args.queries)]
+        vector_index.search_vectors('org', 'user', queries[0], args.limit)  # maps the file and warms the page cache
+        latencies = []
+        for query in queries:
+            query_started = time.perf_counter()
+            vector_index.search_vectors('org', 'user', query, args.limit)
+            latencies.append(time.perf_counter() - query_started)
+
+        keys = rng.sample(range(args.items), min(args.batch, args.items))
+        update_started = time.perf_counter()
+        vector_index.update_vectors('org', 'user', keys, [_item(rng, key) for key in keys])
+        update_seconds = time.perf_counter() - update_started
+        delete_started = time.perf_counter()
+        vector_index.delete_vectors('org', 'user', keys)
+        delete_seconds = time.perf_counter() - delete_started
+
+        results = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'items': args.items,
+            'dimensions': vector_index.VECTOR_INDEX_DIMENSIONS,
+            'file_mb': round(os.path.getsize(path) / 2**20, 1),
+            'build_items_per_second': round(args.items / build_seconds, 1),
+            'query_p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+            'query_p99_ms': round(_percentile(latencies, 99) * 1000, 2),
+            f'update_{len(keys)}_ms': round(update_seconds * 1000, 1),
+            f'delete_{len(keys)}_ms': round(delete_seconds * 1000, 1),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(
+        f'{results["items"]} items x {results["dimensions"]} dims ({results["file_mb"]} MiB): '
+        f'build {results["build_items_per_second"]:,.0f} items/s  '
+        f'query p50 {results["query_p50_ms"]}ms p99 {results["query_p99_ms"]}ms'
+    )
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
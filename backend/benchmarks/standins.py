@@ -0,0 +1,232 @@
+"""Local ASGI stand-ins for the provider APIs the loaders call, for benchmarks that must not touch live accounts.
+
+Each stand-in serves a generated dataset in the same response shape as the real API, with a configurable
+page size, per-request latency, share of slow responses (the latency tail) and share of requests answered with a 429.
+"""
+import asyncio
+import functools
+import random
+from dataclasses import dataclass, field
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+CREATED = '2024-01-01T00:00:00.000Z'
+EDITED = '2024-06-01T00:00:00.000Z'
+
+
+@dataclass
+class StandInConfig:
+    items: int = 1000  # bases for Airtable, pages and databases for Notion, contacts for HubSpot
+    page_size: int = 100  # the most a single response returns, whatever the client asks for
+    latency: float = 0.0  # seconds added to every response
+    slow_ratio: float = 0.0  # share of responses delayed by slow_latency on top, the tail hedging is for
+    slow_latency: float = 1.0
+    rate_limit_ratio: float = 0.0  # share of requests answered with a 429
+    retry_after: int = 1
+    tables_per_base: int = 5  # Airtable only
+    records_per_table: int = 0  # Airtable only, served by /v0/{base_id}/{table_id}
+    children_per_page: int = 5  # Notion only, fan-out of the page tree served by /v1/blocks
+    seed: int = 0
+
+
+@dataclass
+class StandInStats:
+    requests: int = 0
+    rate_limited: int = 0
+    by_route: dict = field(default_factory=dict)
+
+
+class StandIn:
+    """One provider's stand-in: its ASGI app plus what it has served"""
+
+    def __init__(self, config: StandInConfig, routes):
+        self.config = config
+        self.stats = StandInStats()
+        self._random = random.Random(config.seed)
+        self.app = Starlette(routes=[Route(path, self._wrap(path, handler), methods=methods) for path, handler, methods in routes])
+
+    def _wrap(self, path, handler):
+        async def endpoint(request: Request):
+            self.stats.requests += 1
+            self.stats.by_route[path] = self.stats.by_route.get(path, 0) + 1
+            latency = self.config.latency
+            if self.config.slow_ratio and self._random.random() < self.config.slow_ratio:
+                latency += self.config.slow_latency
+            if latency:
+                await asyncio.sleep(latency)
+            if self.config.rate_limit_ratio and self._random.random() < self.config.rate_limit_ratio:
+                self.stats.rate_limited += 1
+                return JSONResponse(
+                    {'message': 'rate limited'}, status_code=429, headers={'Retry-After': str(self.config.retry_after)}
+                )
+            return await handler(self.config, request)
+        return endpoint
+
+
+def _page_bounds(config: StandInConfig, cursor, requested) -> tuple:
+    start = int(cursor or 0)
+    size = min(int(requested or config.page_size), config.page_size)
+    return start, min(start + size, config.items)
+
+
+# Airtable meta API
+
+async def _airtable_bases(config: StandInConfig, request: Request):
+    start, stop = _page_bounds(config, request.query_params.get('offset'), None)
+    body = {'bases': [{'id': f'app{i:06d}', 'name': f'Base {i}', 'permissionLevel': 'create'} for i in range(start, stop)]}
+    if stop < config.items:
+        body['offset'] = str(stop)
+    return JSONResponse(body)
+
+
+async def _airtable_tables(config: StandInConfig, request: Request):
+    base_id = request.path_params['base_id']
+    return JSONResponse({'tables': [
+        {
+            'id': f'tbl{base_id[3:]}{t:02d}',
+            'name': f'Table {t}',
+            'primaryFieldId': 'fld0',
+            'fields': [{'id': 'fld0', 'name': 'Name', 'type': 'singleLineText'}],
+        }
+        for t in range(config.tables_per_base)
+    ]})
+
+
+async def _airtable_records(config: StandInConfig, request: Request):
+    table_id = request.path_params['table_id']
+    start, stop = _page_bounds(
+        StandInConfig(items=config.records_per_table, page_size=config.page_size),
+        request.query_params.get('offset'),
+        request.query_params.get('pageSize'),
+    )
+    projection = request.query_params.getlist('fields[]')
+    body = {'records': [
+        {
+            'id': f'rec{table_id[3:]}{r:06d}',
+            'createdTime': CREATED,
+            'fields': {name: f'Record {r}' for name in projection or ['Name']},
+        }
+        for r in range(start, stop)
+    ]}
+    if stop < config.records_per_table:
+        body['offset'] = str(stop)
+    return JSONResponse(body)
+
+
+def airtable_standin(config: StandInConfig) -> StandIn:
+    return StandIn(config, [
+        ('/v0/meta/bases', _airtable_bases, ['GET']),
+        ('/v0/meta/bases/{base_id}/tables', _airtable_tables, ['GET']),
+        ('/v0/{base_id}/{table_id}', _airtable_records, ['GET']),
+    ])
+
+
+# Notion search and blocks. Every tenth object is a database, page i sits under page (i - 1) // children_per_page
+
+def _notion_parent(config: StandInConfig, i: int) -> dict:
+    if i == 0:
+        return {'type': 'workspace', 'workspace': True}
+    return {'type': 'page_id', 'page_id': f'page-{(i - 1) // config.children_per_page}'}
+
+
+def _notion_object(config: StandInConfig, i: int) -> dict:
+    title = [{'type': 'text', 'text': {'content': f'Object {i}', 'link': None}, 'plain_text': f'Object {i}'}]
+    if i % 10 == 9:
+        return {
+            'object': 'database', 'id': f'page-{i}', 'created_time': CREATED, 'last_edited_time': EDITED,
+            'parent': _notion_parent(config, i), 'title': title,
+            'properties': {'Name': {'id': 'title', 'type': 'title', 'title': {}}},
+        }
+    return {
+        'object': 'page', 'id': f'page-{i}', 'created_time': CREATED, 'last_edited_time': EDITED,
+        'parent': _notion_parent(config, i),
+        'properties': {'title': {'id': 'title', 'type': 'title', 'title': title}},
+    }
+
+
+@functools.lru_cache(maxsize=8)
+def _notion_ids(items: int, databases: bool) -> tuple:
+    return tuple(i for i in range(items) if (i % 10 == 9) == databases)
+
+
+async def _notion_search(config: StandInConfig, request: Request):
+    body = await request.json()
+    wanted = body.get('filter', {}).get('value')
+    ids = _notion_ids(config.items, wanted == 'database')
+    start = int(body.get('start_cursor') or 0)
+    stop = min(start + min(body.get('page_size', config.page_size), config.page_size), len(ids))
+    more = stop < len(ids)
+    return JSONResponse({
+        'object': 'list',
+        'results': [_notion_object(config, i) for i in ids[start:stop]],
+        'has_more': more,
+        'next_cursor': str(stop) if more else None,
+    })
+
+
+async def _notion_block_children(config: StandInConfig, request: Request):
+    block_id = request.path_params['block_id']
+    parent = int(block_id.split('-')[1])
+    children = [
+        i for i in range(parent * config.children_per_page + 1, (parent + 1) * config.children_per_page + 1)
+        if i < config.items
+    ]
+    start, stop = _page_bounds(
+        StandInConfig(items=len(children), page_size=config.page_size),
+        request.query_params.get('start_cursor'),
+        request.query_params.get('page_size'),
+    )
+    more = stop < len(children)
+    return JSONResponse({
+        'object': 'list',
+        'results': [
+            {
+                'object': 'block', 'id': f'page-{i}', 'has_children': True, 'created_time': CREATED, 'last_edited_time': EDITED,
+                **({'type': 'child_database', 'child_database': {'title': f'Object {i}'}} if i % 10 == 9
+                   else {'type': 'child_page', 'child_page': {'title': f'Object {i}'}}),
+            }
+            for i in children[start:stop]
+        ],
+        'has_more': more,
+        'next_cursor': str(stop) if more else None,
+    })
+
+
+def notion_standin(config: StandInConfig) -> StandIn:
+    return StandIn(config, [
+        ('/v1/search', _notion_search, ['POST']),
+        ('/v1/blocks/{block_id}/children', _notion_block_children, ['GET']),
+    ])
+
+
+# HubSpot CRM contacts
+
+def _hubspot_contact(i: int) -> dict:
+    return {
+        'id': str(i + 1),
+        'properties': {
+            'createdate': CREATED, 'email': f'contact{i}@example.com', 'firstname': f'First{i}',
+            'hs_object_id': str(i + 1), 'lastmodifieddate': EDITED, 'lastname': f'Last{i}',
+        },
+        'createdAt': CREATED,
+        'updatedAt': EDITED,
+        'archived': False,
+    }
+
+
+async def _hubspot_contacts(config: StandInConfig, request: Request):
+    start, stop = _page_bounds(config, request.query_params.get('after'), request.query_params.get('limit'))
+    body = {'results': [_hubspot_contact(i) for i in range(start, stop)]}
+    if stop < config.items:
+        body['paging'] = {'next': {'after': str(stop), 'link': f'?after={stop}'}}
+    return JSONResponse(body)
+
+
+def hubspot_standin(config: StandInConfig) -> StandIn:
+    return StandIn(config, [('/crm/v3/objects/contacts', _hubspot_contacts, ['GET'])])
+
+
+STANDINS = {'airtable': airtable_standin, 'notion': notion_standin, 'hubspot': hubspot_standin}
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from fastapi import HTTPException
+
+from integrations.registry import ENABLED_PROVIDERS, PROVIDER_MODULES
+from load_pages import compact, project
+from serialization import dumps, loads
+
+# Accounts loaded at once by one bulk request, across all providers
+BULK_LOAD_CONCURRENCY = int(os.environ.get('BULK_LOAD_CONCURRENCY', 8))
+# Accounts of one provider loaded at once by one bulk request, so one provider never takes the whole budget
+# (BULK_LOAD_AIRTABLE_CONCURRENCY, BULK_LOAD_NOTION_CONCURRENCY, ...)
+BULK_LOAD_PROVIDER_CONCURRENCY = {
+    provider: int(os.environ.get(f'BULK_LOAD_{provider.upper()}_CONCURRENCY', 4)) for provider in PROVIDER_MODULES
+}
+# Accounts of one org loaded at once, the other orgs keep getting slots while a big org is being loaded
+BULK_LOAD_MAX_PER_ORG = int(os.environ.get('BULK_LOAD_MAX_PER_ORG', 2))
+# A single account still loading after this long is reported as failed
+BULK_LOAD_ACCOUNT_TIMEOUT = float(os.environ.get('BULK_LOAD_ACCOUNT_TIMEOUT', 600))
+BULK_LOAD_MAX_ACCOUNTS = int(os.environ.get('BULK_LOAD_MAX_ACCOUNTS', 1000))
+
+Loader = Callable[[dict], Awaitable[List[dict]]]
+
+
+def parse_accounts(accounts: str) -> List[dict]:
+    """The accounts form field: a JSON array of {provider, credentials, user_id?, org_id?}"""
+    try:
+        accounts = loads(accounts)
+    except ValueError:
+        raise HTTPException(status_code=400, detail='accounts must be a JSON array.')
+    if not isinstance(accounts, list) or not all(isinstance(account, dict) for account in accounts):
+        raise HTTPException(status_code=400, detail='accounts must be a JSON array of objects.')
+    if len(accounts) > BULK_LOAD_MAX_ACCOUNTS:
+        raise HTTPException(status_code=400, detail=f'At most {BULK_LOAD_MAX_ACCOUNTS} accounts per bulk load.')
+    return accounts
+
+
+def _invalid(account: dict) -> Optional[str]:
+    if account.get('provider') not in ENABLED_PROVIDERS:
+        return f'Unknown integration {account.get("provider")!r}.'
+    credentials = account.get('credentials')
+    if isinstance(credentials, dict):
+        # accepted as an object too, the loaders take the JSON string the /load routes receive
+        account['credentials'] = dumps(credentials).decode('utf-8')
+    elif not isinstance(credentials, str) or not credentials:
+        return 'credentials are required.'
+    return None
+
+
+class _FairQueue:
+    """Accounts waiting to load, handed out round-robin across orgs within the provider and org caps"""
+
+    def __init__(self):
+        self.by_org = collections.OrderedDict()  # org -> deque of (index, account), in turn order
+        self.running_by_provider = collections.Counter()
+        self.running_by_org = collections.Counter()
+
+    def add(self, index: int, account: dict) -> None:
+        self.by_org.setdefault(account.get('org_id'), collections.deque()).append((index, account))
+
+    def __bool__(self) -> bool:
+        return bool(self.by_org)
+
+    def take(self) -> Optional[tuple]:
+        for org, waiting in self.by_org.items():
+            if self.running_by_org[org] >= BULK_LOAD_MAX_PER_ORG:
+                continue
+            for position, (index, account) in enumerate(waiting):
+                provider = account['provider']
+                if self.running_by_provider[provider] >= BULK_LOAD_PROVIDER_CONCURRENCY[provider]:
+                    continue
+                del waiting[position]
+                # the org goes to the back of the line, whether it has more accounts waiting or not
+                self.by_org.pop(org)
+                if waiting:
+                    self.by_org[org] = waiting
+                self.running_by_provider[provider] += 1
+                self.running_by_org[org] += 1
+                return index, account
+        return None
+
+    def release(self, account: dict) -> None:
+        self.running_by_provider[account['provider']] -= 1
+        self.running_by_org[account.get('org_id')] -= 1
+
+
+def _result(index: int, account: dict, started: float, **fields) -> dict:
+    return {
+        'index': index,
+        'provider': account.get('provider'),
+        'user_id': account.get('user_id'),
+        'org_id': account.get('org_id'),
+        **fields,
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+async def _load_account(index: int, account: dict, load: Loader, fields: Optional[List[str]]) -> dict:
+    started = time.monotonic()
+    try:
+        items = await asyncio.wait_for(load(account), timeout=BULK_LOAD_ACCOUNT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return _result(index, account, started, status='error', status_code=504,
+                       error=f'Loading took longer than {BULK_LOAD_ACCOUNT_TIMEOUT} seconds.')
+    except HTTPException as e:
+        return _result(index, account, started, status='error', status_code=e.status_code, error=e.detail)
+    except Exception as e:
+        return _result(index, account, started, status='error', status_code=500, error=repr(e))
+    if fields:
+        items = [project(compact(item), fields) for item in items]
+    return _result(index, account, started, status='ok', count=len(items), items=items)
+
+
+async def bulk_load(accounts: List[dict], load: Loader, fields: Optional[List[str]] = None) -> AsyncIterator[dict]:
+    """Loads every account with load and yields one result per account as soon as it finishes.
+
+    Results carry the account's index in accounts, its status ('ok' with count and items, or 'error' with
+    status_code and error) and how long it took. An account that fails never stops the others.
+    """
+    queue = _FairQueue()
+    for index, account in enumerate(accounts):
+        error = _invalid(account)
+        if error is not None:
+            yield _result(index, account, time.monotonic(), status='error', status_code=400, error=error)
+        else:
+            queue.add(index, account)
+
+    running = {}
+    try:
+        while queue or running:
+            while len(running) < BULK_LOAD_CONCURRENCY:
+                taken = queue.take()
+                if taken is None:
+                    break
+                index, account = taken
+                running[asyncio.create_task(_load_account(index, account, load, fields))] = account
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                queue.release(running.pop(task))
+                yield task.result()
+    finally:
+        # the client went away: the loads nobody will read are stopped
+        for task in running:
+            task.cancel()
@@ -0,0 +1,318 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+from fastapi import HTTPException
+
+from integrations.integration_item import IntegrationItem
+from redis_client import (
+    add_key_value_if_absent_redis,
+    append_list_redis,
+    delete_key_if_value_redis,
+    extend_key_if_value_redis,
+    get_list_range_redis,
+    get_value_redis,
+    key_exists_redis,
+    publish_redis,
+    pubsub_redis,
+)
+from serialization import pack, unpack
+
+# How long other workers wait for the worker that is running a load before running it themselves
+COALESCE_WAIT_TIMEOUT = int(os.environ.get('COALESCE_WAIT_TIMEOUT', 300))
+# Results above this size are not broadcast, waiting workers then run the load themselves (normally a load cache hit)
+COALESCE_MAX_PUBLISH_BYTES = int(os.environ.get('COALESCE_MAX_PUBLISH_BYTES', 16 * 1024 * 1024))
+# A streamed load hands its items to the other workers in chunks of this many
+COALESCE_STREAM_CHUNK = int(os.environ.get('COALESCE_STREAM_CHUNK', 500))
+# Callers in the same worker can join a streamed load until it has produced this many items, which it keeps to replay
+# to them. Later callers replay what the load published to Redis instead.
+COALESCE_REPLAY_ITEMS = int(os.environ.get('COALESCE_REPLAY_ITEMS', 10_000))
+# Past that, a streamed load runs at most this many items ahead of its slowest caller
+COALESCE_STREAM_WINDOW = int(os.environ.get('COALESCE_STREAM_WINDOW', 1000))
+
+_inflight = {}
+_streams = {}
+_stats = {'leaders': 0, 'coalesced_in_process': 0, 'coalesced_cross_worker': 0, 'fallbacks': 0}
+
+_FAILED = b'failed'
+_TOO_LARGE = b'too_large'
+_DONE = b'done'
+
+
+def coalesce_key(provider: str, credentials: str, *variant) -> str:
+    access_token = json.loads(credentials).get('access_token') or ''
+    digest = hashlib.sha256('\0'.join([access_token, *map(str, variant)]).encode('utf-8')).hexdigest()
+    return f'{provider}:{digest}'
+
+
+async def coalesced(key: str, run: Callable[[], Awaitable[Any]]) -> Any:
+    """Runs run() once for all identical in-flight calls, in this worker and across workers.
+
+    run() must return something JSON serializable so it can be handed to waiters in other workers.
+    """
+    task = _inflight.get(key)
+    if task is not None:
+        _stats['coalesced_in_process'] += 1
+    else:
+        task = _inflight[key] = asyncio.create_task(_run_once(key, run))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: one caller disconnecting must not cancel the load for everyone else
+    return await asyncio.shield(task)
+
+
+@contextlib.asynccontextmanager
+async def _leading(lock_key: str, owner: str):
+    # the lock outlives COALESCE_WAIT_TIMEOUT as long as its leader runs, and a leader only ever releases its own
+    # lock: one that expired anyway (a stalled worker) may belong to the next leader by then
+    async def renew():
+        while await extend_key_if_value_redis(lock_key, owner, COALESCE_WAIT_TIMEOUT):
+            await asyncio.sleep(COALESCE_WAIT_TIMEOUT / 3)
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        await delete_key_if_value_redis(lock_key, owner)
+
+
+async def _run_once(key: str, run: Callable[[], Awaitable[Any]]) -> Any:
+    lock_key, channel, owner = f'coalesce_lock:{key}', f'coalesce:{key}', uuid.uuid4().hex
+    if await add_key_value_if_absent_redis(lock_key, owner, expire=COALESCE_WAIT_TIMEOUT):
+        _stats['leaders'] += 1
+        async with _leading(lock_key, owner):
+            try:
+                result = await run()
+            except Exception:
+                await publish_redis(channel, _FAILED)
+                raise
+            payload = pack(result)
+            await publish_redis(channel, payload if len(payload) <= COALESCE_MAX_PUBLISH_BYTES else _TOO_LARGE)
+        return result
+
+    payload = await _wait_for_leader(lock_key, channel)
+    if payload == _FAILED:
+        raise HTTPException(status_code=502, detail='The shared load of this account failed.')
+    if payload is None or payload == _TOO_LARGE:
+        _stats['fallbacks'] += 1
+        return await run()
+    _stats['coalesced_cross_worker'] += 1
+    return unpack(payload)
+
+
+async def _wait_for_leader(lock_key: str, channel: str):
+    pubsub = pubsub_redis()
+    try:
+        await pubsub.subscribe(channel)
+        deadline = time.time() + COALESCE_WAIT_TIMEOUT
+        while time.time() < deadline:
+            # checked after subscribing, so a leader finishing in between is either seen here or heard below
+            if not await key_exists_redis(lock_key):
+                return None
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is not None:
+                return message['data']
+        return None
+    finally:
+        await pubsub.reset()
+
+
+class _SharedStream:
+    """The items of one streamed load in this worker that a caller may still read.
+
+    The first COALESCE_REPLAY_ITEMS are kept for callers joining late. Once the load is past them it takes no new
+    callers, keeps only what its slowest caller has not read yet and waits for that caller when it is
+    COALESCE_STREAM_WINDOW items behind, so memory stays flat however big the account is.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.items = []
+        self.start = 0  # position in the load of items[0]
+        self.positions = {}  # caller -> position of the next item it reads
+        self.joinable = True
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.drained = None  # set while the load waits for its slowest caller
+        self.task = None
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.items)
+
+    async def append(self, item: IntegrationItem) -> None:
+        if self.joinable and self.end >= COALESCE_REPLAY_ITEMS:
+            self.joinable = False
+            if _streams.get(self.key) is self:
+                del _streams[self.key]
+        while not self.joinable and self.positions and self.end - min(self.positions.values()) >= COALESCE_STREAM_WINDOW:
+            self.drained = asyncio.Event()
+            await self.drained.wait()
+        self.items.append(item)
+        self._trim()
+        self._notify()
+
+    def read(self, caller) -> IntegrationItem:
+        position = self.positions[caller]
+        self.positions[caller] = position + 1
+        if self.drained is not None:
+            self.drained.set()
+            self.drained = None
+        return self.items[position - self.start]
+
+    def leave(self, caller) -> None:
+        del self.positions[caller]
+        if self.drained is not None:
+            self.drained.set()
+            self.drained = None
+
+    def _trim(self) -> None:
+        if self.joinable or not self.positions:
+            return
+        read = min(self.positions.values()) - self.start
+        # dropped in batches, removing the head of a list copies the rest
+        if read >= max(COALESCE_STREAM_CHUNK, len(self.items) // 2):
+            del self.items[:read]
+            self.start += read
+
+    def finish(self, error: BaseException = None) -> None:
+        self.done, self.error = True, error
+        self._notify()
+
+    def _notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+async def coalesced_stream(key: str, open_stream: Callable[[], AsyncIterator[IntegrationItem]]) -> AsyncIterator[IntegrationItem]:
+    """Streaming counterpart of coalesced: one open_stream() runs for all identical in-flight calls, in this worker
+    and across workers. Callers that join late replay the items streamed so far, then get the rest as they arrive."""
+    shared = _streams.get(key)
+    if shared is not None:
+        _stats['coalesced_in_process'] += 1
+    else:
+        shared = _streams[key] = _SharedStream(key)
+        shared.task = asyncio.create_task(_stream_once(key, shared, open_stream))
+        shared.task.add_done_callback(lambda _: _streams.pop(key, None) if _streams.get(key) is shared else None)
+    caller = object()
+    shared.positions[caller] = shared.start
+    try:
+        while True:
+            if shared.positions[caller] < shared.end:
+                yield shared.read(caller)
+            elif shared.done:
+                if shared.error is not None:
+                    raise shared.error
+                return
+            else:
+                await shared.changed.wait()
+    finally:
+        shared.leave(caller)
+        if not shared.positions and not shared.done:
+            # every caller went away, nobody is left to stream for
+            if _streams.get(key) is shared:
+                del _streams[key]
+            shared.task.cancel()
+
+
+async def _stream_once(key: str, shared: _SharedStream, open_stream: Callable[[], AsyncIterator[IntegrationItem]]) -> None:
+    # the lock holds the id of the leader's list, so a new leader never appends to a list an old one's followers read
+    lock_key, channel, stream_id = f'coalesce_lock:{key}', f'coalesce:{key}', uuid.uuid4().hex
+    try:
+        if await add_key_value_if_absent_redis(lock_key, stream_id, expire=COALESCE_WAIT_TIMEOUT):
+            _stats['leaders'] += 1
+            async with _leading(lock_key, stream_id):
+                await _lead_stream(key, stream_id, shared, open_stream)
+        else:
+            await _follow_stream(key, shared, open_stream)
+    except Exception as e:
+        shared.finish(e)
+    else:
+        shared.finish()
+
+
+async def _lead_stream(key: str, stream_id: str, shared: _SharedStream, open_stream) -> None:
+    list_key, channel = f'coalesce_stream:{key}:{stream_id}', f'coalesce:{key}'
+    chunk, published, sharing = [], 0, True
+
+    async def publish(payload: bytes) -> None:
+        await append_list_redis(list_key, payload, expire=COALESCE_WAIT_TIMEOUT)
+        await publish_redis(channel, b'')
+
+    async def flush() -> bool:
+        nonlocal chunk, published
+        payload, chunk = pack(chunk), []
+        published += len(payload)
+        if published > COALESCE_MAX_PUBLISH_BYTES:
+            # followers stream the rest themselves
+            await publish(_TOO_LARGE)
+            return False
+        await publish(payload)
+        return True
+
+    try:
+        async for item in open_stream():
+            await shared.append(item)
+            if sharing:
+                chunk.append(item.to_dict())
+                if len(chunk) >= COALESCE_STREAM_CHUNK:
+                    sharing = await flush()
+        if sharing and (not chunk or await flush()):
+            await publish(_DONE)
+    except Exception:
+        await publish(_FAILED)
+        raise
+
+
+async def _follow_stream(key: str, shared: _SharedStream, open_stream) -> None:
+    lock_key, channel = f'coalesce_lock:{key}', f'coalesce:{key}'
+    # ids of the items taken from the leader, at most COALESCE_MAX_PUBLISH_BYTES worth of items
+    replayed = set()
+    pubsub = pubsub_redis()
+    try:
+        await pubsub.subscribe(channel)
+        stream_id = await get_value_redis(lock_key)
+        list_key = None if stream_id is None else f'coalesce_stream:{key}:{stream_id.decode()}'
+        position = 0
+        while list_key is not None:
+            # a few chunks at a time, the callers of this worker may be reading slower than the leader published
+            chunks = await get_list_range_redis(list_key, position, position + 3)
+            for payload in chunks:
+                position += 1
+                if payload == _DONE:
+                    _stats['coalesced_cross_worker'] += 1
+                    return
+                if payload == _FAILED:
+                    raise HTTPException(status_code=502, detail='The shared load of this account failed.')
+                if payload == _TOO_LARGE:
+                    list_key = None
+                    break
+                for item in unpack(payload):
+                    replayed.add(item['id'])
+                    await shared.append(IntegrationItem(**item))
+            if list_key is None:
+                break
+            if not chunks and await get_value_redis(lock_key) != stream_id:
+                # the lock is released after the last chunk, one more read tells a finished leader from a dead one
+                if not await get_list_range_redis(list_key, position):
+                    break
+                continue
+            await pubsub.get_message(ignore_subscribe_messages=True, timeout=0 if chunks else 1.0)
+    finally:
+        await pubsub.reset()
+
+    # the leader stopped sharing (too large, gone or never found), the rest is streamed here without what was replayed
+    _stats['fallbacks'] += 1
+    async for item in open_stream():
+        if item.id not in replayed:
+            await shared.append(item)
+
+
+def coalesce_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,119 @@
+import os
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# brotli is optional, without it only gzip is offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+# 4 compresses about as well as gzip -9 at gzip -6 speed, the higher qualities are too slow for dynamic responses
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+
+class _Gzip:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31 writes the gzip container
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _Brotli:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """The best of br and gzip the client accepts, by its q-values, br when they tie"""
+    offered = {'gzip': 0.0, 'br': 0.0}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if coding == '*':
+            offered = {name: max(value, quality) for name, value in offered.items()}
+        elif coding in offered:
+            offered[coding] = quality
+    if brotli is None:
+        offered.pop('br')
+    best = max(offered, key=lambda name: (offered[name], name == 'br'))
+    return best if offered[best] > 0 else None
+
+
+class CompressionMiddleware:
+    """Compresses responses with brotli or gzip, whichever the client prefers.
+
+    Unlike Starlette's GZipMiddleware, a streamed body is flushed after every message, so NDJSON lines still
+    reach the client as they are produced. Bodies under minimum_size and already encoded responses are left alone.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1000):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _Responder(send, encoding, self.minimum_size).send)
+
+
+class _Responder:
+    def __init__(self, send: Send, encoding: str, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            # held back until the first body message tells whether compressing is worth it
+            self.start = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start['headers'])
+            if 'content-encoding' in headers or (not more_body and len(body) < self.minimum_size):
+                self.passthrough = True
+                await self._send(self.start)
+                await self._send(message)
+                return
+            self.compressor = _Brotli() if self.encoding == 'br' else _Gzip()
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            message['body'] = self.compressor.compress(body, final=not more_body)
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(message['body']))
+            await self._send(self.start)
+            await self._send(message)
+            return
+
+        message['body'] = self.compressor.compress(body, final=not more_body)
+        await self._send(message)
@@ -0,0 +1,89 @@
+import importlib.util
+import os
+import httpx
+
+# One pooled, keep-alive client per provider, shared by every request in the worker
+PROVIDERS = ('airtable', 'notion', 'hubspot')
+
+MAX_CONNECTIONS = int(os.environ.get('HTTP_CLIENT_MAX_CONNECTIONS', 50))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS', 20))
+KEEPALIVE_EXPIRY = float(os.environ.get('HTTP_CLIENT_KEEPALIVE_EXPIRY', 30))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CLIENT_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('HTTP_CLIENT_READ_TIMEOUT', 30))
+# HTTP/2 needs the optional h2 package, fall back to HTTP/1.1 when it is missing
+HTTP2_ENABLED = (
+    os.environ.get('HTTP_CLIENT_HTTP2', 'false').lower() == 'true'
+    and importlib.util.find_spec('h2') is not None
+)
+
+_clients = {}
+_stats = {}
+_transports = {}
+
+
+class _CountingTransport(httpx.AsyncBaseTransport):
+    """Wraps the pooled transport to count pool checkouts and checkouts that had to wait"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: dict):
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._stats['checkouts'] += 1
+        if self._stats['in_flight'] >= MAX_CONNECTIONS:
+            self._stats['waits'] += 1
+        self._stats['in_flight'] += 1
+        try:
+            return await self._transport.handle_async_request(request)
+        finally:
+            self._stats['in_flight'] -= 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _build_client(provider: str) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+    stats = _stats.setdefault(provider, {'checkouts': 0, 'waits': 0, 'in_flight': 0})
+    transport = _transports.get(provider) or httpx.AsyncHTTPTransport(limits=limits, http2=HTTP2_ENABLED)
+    return httpx.AsyncClient(
+        transport=_CountingTransport(transport, stats),
+        timeout=timeout,
+        http2=HTTP2_ENABLED,
+    )
+
+
+def get_http_client(provider: str) -> httpx.AsyncClient:
+    """Returns the shared client for a provider, creating it on first use"""
+    client = _clients.get(provider)
+    if client is None or client.is_closed:
+        client = _clients[provider] = _build_client(provider)
+    return client
+
+
+def set_http_transport(provider: str, transport: httpx.AsyncBaseTransport) -> None:
+    """Sends a provider's requests through another transport, e.g. an httpx.ASGITransport to a local stand-in API"""
+    _transports[provider] = transport
+    # the next get_http_client builds a client on the new transport
+    _clients.pop(provider, None)
+
+
+def start_http_clients() -> None:
+    for provider in PROVIDERS:
+        get_http_client(provider)
+
+
+async def close_http_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+
+def http_client_stats() -> dict:
+    return {provider: dict(stats) for provider, stats in _stats.items()}
@@ -2,19 +2,23 @@
 
 import datetime
 import json
+import os
 import secrets
-from typing import List
+from typing import AsyncIterator, List, Optional
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
 import asyncio
 import base64
 import hashlib
 
-import requests
 from integrations.integration_item import IntegrationItem
+from integrations.registry import LoadVariant, ProviderInterface
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, add_key_values_redis, consume_state_redis, get_and_delete_redis
+from serialization import pack, unpack
+from streaming import merge_async_iterators
+from upstream import upstream_request
+from watermarks import DELTA_ADDED, DELTA_CHANGED, DELTA_REMOVED, get_watermark, set_watermark
 
 # CLIENT_ID = 'XXX'
 # CLIENT_SECRET = 'XXX'
@@ -24,6 +28,15 @@ REDIRECT_URI = 'http://localhost:8000/integrations/airtable/oauth2callback'
 authorization_url = f'https://airtable.com/oauth2/v1/authorize?client_id={CLIENT_ID}&response_type=code&owner=user&redirect_uri=http%3A%2F%2Flocalhost%3A8000%2Fintegrations%2Fairtable%2Foauth2callback'
 encoded_client_id_secret = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
 
+# Upper bound on concurrent /meta/bases/{id}/tables requests per load
+TABLES_CONCURRENCY = int(os.environ.get('AIRTABLE_TABLES_CONCURRENCY', 8))
+# Record loads: tables read at once within a base, and bases read at once per load. Airtable allows 5 requests
+# per second per base, which upstream_request enforces with a bucket per base, so more tables per base only helps
+# while responses are slower than 1/5 s.
+RECORDS_TABLES_PER_BASE = int(os.environ.get('AIRTABLE_RECORDS_TABLES_PER_BASE', 3))
+RECORDS_BASES_CONCURRENCY = int(os.environ.get('AIRTABLE_RECORDS_BASES_CONCURRENCY', 4))
+RECORDS_PAGE_SIZE = 100  # the most /v0/{baseId}/{tableId} returns per request
+
 scope = 'data.records:read data.records:write data.recordComments:read data.recordComments:write schema.bases:read schema.bases:write'
 
 async def authorize_airtable(user_id, org_id):
@@ -40,9 +53,12 @@ async def authorize_airtable(user_id, org_id):
     code_challenge = base64.urlsafe_b64encode(m.digest()).decode('utf-8').replace('=', '')
 
     auth_url = f'{authorization_url}&state={encoded_state}&code_challenge={code_challenge}&code_challenge_method=S256&scope={scope}'
-    await asyncio.gather(
-        add_key_value_redis(f'airtable_state:{org_id}:{user_id}', json.dumps(state_data), expire=600),
-        add_key_value_redis(f'airtable_verifier:{org_id}:{user_id}', code_verifier, expire=600),
+    await add_key_values_redis(
+        {
+            f'airtable_state:{org_id}:{user_id}': pack(state_data),
+            f'airtable_verifier:{org_id}:{user_id}': code_verifier,
+        },
+        expire=600,
     )
 
     return auth_url
@@ -58,35 +74,34 @@ async def oauth2callback_airtable(request: Request):
     user_id = state_data.get('user_id')
     org_id = state_data.get('org_id')
 
-    saved_state, code_verifier = await asyncio.gather(
-        get_value_redis(f'airtable_state:{org_id}:{user_id}'),
-        get_value_redis(f'airtable_verifier:{org_id}:{user_id}'),
+    consumed = await consume_state_redis(
+        f'airtable_state:{org_id}:{user_id}',
+        original_state,
+        f'airtable_verifier:{org_id}:{user_id}',
     )
-
-    if not saved_state or original_state != json.loads(saved_state).get('state'):
+    if not consumed:
         raise HTTPException(status_code=400, detail='State does not match.')
+    _, code_verifier = consumed
 
-    async with httpx.AsyncClient() as client:
-        response, _, _ = await asyncio.gather(
-            client.post(
-                'https://airtable.com/oauth2/v1/token',
-                data={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI,
-                    'client_id': CLIENT_ID,
-                    'code_verifier': code_verifier.decode('utf-8'),
-                },
-                headers={
-                    'Authorization': f'Basic {encoded_client_id_secret}',
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                }
-            ),
-            delete_key_redis(f'airtable_state:{org_id}:{user_id}'),
-            delete_key_redis(f'airtable_verifier:{org_id}:{user_id}'),
-        )
+    response = await upstream_request(
+        'airtable',
+        None,
+        'POST',
+        'https://airtable.com/oauth2/v1/token',
+        data={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI,
+            'client_id': CLIENT_ID,
+            'code_verifier': code_verifier.decode('utf-8'),
+        },
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+    )
 
-    await add_key_value_redis(f'airtable_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    await add_key_value_redis(f'airtable_credentials:{org_id}:{user_id}', pack(response.json()), expire=600)
     
     close_window_script = """
     <html>
@@ -99,11 +114,10 @@ async def oauth2callback_airtable(request: Request):
 
 
 async def get_airtable_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'airtable_credentials:{org_id}:{user_id}')
+    credentials = await get_and_delete_redis(f'airtable_credentials:{org_id}:{user_id}')
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
-    credentials = json.loads(credentials)
-    await delete_key_redis(f'airtable_credentials:{org_id}:{user_id}')
+    credentials = unpack(credentials)
 
     return credentials
 
@@ -124,53 +138,203 @@ def create_integration_item_metadata_object(
     return integration_item_metadata
 
 
-def fetch_items(
-    access_token: str, url: str, aggregated_response: list, offset=None
-) -> dict:
-    """Fetching the list of bases"""
-    params = {'offset': offset} if offset is not None else {}
+async def fetch_items(access_token: str, url: str) -> AsyncIterator[list]:
+    """Fetching the list of bases, one page at a time"""
     headers = {'Authorization': f'Bearer {access_token}'}
-    response = requests.get(url, headers=headers, params=params)
+    offset = None
+    while True:
+        params = {'offset': offset} if offset is not None else {}
+        response = await upstream_request('airtable', access_token, 'GET', url, headers=headers, params=params)
+
+        response_json = response.json()
+        yield response_json.get('bases', [])
+        offset = response_json.get('offset', None)
+        if offset is None:
+            return
 
-    if response.status_code == 200:
-        results = response.json().get('bases', {})
-        offset = response.json().get('offset', None)
 
-        for item in results:
-            aggregated_response.append(item)
+async def fetch_table_schemas(
+    access_token: str, base_id: str, semaphore: Optional[asyncio.Semaphore] = None
+) -> List[dict]:
+    """Fetching the raw table schemas of a single base, within the semaphore when one is given"""
+    if semaphore is not None:
+        async with semaphore:
+            return await fetch_table_schemas(access_token, base_id)
+    # counted against the base like its records, the token's own limit is ten times higher
+    response = await upstream_request(
+        'airtable',
+        access_token,
+        'GET',
+        f'https://api.airtable.com/v0/meta/bases/{base_id}/tables',
+        headers={'Authorization': f'Bearer {access_token}'},
+        scope=base_id,
+    )
+    return response.json()['tables']
 
-        if offset is not None:
-            fetch_items(access_token, url, aggregated_response, offset)
-        else:
-            return
 
+async def fetch_tables(access_token: str, base: dict, semaphore: asyncio.Semaphore) -> List[IntegrationItem]:
+    """Fetching the tables of a single base"""
+    tables = await fetch_table_schemas(access_token, base.get('id'), semaphore)
+    return [
+        create_integration_item_metadata_object(
+            table,
+            'Table',
+            base.get('id', None),
+            base.get('name', None),
+        )
+        for table in tables
+    ]
 
-async def get_items_airtable(credentials) -> List[IntegrationItem]:
+
+async def stream_items_airtable(credentials) -> AsyncIterator[IntegrationItem]:
+    """Yields each page of bases, followed by their tables, as soon as the page is fetched"""
     credentials = json.loads(credentials)
+    access_token = credentials.get('access_token')
     url = 'https://api.airtable.com/v0/meta/bases'
-    list_of_integration_item_metadata = []
-    list_of_responses = []
 
-    fetch_items(credentials.get('access_token'), url, list_of_responses)
-    for response in list_of_responses:
-        list_of_integration_item_metadata.append(
-            create_integration_item_metadata_object(response, 'Base')
+    semaphore = asyncio.Semaphore(TABLES_CONCURRENCY)
+    async for bases in fetch_items(access_token, url):
+        list_of_tables = await asyncio.gather(
+            *(fetch_tables(access_token, base, semaphore) for base in bases)
         )
-        tables_response = requests.get(
-            f'https://api.airtable.com/v0/meta/bases/{response.get("id")}/tables',
-            headers={'Authorization': f'Bearer {credentials.get("access_token")}'},
-        )
-        if tables_response.status_code == 200:
-            tables_response = tables_response.json()
-            for table in tables_response['tables']:
-                list_of_integration_item_metadata.append(
-                    create_integration_item_metadata_object(
-                        table,
-                        'Table',
-                        response.get('id', None),
-                        response.get('name', None),
-                    )
-                )
-
-    print(f'list_of_integration_item_metadata: {list_of_integration_item_metadata}')
+        for base, tables in zip(bases, list_of_tables):
+            yield create_integration_item_metadata_object(base, 'Base')
+            for table in tables:
+                yield table
+
+
+async def get_items_airtable(credentials) -> List[IntegrationItem]:
+    list_of_integration_item_metadata = [item async for item in stream_items_airtable(credentials)]
+
+    print(f'Found {len(list_of_integration_item_metadata)} Airtable integration items')
     return list_of_integration_item_metadata
+
+
+def _primary_field_name(table: dict) -> Optional[str]:
+    for table_field in table.get('fields', []):
+        if table_field.get('id') == table.get('primaryFieldId'):
+            return table_field.get('name')
+    return None
+
+
+def create_record_item(record: dict, table: dict, name_field: Optional[str]) -> IntegrationItem:
+    name = record.get('fields', {}).get(name_field) if name_field is not None else None
+    return IntegrationItem(
+        id=record['id'] + '_Record',
+        name=record['id'] if name is None else str(name),
+        type='Record',
+        creation_time=record.get('createdTime'),
+        parent_id=table['id'] + '_Table',
+        parent_path_or_name=table.get('name'),
+    )
+
+
+async def fetch_records(
+    access_token: str, base_id: str, table: dict, fields: List[str], semaphore: asyncio.Semaphore
+) -> AsyncIterator[List[IntegrationItem]]:
+    """Fetching the records of a single table, one page at a time, with only the given fields returned"""
+    name_field = fields[0] if fields else None
+    headers = {'Authorization': f'Bearer {access_token}'}
+    url = f'https://api.airtable.com/v0/{base_id}/{table["id"]}'
+    offset = None
+    async with semaphore:
+        while True:
+            params = [('pageSize', RECORDS_PAGE_SIZE)] + [('fields[]', name) for name in fields]
+            if offset is not None:
+                params.append(('offset', offset))
+            # the bucket per base keeps every table of the base together under Airtable's 5 requests/s
+            response = await upstream_request('airtable', access_token, 'GET', url, headers=headers, params=params, scope=base_id)
+
+            response_json = response.json()
+            yield [create_record_item(record, table, name_field) for record in response_json.get('records', [])]
+            offset = response_json.get('offset', None)
+            if offset is None:
+                return
+
+
+async def stream_base_records(
+    access_token: str, base: dict, fields: Optional[List[str]], semaphore: asyncio.Semaphore
+) -> AsyncIterator[List[IntegrationItem]]:
+    """Yields a base and its tables, then their records a page at a time as the tables are read concurrently"""
+    async with semaphore:
+        # the semaphore of the bases already bounds this request
+        tables = await fetch_table_schemas(access_token, base['id'])
+        yield [create_integration_item_metadata_object(base, 'Base')] + [
+            create_integration_item_metadata_object(table, 'Table', base['id'], base.get('name')) for table in tables
+        ]
+
+        tables_semaphore = asyncio.Semaphore(RECORDS_TABLES_PER_BASE)
+        scans = []
+        for table in tables:
+            # without a projection only the primary field is fetched, it is all the record's item needs
+            primary = _primary_field_name(table)
+            projection = fields if fields else [primary] if primary is not None else []
+            scans.append(fetch_records(access_token, base['id'], table, projection, tables_semaphore))
+        if scans:
+            async for records in merge_async_iterators(scans):
+                yield records
+
+
+async def stream_records_airtable(credentials, fields: Optional[List[str]] = None) -> AsyncIterator[IntegrationItem]:
+    """Yields every base and table like stream_items_airtable, followed by the records of each table.
+
+    The first of fields names the records, the table's primary field when fields is empty. At most one page
+    of records per table is held in memory at any time, so tables of any size stream through.
+    """
+    credentials = json.loads(credentials)
+    access_token = credentials.get('access_token')
+    url = 'https://api.airtable.com/v0/meta/bases'
+
+    semaphore = asyncio.Semaphore(RECORDS_BASES_CONCURRENCY)
+    async for bases in fetch_items(access_token, url):
+        scans = [stream_base_records(access_token, base, fields, semaphore) for base in bases]
+        if not scans:
+            continue
+        async for items in merge_async_iterators(scans):
+            for item in items:
+                yield item
+
+
+async def stream_items_airtable_delta(credentials, user_id, org_id) -> AsyncIterator[IntegrationItem]:
+    """Yields the bases and tables added, changed or removed since the account's last incremental load.
+
+    The meta API has no modification times, so the watermark is a snapshot of every base/table seen last time.
+    """
+    watermark = await get_watermark('airtable', org_id, user_id)
+    previous = {} if watermark is None else json.loads(watermark)
+    current = {}
+
+    async for item in stream_items_airtable(credentials):
+        current[item.id] = [item.name, item.parent_id, item.parent_path_or_name]
+        known = previous.get(item.id)
+        if known is None:
+            item.delta = DELTA_ADDED
+            yield item
+        elif known != current[item.id]:
+            item.delta = DELTA_CHANGED
+            yield item
+
+    for item_id, (name, parent_id, parent_name) in previous.items():
+        if item_id not in current:
+            yield IntegrationItem(
+                id=item_id,
+                name=name,
+                type=item_id.rsplit('_', 1)[-1],
+                parent_id=parent_id,
+                parent_path_or_name=parent_name,
+                delta=DELTA_REMOVED,
+            )
+
+    await set_watermark('airtable', org_id, user_id, json.dumps(current))
+
+
+PROVIDER = ProviderInterface(
+    authorize=authorize_airtable,
+    oauth2callback=oauth2callback_airtable,
+    credentials=get_airtable_credentials,
+    load=get_items_airtable,
+    stream=stream_items_airtable,
+    stream_delta=stream_items_airtable_delta,
+    # records=true: every record of every table as well, always streamed live
+    variants={'records': LoadVariant('airtable_records', stream=stream_records_airtable, projection=True)},
+)
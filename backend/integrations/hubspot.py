@@ -1,14 +1,22 @@
 # hubspot.py
 
-from typing import List
+from typing import AsyncIterator, List, Optional
 from fastapi import Request, HTTPException
 import json
 from fastapi.responses import HTMLResponse
-import httpx
 import secrets
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, consume_state_redis, get_and_delete_redis
+from serialization import pack, unpack
 import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
 from integrations.integration_item import IntegrationItem
+from integrations.normalize import Const, Format, ItemMapping, Path
+from integrations.hubspot_token_manager import close_hubspot_token_refreshers, store_hubspot_token, with_managed_hubspot_token
+from integrations.registry import ProviderInterface
+from upstream import upstream_request
+from watermarks import DELTA_ADDED, DELTA_CHANGED, DELTA_REMOVED, get_watermark, set_watermark
 
 # If we wish to integrate any service or access its API then we have to register our app first and mention the app name,app description, and scopes(the permissions to access or edit certain information present in the user's account) and we also have to mention redirect URL--> this is the URL that the user will be redirected to once the OAuth is successful. If we do that the "HUBSPOT" developers console or any other service's developers console will give us two main things "CLIENT ID" & "CLIENT SECRET".
 
@@ -23,6 +31,23 @@ CLIENT_SECRET =  "59397392-6bb8-4f0c-b20e-b8534736dc5e"
 REDIRECT_URI = "http://localhost:8000/integrations/hubspot/oauth2callback"
 authorization_url= f"https://app-na2.hubspot.com/oauth/authorize?client_id={CLIENT_ID}&redirect_uri={REDIRECT_URI}&scope=crm.objects.contacts.write%20oauth%20crm.objects.contacts.read"
 
+# Export tuning for get_items_hubspot / stream_items_hubspot
+CONTACTS_URL = 'https://api.hubapi.com/crm/v3/objects/contacts'
+CONTACTS_PAGE_SIZE = 100  # the maximum page size hubspot accepts for both the list and the search endpoints
+CONTACT_PROPERTIES = ['firstname', 'lastname']  # only the properties CONTACT_MAPPING actually reads, email is the display name
+# when EXPORT_PARTITIONS > 1 the scan starts from that many createdate ranges which are fetched in parallel through the search API.
+# a range holding more than SEARCH_RESULT_LIMIT contacts is split in two until none does, so the ranges follow where the contacts actually are
+EXPORT_PARTITIONS = int(os.environ.get('HUBSPOT_EXPORT_PARTITIONS', 1))
+EXPORT_CONCURRENCY = int(os.environ.get('HUBSPOT_EXPORT_CONCURRENCY', 4))
+EXPORT_START = os.environ.get('HUBSPOT_EXPORT_START', '2006-01-01')  # no contact can be older than hubspot itself
+SEARCH_RESULT_LIMIT = 10000  # the search API refuses to page past this many results for a single query
+# Archived contacts can neither be searched nor filtered by archivedAt, so an incremental load reads at most this many
+# pages of the archive, carrying on where the previous load stopped. A removal shows up within one pass over the archive.
+DELTA_ARCHIVE_PAGES = int(os.environ.get('HUBSPOT_DELTA_ARCHIVE_PAGES', 20))
+# The search index trails contact updates by a few seconds, so an incremental load starts this far before the previous
+# one did. Contacts changed in the overlap are reported twice, which is harmless.
+DELTA_OVERLAP_MS = int(float(os.environ.get('HUBSPOT_DELTA_OVERLAP_SECONDS', 30)) * 1000)
+
 ######## the below encoded_client_id_secret #########
 
 
@@ -48,7 +73,7 @@ async def authorize_hubspot(user_id, org_id):
     encoded_state = json.dumps(state_data) # convert the state_data object into a string that can be embedded in the url
 
     #now its a good practice to store this state in our redis db temporarily till we get an authorisation code from the authorization server of hubspot. so once we are redirected back to a url along with code in that url then we can see whether our state which we passed  on(currently read from redis) is what was actually received in the redirect url too. if yes then 100% it is from hubspot. Thus we can trust the auth_code
-    await add_key_value_redis(f'hubspot_state:{org_id}:{user_id}', encoded_state, expire=600)
+    await add_key_value_redis(f'hubspot_state:{org_id}:{user_id}', pack(state_data), expire=600) #stored packed with msgpack (see serialization.py), the url still carries the json string
     
     #you can find this function inside redis_client(dont forget to import these from the file) where this is used to set key value pair in the redis db and it will expire in 10mins(600 seconds). So the key value pair would look something like: hubspot_state:TestOrg:TestUser   erjnefriFVns_9wjnsDFnDFclslwerlxftANX
 
@@ -91,51 +116,37 @@ async def oauth2callback_hubspot(request: Request): #this function will exchange
 
 
     #Once we capture the state now its time to check it with the state value that we have already stored in our redis database. 
-    # So 1st lets retrieve the state value from redis using the get value method.
-    saved_state = await get_value_redis(f'hubspot_state:{org_id}:{user_id}')
-
-    #now if the saved_state from is not there(which means our 10 mins barrier was over) or if the original_state that we extracted from our response url does not match the saved_state stored in redis then we again have to raise an HTTPException.
-    if not saved_state or original_state != json.loads(saved_state).get('state'): #we are doing json.loads() because data extracted from redis comes in the format of a string. so we have to convert it into json before comparing with the (original_state) which is also in the json format.
+    # consume_state_redis (inside redis_client.py) does the whole check inside redis in ONE round trip: it reads the saved state, compares its 'state' field with the original_state and, only if they match, deletes the key since we no longer need it.
+    #it returns nothing if the saved_state is not there(which means our 10 mins barrier was over) or if the original_state that we extracted from our response url does not match the saved_state stored in redis. then we again have to raise an HTTPException.
+    if not await consume_state_redis(f'hubspot_state:{org_id}:{user_id}', original_state):
         raise HTTPException(status_code=400, detail='State does not match.')
 
     #ONCE WE HAVE ENSURED THAT THE STATE IS SAME AS WHAT WE SENT. Its time to move on to the process of "EXCHANGING AUTHORIZATION CODE WITH ACCESS TOKEN."
 
-
-
-    #The 'async with' syntax tells Python to:
-    # Await the completion of the context manager's setup
-    # Execute the code block
-    # Await the completion of cleanup afterward 
-
-
-
-
-    async with httpx.AsyncClient() as client: #we are creating a new http client called as client. Using the 'with' keyword will close connections once the task of the client is done.
-        
-        #since the gather function has 2 operations inside both will return values but we are not going to use the return value of delete_key_redis. the only return thats useful for us is the response from the post request (for access token) 
-        response, _ = await asyncio.gather( 
-            #we have used asyncio.gather because we are concurrently performing two asynchronous tasks, one is posting a request to get access tokens for hubspot and the other one is a redis operation to delete the "hubspot_state" key which we no longer need because we have already verified that the response which we have received back is actually from Hubspot....based on the state information.
-            client.post(
-            'https://api.hubapi.com/oauth/v1/token',
-            data={
-                'grant_type': 'authorization_code',
-                'code': code,         # we are sending the authorisaiton code which we extracted req.query_params a while ago                    
-                'redirect_uri': REDIRECT_URI, 
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_SECRET,
-            }, 
-            headers={
-                'Content-Type': 'application/x-www-form-urlencoded',
-            }
-        ),  #the format of this post request is available in https://developers.hubspot.com/docs/guides/api/app-management/oauth-tokens
-         
-            delete_key_redis(f'hubspot_state:{org_id}:{user_id}'), #deleting the state information from redis as it is no longer necessary
-        )
+    response = await upstream_request( #every call to hubspot goes through upstream.py, which shares the rate limit with the other workers and retries 429s for us
+        'hubspot',
+        None, #no access token yet, the code exchange uses the app-wide rate limit bucket
+        'POST',
+        'https://api.hubapi.com/oauth/v1/token',
+        data={
+            'grant_type': 'authorization_code',
+            'code': code,         # we are sending the authorisaiton code which we extracted req.query_params a while ago                    
+            'redirect_uri': REDIRECT_URI, 
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET,
+        }, 
+        headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+    )  #the format of this post request is available in https://developers.hubspot.com/docs/guides/api/app-management/oauth-tokens
 
     #since we have recceived our response we not have to store it in our REDIS DB under the key name ("hubspot_credentials"). And this access token will expire in 600 seconds.
-    await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', pack(response.json()), expire=600)
+
+    #the token manager keeps its own long lived copy (with the refresh_token) and refreshes the access token in the background before its 30 minutes run out, so later loads never need the user to go through OAuth again (see hubspot_token_manager.py)
+    await store_hubspot_token(user_id, org_id, response.json())
     
-    #json.dumps converts json object into string format so that it can be stored in the redis DB
+    #pack (from serialization.py) converts the json object into compact msgpack bytes so that it can be stored in the redis DB
     
     close_window_script = """
     <html>
@@ -162,18 +173,18 @@ async def oauth2callback_hubspot(request: Request): #this function will exchange
 
 
 async def get_hubspot_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'hubspot_credentials:{org_id}:{user_id}')
+    credentials = await get_and_delete_redis(f'hubspot_credentials:{org_id}:{user_id}')
     #in the previous function, before closing the window we stored the credentials which includes access token & refresh token
     #no we are trying to fetch it from our redis database. only then using this access token we can access or edit the hubspot data of our user
+    #get_and_delete_redis reads the key and deletes it in the same round trip (GETDEL). since we have fetched it from the redis db we no longer have to store it in redis due to security reasons.
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
     
     #if not accessed with 600 seconds or 10 mins the credentials will no longer be there in redis since we have already declared this expiration time in the previous function while storing our credentials in redis db 
-    credentials = json.loads(credentials)
-    #but remember before storing into redis we converted into string format, so once we retrieve it, then also its gonna be in string format, so using json.loads() function we have to convert the string credentials into json format only then we can access the individual keys inside it(like access token, refresh token etc )
-    await delete_key_redis(f'hubspot_credentials:{org_id}:{user_id}')
+    credentials = unpack(credentials)
+    #but remember before storing into redis we packed it into bytes, so once we retrieve it, then also its gonna be in bytes, so using unpack() we have to convert the bytes back into json format only then we can access the individual keys inside it(like access token, refresh token etc )
 
-    #since we have fetched it from the redis db and stored in a variable we no longer have to store it in redis due to security reasons. so lets delete the hubspot_credentials key and return the credentials to the "handleWindowClosed" function.
+    #return the credentials to the "handleWindowClosed" function.
     return credentials
 
 
@@ -185,7 +196,31 @@ async def get_hubspot_credentials(user_id, org_id):
 #PLEASE REFER TO get_hubspot_items function before you look into the below integration item_function 
 #################################################################################################
 
-async def create_integration_item_metadata_object(response_json: dict, item_type: str) -> IntegrationItem:
+def _contact_name(response_json: dict) -> str:
+    # For contacts, use first and last name to create a display name, falling back to the contact id
+    properties = response_json.get('properties') or {}
+    first_name, last_name = properties.get('firstname'), properties.get('lastname')
+    if first_name and last_name:
+        return f"{first_name} {last_name}".strip()
+    return (first_name or last_name or '').strip() or f"Contact {response_json.get('id', '')}"
+
+
+# The declarative version of the old per-contact function: normalize.py compiles it once, and a whole page of
+# contacts is then turned into integration items in one pass (no await per contact, this is pure CPU work)
+CONTACT_MAPPING = ItemMapping(
+    'hubspot_contact',
+    id=Format('{}_Contact', Path('id', default='')),  # Create a unique ID combining HubSpot ID and item type
+    name=_contact_name,
+    email=_contact_name,  # kept as the display name, like the /load results always had
+    type=Const('Contact'),
+    creation_time=Path('createdAt'),  # Store creation timestamp if available
+    last_modified_time=Path('updatedAt'),  # Store update timestamp if available
+)
+
+_mappings = {'Contact': CONTACT_MAPPING}
+
+
+def create_integration_item_metadata_object(response_json: dict, item_type: str) -> IntegrationItem:
     
     """Creates an integration metadata object from a HubSpot response
     
@@ -196,40 +231,22 @@ async def create_integration_item_metadata_object(response_json: dict, item_type
     Returns:
         A standardized IntegrationItem object
     """
-    # Extract the unique ID from the response
-    item_id = str(response_json.get('id', ''))
-    
-    # Process different item types accordingly
-    if item_type == 'Contact':
-        # For contacts, use first and last name to create a display name
-        properties = response_json.get('properties', {})
-        first_name = properties.get('firstname', '')
-        last_name = properties.get('lastname', '')
-        email = properties.get('email', '')
-
-        
-        # Construct a name using available information
-        if first_name or last_name:
-            name = f"{first_name} {last_name}".strip()
-        else:
-            name = f"Contact {item_id}"
-
-    else:
+    mapping = _mappings.get(item_type)
+    if mapping is None:
         # Generic handling for other item types
-        name = response_json.get('properties', {}).get('name', f"{item_type} {item_id}")
-    
-    # Create and return the standardized IntegrationItem
-    integration_item_metadata = IntegrationItem(
-        id=f"{item_id}_{item_type}",  # Create a unique ID combining HubSpot ID and item type
-        name=name,  # Use the constructed name
-        email=name,  
-        type=item_type,  # Store the item type
-        creation_time=response_json.get('createdAt'),  # Store creation timestamp if available
-        last_modified_time=response_json.get('updatedAt'),  # Store update timestamp if available
-        # Additional fields could be included here as needed
-    )
-    
-    return integration_item_metadata
+        def name(response_json):
+            return (response_json.get('properties') or {}).get('name', f"{item_type} {response_json.get('id', '')}")
+
+        mapping = _mappings[item_type] = ItemMapping(
+            f'hubspot_{item_type.lower()}',
+            id=Format('{}_' + item_type, Path('id', default='')),
+            name=name,
+            email=name,
+            type=Const(item_type),
+            creation_time=Path('createdAt'),
+            last_modified_time=Path('updatedAt'),
+        )
+    return mapping(response_json)
     
 
 
@@ -240,25 +257,21 @@ async def create_integration_item_metadata_object(response_json: dict, item_type
 
 
 
-# the get_items_hubspot needs a helper function to perform its job----> 
-# 1. create_integration_item_metadata_object and 
+# the stream_items_hubspot needs a helper to perform its job----> 
+# 1. CONTACT_MAPPING and 
 
-async def get_items_hubspot(credentials) -> List[IntegrationItem]: #this is to indicate that we are going to return a list of integrationitems
+async def stream_items_hubspot(credentials, partitions=None) -> AsyncIterator[IntegrationItem]: #this is an async generator: it hands out each integration item as soon as its page arrives instead of building up the whole list
 
     #what are integration items though?
-    #its not just about fetching a contact or an item and displaying it. We have to standardise the API response according to a format that our app needs (aka integration item) and then display it to our app users. And for that each item will be processed using the function "create_integration_item_metadata_object". and only after that we will store it in the "list_of_integration_item_metadata"
+    #its not just about fetching a contact or an item and displaying it. We have to standardise the API response according to a format that our app needs (aka integration item) and then display it to our app users. And for that each page of items will be processed using "CONTACT_MAPPING". and only after that we yield it to whoever is consuming the stream (get_items_hubspot below, or the streaming /load response)
     
-    """Aggregates metadata relevant for a HubSpot integration"""
+    """Yields metadata relevant for a HubSpot integration page by page"""
 
     credentials = json.loads(credentials)
     access_token = credentials.get('access_token')
     # if you remember we passed the credentials from our data-form.js file in the string format. but now we have to extract 'access_token' from that credential. so we have to convert that string into json using json.loads(). 
     #onces thats done then we can use the get function on credentials to get hold of the access token.
 
-
-    # List to store all integration items
-    list_of_integration_item_metadata = []
-    
     
     #########################################################################################################################
 
@@ -270,7 +283,7 @@ async def get_items_hubspot(credentials) -> List[IntegrationItem]: #this is to i
 
     #########################################################################################################################
 
-    contacts_url = 'https://api.hubapi.com/crm/v3/objects/contacts'
+    contacts_url = CONTACTS_URL
 
     #The above url to retrieve contacts in bacthes is in the docs: "https://developers.hubspot.com/docs/guides/api/crm/objects/contacts"
 
@@ -279,79 +292,339 @@ async def get_items_hubspot(credentials) -> List[IntegrationItem]: #this is to i
         'Content-Type': 'application/json',
     }
     
-    # Limit is set to 10 contacts per request    
+    if partitions is None:
+        partitions = EXPORT_PARTITIONS
+    if partitions > 1:
+        # partitioned export: several createdate ranges are scanned at the same time through the search API (see stream_contacts_partitioned below)
+        async for contact_item in stream_contacts_partitioned(access_token, headers, partitions):
+            yield contact_item
+        return
+
+    # Ask for the biggest page hubspot allows and only the properties we need, so every round trip carries as many contacts as possible
     params = {
-        'limit': 10,  # this number can be changed
-     
+        'limit': CONTACTS_PAGE_SIZE,
+        'properties': ','.join(CONTACT_PROPERTIES),
     }
     #to see the list of parameters that you can play with visit: https://developers.hubspot.com/docs/reference/api/crm/objects/contacts#get-%2Fcrm%2Fv3%2Fobjects%2Fcontacts
 
-    # Create an HTTP client that will be reused for all requests. orelse for every single page request you will have to establish a new connectio(3-way handshake) which will be resource and time intensive. thats why we use httpx.AsyncClient for connection pooling. Connect once and carry out multiple requests instead of new connection every time.
-    async with httpx.AsyncClient() as client:
-        has_more = True
-        # Continue fetching data as long as there are more results available
-        while has_more:
-            # Make the API request to HubSpot to fetch contacts
-            response = await client.get(contacts_url, headers=headers, params=params)
-            # Check if the request was successful (HTTP 200 OK status)
-            if response.status_code == 200:
-                # Parse the JSON response
-                response_json = response.json()
-                # Extract the list of contacts from the response. always use response.json() to extract the response so that we can access the key-value pairs inside the response
-
-                #to see how sample response looks like visit: https://developers.hubspot.com/docs/reference/api/crm/objects/contacts#get-%2Fcrm%2Fv3%2Fobjects%2Fcontacts
-
-                #   {
-                #   "paging": {
-                #     "next": {
-                #       "link": "?after=NTI1Cg%3D%3D",
-                #       "after": "NTI1Cg%3D%3D"
-                #     }
-                #   },
-                #   "results": []
-                
-                #response from hubspot has 2 componenets, 1. RESULTS---> contains contact info  2. PAGING---> whether there is a next page
+    # Every request goes through upstream_request (see upstream.py). It borrows the process-wide pooled HTTP client, waits for a token from the per-account rate limit that all workers share, retries 429s and server errors with backoff, and raises instead of returning a failed response, so we never hand back a silently truncated contact list.
+    has_more = True
+    # Continue fetching data as long as there are more results available
+    while has_more:
+        # Make the API request to HubSpot to fetch contacts
+        response = await upstream_request('hubspot', access_token, 'GET', contacts_url, headers=headers, params=params)
+        # Parse the JSON response
+        response_json = response.json()
+        # Extract the list of contacts from the response. always use response.json() to extract the response so that we can access the key-value pairs inside the response
 
-                contacts = response_json.get('results', [])
-                # Extract pagination information
-                paging_info = response_json.get('paging', {})
-
-
-                # Process each contact and transform it to our standard format
-                for contact in contacts:
-                    # Convert each contact to our IntegrationItem format
-                    contact_item = await create_integration_item_metadata_object(contact, 'Contact') #you can take a look at this function above the current function which we are working on 
-
-
-                    # Add the processed contact to our list
-                    list_of_integration_item_metadata.append(contact_item)
-                
-                # Check if there's a next page of results
-                if 'next' in paging_info:
-                    # Get the cursor for the next page
-                    after = paging_info['next'].get('after')
-                    # It’s like saying, “Hey, here’s the special code (after) that lets you grab the next set of contacts.”
-
-
-                    if after:
-                    # "Hey, I’m ready for the next batch of contacts. Here’s the special code you gave me (the cursor)."
-                    # This ensures that, when you make the next request, HubSpot knows to start where the last set of contacts left off, rather than starting from the beginning again.
-                        params['after'] = after 
-                    else:
-                        # No "after" cursor means no more pages
-                        has_more = False
-                else:
-                    # No "next" in paging_info means no more pages
-                    has_more = False
-
-                
+        #to see how sample response looks like visit: https://developers.hubspot.com/docs/reference/api/crm/objects/contacts#get-%2Fcrm%2Fv3%2Fobjects%2Fcontacts
+
+        #   {
+        #   "paging": {
+        #     "next": {
+        #       "link": "?after=NTI1Cg%3D%3D",
+        #       "after": "NTI1Cg%3D%3D"
+        #     }
+        #   },
+        #   "results": []
+
+        #response from hubspot has 2 componenets, 1. RESULTS---> contains contact info  2. PAGING---> whether there is a next page
+
+        contacts = response_json.get('results', [])
+        # Extract pagination information
+        paging_info = response_json.get('paging', {})
+
+
+        # Transform the whole page of contacts to our standard format in one pass
+        for contact_item in CONTACT_MAPPING.map_page(contacts): #you can take a look at CONTACT_MAPPING above the current function which we are working on 
+
+
+            # Hand the processed contact to the consumer right away
+            yield contact_item
+
+        # Check if there's a next page of results
+        if 'next' in paging_info:
+            # Get the cursor for the next page
+            after = paging_info['next'].get('after')
+            # It’s like saying, “Hey, here’s the special code (after) that lets you grab the next set of contacts.”
+
+
+            if after:
+            # "Hey, I’m ready for the next batch of contacts. Here’s the special code you gave me (the cursor)."
+            # This ensures that, when you make the next request, HubSpot knows to start where the last set of contacts left off, rather than starting from the beginning again.
+                params['after'] = after 
             else:
-                # If the API request failed, log the error and break the loop
-                print(f"Failed to fetch contacts: {response.status_code} - {response.text}")
-                break
+                # No "after" cursor means no more pages
+                has_more = False
+        else:
+            # No "next" in paging_info means no more pages
+            has_more = False
+
+
+def _createdate_partitions(partitions: int) -> List[tuple]:
+    """Splits [EXPORT_START, now] into equal createdate ranges, in epoch milliseconds. These are only where the
+    scan starts: stream_contacts_partitioned splits the crowded ones further."""
+    start = int(datetime.fromisoformat(EXPORT_START).replace(tzinfo=timezone.utc).timestamp() * 1000)
+    end = int((datetime.now(timezone.utc) + timedelta(days=1)).timestamp() * 1000)
+    step = -(-(end - start) // partitions)
+    return [(lower, min(lower + step, end)) for lower in range(start, end, step)]
+
+
+async def search_contacts_page(
+    access_token: str, headers: dict, lower: int, upper: int, after_id: int, semaphore: asyncio.Semaphore
+) -> dict:
+    """One page of the contacts whose createdate falls in [lower, upper) and whose id is above after_id, in id order.
+
+    Every page is a new query starting after the last id seen rather than a paging cursor, so a range never
+    runs into the 10,000 results the search API returns per query, however many contacts share a createdate.
+    """
+    body = {
+        'filterGroups': [{
+            'filters': [
+                {'propertyName': 'createdate', 'operator': 'GTE', 'value': str(lower)},
+                {'propertyName': 'createdate', 'operator': 'LT', 'value': str(upper)},
+                {'propertyName': 'hs_object_id', 'operator': 'GT', 'value': str(after_id)},
+            ],
+        }],
+        'sorts': [{'propertyName': 'hs_object_id', 'direction': 'ASCENDING'}],
+        'properties': CONTACT_PROPERTIES,
+        'limit': CONTACTS_PAGE_SIZE,
+    }
+    async with semaphore:  # caps how many search requests are in flight across all ranges
+        response = await upstream_request(
+            'hubspot', access_token, 'POST', f'{CONTACTS_URL}/search', idempotent=True, scope='search', headers=headers, json=body
+        )
+    return response.json()
+
+
+async def stream_contacts_partitioned(access_token: str, headers: dict, partitions: int) -> AsyncIterator[IntegrationItem]:
+    """Scans createdate ranges in parallel and yields each contact once.
+
+    The first page of a range reports how many contacts it holds: a range over SEARCH_RESULT_LIMIT is split in two
+    and both halves are scanned instead, so a portal whose contacts were almost all created recently still gets
+    spread over many ranges rather than leaving one range to do all the work.
+    """
+    semaphore = asyncio.Semaphore(EXPORT_CONCURRENCY)
+    pages = asyncio.Queue()
+    tasks = set()
+
+    async def scan(lower: int, upper: int) -> None:
+        try:
+            after_id = 0
+            while True:
+                response_json = await search_contacts_page(access_token, headers, lower, upper, after_id, semaphore)
+                if not after_id and response_json.get('total', 0) > SEARCH_RESULT_LIMIT and upper - lower > 1:
+                    middle = (lower + upper) // 2
+                    start(lower, middle)
+                    start(middle, upper)
+                    break
+                contacts = response_json.get('results', [])
+                await pages.put((contacts, None))
+                if not contacts or not response_json.get('paging', {}).get('next'):
+                    break
+                after_id = int(contacts[-1]['id'])
+        except Exception as e:
+            await pages.put((None, e))
+        else:
+            await pages.put((None, None))
+
+    def start(lower: int, upper: int) -> None:
+        tasks.add(asyncio.create_task(scan(lower, upper)))
+
+    for lower, upper in _createdate_partitions(partitions):
+        start(lower, upper)
+    seen_ids = set()  # a contact created while the export runs could otherwise show up twice
+    try:
+        finished = 0
+        while finished < len(tasks):
+            contacts, error = await pages.get()
+            if error is not None:
+                raise error
+            if contacts is None:
+                finished += 1  # a range split in two finishes after starting its halves, so len(tasks) is already bigger
+                continue
+            fresh = []
+            for contact in contacts:
+                if contact.get('id') not in seen_ids:
+                    seen_ids.add(contact.get('id'))
+                    fresh.append(contact)
+            for contact_item in CONTACT_MAPPING.map_page(fresh):
+                yield contact_item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _to_epoch_ms(timestamp: str) -> int:
+    return int(datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+async def _search_contacts(access_token: str, headers: dict, body: dict) -> dict:
+    # a failed page raises, so a half read delta never moves the watermark forward
+    response = await upstream_request(
+        'hubspot', access_token, 'POST', f'{CONTACTS_URL}/search', idempotent=True, scope='search', headers=headers, json=body
+    )
+    return response.json()
+
+
+async def search_contacts_modified_at(access_token: str, headers: dict, modified_ms: int) -> AsyncIterator[list]:
+    """Pages through the contacts last modified in exactly that millisecond, in id order"""
+    after_id = 0
+    while True:
+        response_json = await _search_contacts(access_token, headers, {
+            'filterGroups': [{
+                'filters': [
+                    {'propertyName': 'lastmodifieddate', 'operator': 'EQ', 'value': str(modified_ms)},
+                    {'propertyName': 'hs_object_id', 'operator': 'GT', 'value': str(after_id)},
+                ],
+            }],
+            'sorts': [{'propertyName': 'hs_object_id', 'direction': 'ASCENDING'}],
+            'properties': CONTACT_PROPERTIES + ['createdate', 'lastmodifieddate'],
+            'limit': CONTACTS_PAGE_SIZE,
+        })
+        contacts = response_json.get('results', [])
+        yield contacts
+        if not contacts or not response_json.get('paging', {}).get('next'):
+            return
+        after_id = int(contacts[-1]['id'])
+
+
+async def search_contacts_modified_since(access_token: str, headers: dict, since_ms: int) -> AsyncIterator[list]:
+    """Pages through the contacts whose lastmodifieddate is newer than since_ms, oldest change first"""
+    body = {
+        'filterGroups': [{
+            'filters': [{'propertyName': 'lastmodifieddate', 'operator': 'GT', 'value': str(since_ms)}],
+        }],
+        'sorts': [{'propertyName': 'lastmodifieddate', 'direction': 'ASCENDING'}],
+        'properties': CONTACT_PROPERTIES + ['createdate', 'lastmodifieddate'],
+        'limit': CONTACTS_PAGE_SIZE,
+    }
+    while True:
+        response_json = await _search_contacts(access_token, headers, body)
+        contacts = response_json.get('results', [])
+        yield contacts
+        after = response_json.get('paging', {}).get('next', {}).get('after')
+        if not after:
+            return
+        if int(after) + CONTACTS_PAGE_SIZE > SEARCH_RESULT_LIMIT and contacts:
+            # restart the query past the newest change we have seen instead of paging past the cap. The contacts
+            # sharing that millisecond are read by id first: after a bulk import or a workflow there can be more of
+            # them than one query returns, and restarting at that millisecond would return the same ones forever.
+            # The ones already seen come back again and are skipped by the caller.
+            last_modified_ms = _to_epoch_ms(contacts[-1].get('properties', {}).get('lastmodifieddate'))
+            async for contacts in search_contacts_modified_at(access_token, headers, last_modified_ms):
+                yield contacts
+            body['filterGroups'][0]['filters'][0] = {
+                'propertyName': 'lastmodifieddate', 'operator': 'GT', 'value': str(last_modified_ms),
+            }
+            body.pop('after', None)
+        else:
+            body['after'] = after
+
+
+async def fetch_archived_contacts(
+    access_token: str, headers: dict, after: Optional[str] = None, max_pages: Optional[int] = None
+) -> AsyncIterator[tuple]:
+    """Pages through the archived (deleted) contacts of the portal from the cursor after, at most max_pages pages.
+
+    Yields (contacts, next_after), next_after being None once the end of the archive is reached.
+    """
+    params = {
+        'limit': CONTACTS_PAGE_SIZE,
+        'properties': ','.join(CONTACT_PROPERTIES),
+        'archived': 'true',
+    }
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        if after:
+            params['after'] = after
+        response = await upstream_request('hubspot', access_token, 'GET', CONTACTS_URL, headers=headers, params=params)
+        pages += 1
+
+        response_json = response.json()
+        after = response_json.get('paging', {}).get('next', {}).get('after')
+        yield response_json.get('results', []), after
+        if not after:
+            return
+
+
+async def stream_items_hubspot_delta(credentials, user_id, org_id) -> AsyncIterator[IntegrationItem]:
+    """Yields only the contacts added, changed or removed since the account's last incremental load.
+
+    The watermark is the time the previous sync started, less DELTA_OVERLAP_MS, so it only moves forward once the
+    whole delta was read.
+    """
+    access_token = json.loads(credentials).get('access_token')
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json',
+    }
+    sync_started_ms = int(time.time() * 1000)
+    watermark = await get_watermark('hubspot', org_id, user_id)
+    archive_watermark = await get_watermark('hubspot_archive', org_id, user_id)
+
+    if watermark is None:
+        # first incremental load of this account: everything is new
+        async for contact_item in stream_items_hubspot(credentials):
+            contact_item.delta = DELTA_ADDED
+            yield contact_item
+        # whatever is archived by now was simply not listed, the archive only needs reading from here on
+        archive = {'after': None, 'pass_started': sync_started_ms}
+    else:
+        since_ms = int(watermark)
+        seen_ids = set()
+        async for contacts in search_contacts_modified_since(access_token, headers, since_ms):
+            fresh = []
+            for contact in contacts:
+                if contact.get('id') not in seen_ids:
+                    seen_ids.add(contact.get('id'))
+                    fresh.append(contact)
+            for contact, contact_item in zip(fresh, CONTACT_MAPPING.map_page(fresh)):
+                created = contact.get('properties', {}).get('createdate')
+                contact_item.delta = DELTA_ADDED if created and _to_epoch_ms(created) > since_ms else DELTA_CHANGED
+                yield contact_item
+
+        # the archive is read in slices of DELTA_ARCHIVE_PAGES pages, one slice per load. A contact archived after the
+        # previous pass over it started is either still ahead in the current pass or in the next one, so reporting
+        # those archived since then reports every removal at least once (a second time is harmless).
+        archive = json.loads(archive_watermark) if archive_watermark else {'after': None, 'pass_started': since_ms}
+        if archive['after'] is None:
+            archive = {'after': None, 'pass_started': sync_started_ms, 'previous_pass_started': archive['pass_started']}
+        removed_since_ms = archive['previous_pass_started']
+        async for contacts, after in fetch_archived_contacts(access_token, headers, archive['after'], DELTA_ARCHIVE_PAGES):
+            archive['after'] = after
+            removed = [
+                contact for contact in contacts
+                if contact.get('archivedAt') and _to_epoch_ms(contact['archivedAt']) > removed_since_ms
+            ]
+            for contact_item in CONTACT_MAPPING.map_page(removed, delta=DELTA_REMOVED):
+                yield contact_item
+
+    await set_watermark('hubspot_archive', org_id, user_id, json.dumps(archive))
+    await set_watermark('hubspot', org_id, user_id, str(sync_started_ms - DELTA_OVERLAP_MS))
+
+
+async def get_items_hubspot(credentials) -> List[IntegrationItem]: #this is to indicate that we are going to return a list of integrationitems
+    """Aggregates metadata relevant for a HubSpot integration"""
+
+    # List to store all integration items
+    list_of_integration_item_metadata = [item async for item in stream_items_hubspot(credentials)]
+
     # Log the total number of items found
     print(f"Found {len(list_of_integration_item_metadata)} HubSpot integration items")
 
     # Return the list of standardized integration items
     return list_of_integration_item_metadata
 
+
+# this is everything main.py needs from this file: it builds the /integrations/hubspot/authorize, /oauth2callback, /credentials and /load routes out of it
+PROVIDER = ProviderInterface(
+    authorize=authorize_hubspot, # "CONNECT TO HUBSPOT" was clicked
+    oauth2callback=oauth2callback_hubspot, # hubspot redirects here once the user allowed access
+    credentials=get_hubspot_credentials, # handleWindowClosed in the frontend asks for the credentials
+    load=get_items_hubspot, # data-form.js loads the contacts
+    stream=stream_items_hubspot,
+    stream_delta=stream_items_hubspot_delta,
+    prepare_credentials=with_managed_hubspot_token, # when we know the account, load with the token the token manager keeps fresh instead of the one the browser holds
+    close=close_hubspot_token_refreshers,
+)
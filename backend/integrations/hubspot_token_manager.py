@@ -0,0 +1,215 @@
+# hubspot_token_manager.py
+
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+from fastapi import HTTPException
+
+from redis_client import (
+    add_key_value_if_absent_redis,
+    add_key_value_redis,
+    delete_key_if_value_redis,
+    delete_key_redis,
+    get_value_redis,
+)
+from serialization import pack, unpack
+from upstream import UpstreamRejected, upstream_request
+
+# Access tokens are refreshed this many seconds before they expire, so loads never wait on a refresh
+REFRESH_MARGIN = int(os.environ.get('HUBSPOT_TOKEN_REFRESH_MARGIN', 300))
+# How long one worker may hold the refresh lock before another one is allowed to try
+REFRESH_LOCK_TTL = 30
+# An account not loaded for this many seconds stops being refreshed in the background, and its token is dropped
+# once the same time has passed again. The next load after that needs the user to connect HubSpot again.
+TOKEN_IDLE_TTL = int(os.environ.get('HUBSPOT_TOKEN_IDLE_TTL', 30 * 24 * 3600))
+# Hashes of the tokens handed to the browser that are still accepted as proof the credentials belong to the account
+OWNER_HASHES = 16
+
+_inflight = {}
+_timers = {}
+
+
+def _token_key(user_id, org_id):
+    return f'hubspot_token:{org_id}:{user_id}'
+
+
+def _lock_key(user_id, org_id):
+    return f'hubspot_token_lock:{org_id}:{user_id}'
+
+
+def _used_key(user_id, org_id):
+    return f'hubspot_token_used:{org_id}:{user_id}'
+
+
+def _hash(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+async def _load_token(user_id, org_id) -> Optional[dict]:
+    token = await get_value_redis(_token_key(user_id, org_id))
+    return None if token is None else unpack(token)
+
+
+async def store_hubspot_token(user_id, org_id, token_response: dict, owners=None) -> dict:
+    """Keeps the token response from /oauth/v1/token and schedules its next refresh.
+
+    owners are the hashes of the tokens issued to the account before, the browser may still hold any of them.
+    """
+    token = {
+        'access_token': token_response['access_token'],
+        'refresh_token': token_response['refresh_token'],
+        'expires_at': time.time() + int(token_response.get('expires_in', 1800)),
+        'owners': (list(owners or []) + [_hash(token_response['access_token']), _hash(token_response['refresh_token'])])[-OWNER_HASHES:],
+    }
+    await add_key_value_redis(_token_key(user_id, org_id), pack(token), expire=2 * TOKEN_IDLE_TTL)
+    await add_key_value_redis(_used_key(user_id, org_id), 1, expire=TOKEN_IDLE_TTL)
+    _schedule_refresh(user_id, org_id, token['expires_at'])
+    return token
+
+
+async def forget_hubspot_token(user_id, org_id) -> None:
+    """Drops the account's token and stops refreshing it"""
+    timer = _timers.pop((org_id, user_id), None)
+    if timer is not None and timer is not asyncio.current_task():
+        timer.cancel()
+    await delete_key_redis(_token_key(user_id, org_id))
+    await delete_key_redis(_used_key(user_id, org_id))
+
+
+def _schedule_refresh(user_id, org_id, expires_at):
+    timer = _timers.pop((org_id, user_id), None)
+    if timer is not None:
+        timer.cancel()
+    _timers[(org_id, user_id)] = asyncio.create_task(_refresh_later(user_id, org_id, expires_at))
+
+
+async def _refresh_later(user_id, org_id, expires_at):
+    await asyncio.sleep(max(0, expires_at - REFRESH_MARGIN - time.time()))
+    _timers.pop((org_id, user_id), None)
+    # idle accounts are left to expire, a load that comes back for one refreshes it on demand
+    if await get_value_redis(_used_key(user_id, org_id)) is not None:
+        _start_refresh(user_id, org_id)
+
+
+def _revoked(error: UpstreamRejected) -> bool:
+    # invalid_grant (BAD_REFRESH_TOKEN in HubSpot's own words): the app was uninstalled or the token revoked,
+    # no retry can succeed
+    return error.upstream_status in (400, 401) and (
+        'invalid_grant' in error.upstream_body or 'BAD_REFRESH_TOKEN' in error.upstream_body
+    )
+
+
+async def _refresh(user_id, org_id) -> dict:
+    from integrations.hubspot import CLIENT_ID, CLIENT_SECRET
+
+    current = await _load_token(user_id, org_id)
+    if current is None:
+        raise HTTPException(status_code=400, detail='No credentials found.')
+
+    lock_owner = uuid.uuid4().hex
+    if not await add_key_value_if_absent_redis(_lock_key(user_id, org_id), lock_owner, expire=REFRESH_LOCK_TTL):
+        # another worker is refreshing, wait for the token it writes instead of spending a second refresh
+        deadline = time.time() + REFRESH_LOCK_TTL
+        while time.time() < deadline:
+            await asyncio.sleep(0.2)
+            token = await _load_token(user_id, org_id)
+            if token is None:
+                raise HTTPException(status_code=401, detail='HubSpot access was revoked, connect HubSpot again.')
+            if token['expires_at'] != current['expires_at']:
+                return token
+        raise HTTPException(status_code=503, detail='Timed out waiting for the HubSpot token refresh.')
+
+    try:
+        try:
+            response = await upstream_request(
+                'hubspot',
+                None,
+                'POST',
+                'https://api.hubapi.com/oauth/v1/token',
+                data={
+                    'grant_type': 'refresh_token',
+                    'client_id': CLIENT_ID,
+                    'client_secret': CLIENT_SECRET,
+                    'refresh_token': current['refresh_token'],
+                },
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            )
+        except UpstreamRejected as e:
+            if not _revoked(e):
+                raise  # rate limited or any other refusal, the refresh token is still good for the next try
+            await forget_hubspot_token(user_id, org_id)
+            raise HTTPException(status_code=401, detail='HubSpot access was revoked, connect HubSpot again.')
+        return await store_hubspot_token(user_id, org_id, response.json(), current.get('owners'))
+    finally:
+        # the lock may have expired during a slow refresh and been taken by another worker, that one is left alone
+        await delete_key_if_value_redis(_lock_key(user_id, org_id), lock_owner)
+
+
+def _start_refresh(user_id, org_id) -> asyncio.Task:
+    # single-flight: every caller in this worker joins the refresh that is already running
+    task = _inflight.get((org_id, user_id))
+    if task is None:
+        task = _inflight[(org_id, user_id)] = asyncio.create_task(_refresh(user_id, org_id))
+        task.add_done_callback(lambda done: _refresh_done(user_id, org_id, done))
+    return task
+
+
+def _refresh_done(user_id, org_id, task: asyncio.Task):
+    _inflight.pop((org_id, user_id), None)
+    if not task.cancelled() and task.exception() is not None:
+        print(f'Refresh of the hubspot token for {org_id}:{user_id} failed: {task.exception()!r}')
+
+
+async def refresh_hubspot_token(user_id, org_id) -> dict:
+    """Refreshes the account's token, concurrent callers in this worker share a single refresh"""
+    return await asyncio.shield(_start_refresh(user_id, org_id))
+
+
+async def get_hubspot_access_token(user_id, org_id) -> str:
+    """Returns a valid access token, only blocking on a refresh when the stored one has already expired"""
+    token = await _load_token(user_id, org_id)
+    if token is None:
+        raise HTTPException(status_code=400, detail='No credentials found.')
+    await add_key_value_redis(_used_key(user_id, org_id), 1, expire=TOKEN_IDLE_TTL)
+
+    remaining = token['expires_at'] - time.time()
+    if remaining <= 0:
+        token = await refresh_hubspot_token(user_id, org_id)
+    elif remaining < REFRESH_MARGIN:
+        # about to expire (e.g. the worker that scheduled the refresh restarted): refresh in the background, this token still works
+        _start_refresh(user_id, org_id)
+    return token['access_token']
+
+
+def _owns(credentials: dict, token: dict) -> bool:
+    # the browser proves the account is its own with a token HubSpot issued to that account
+    presented = [_hash(credentials[name]) for name in ('access_token', 'refresh_token') if isinstance(credentials.get(name), str)]
+    return any(hmac.compare_digest(hashed, owner) for hashed in presented for owner in token.get('owners', ()))
+
+
+async def with_managed_hubspot_token(credentials: str, user_id, org_id) -> str:
+    """Swaps the access token in the credentials string for the managed one, when the account has one and the
+    credentials were issued to it"""
+    if not user_id or not org_id:
+        return credentials
+    token = await _load_token(user_id, org_id)
+    if token is None:
+        return credentials
+    credentials = json.loads(credentials)
+    if not _owns(credentials, token):
+        raise HTTPException(status_code=401, detail='The credentials do not belong to this HubSpot account.')
+    credentials['access_token'] = await get_hubspot_access_token(user_id, org_id)
+    return json.dumps(credentials)
+
+
+async def close_hubspot_token_refreshers() -> None:
+    for task in list(_timers.values()) + list(_inflight.values()):
+        task.cancel()
+    _timers.clear()
+    _inflight.clear()
@@ -1,7 +1,28 @@
 from datetime import datetime
-from typing import Optional, List
+from typing import Iterable, Iterator, List, Optional, Union
+
+from serialization import dumps
 
 class IntegrationItem:
+    # __slots__ drops the per-instance __dict__, loads build hundreds of thousands of these
+    __slots__ = (
+        'id',
+        'type',
+        'directory',
+        'parent_path_or_name',
+        'parent_id',
+        'name',
+        'email',
+        'creation_time',
+        'last_modified_time',
+        'url',
+        'children',
+        'mime_type',
+        'delta',
+        'drive_id',
+        'visibility',
+    )
+
     def __init__(
         self,
         id: Optional[str] = None,
@@ -35,3 +56,120 @@ class IntegrationItem:
         self.delta = delta
         self.drive_id = drive_id
         self.visibility = visibility
+
+    def __repr__(self) -> str:
+        return f'IntegrationItem(id={self.id!r}, type={self.type!r}, name={self.name!r})'
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+_TIME_FIELDS = ('creation_time', 'last_modified_time')
+
+
+def _arrow_schema():
+    # pyarrow is only imported by the first batch, most requests never build one
+    import pyarrow as pa
+
+    types = {'directory': pa.bool_(), 'visibility': pa.bool_(), 'children': pa.list_(pa.string())}
+    return pa.schema([(field, types.get(field, pa.string())) for field in IntegrationItem.__slots__])
+
+
+def _arrow_columns(columns: dict):
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if field.name in _TIME_FIELDS:
+            # providers hand back ISO strings or datetimes, arrow needs one type per column
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class IntegrationItemBatch:
+    """Column-wise store of IntegrationItems, backed by a pyarrow Table instead of one object per item.
+
+    Appended items wait in plain lists until the batch is next read, then become a new chunk of the table.
+    Slicing is Table.slice, a view over the same buffers, and to_arrow hands the table over as it is.
+    """
+
+    FIELDS = IntegrationItem.__slots__
+
+    def __init__(self, table=None, view: bool = False):
+        self._table = table
+        self._pending = {field: [] for field in self.FIELDS}
+        self._view = view
+
+    @classmethod
+    def from_items(cls, items: Iterable[IntegrationItem]) -> 'IntegrationItemBatch':
+        batch = cls()
+        batch.extend(items)
+        return batch
+
+    @classmethod
+    def from_dicts(cls, items: Iterable[dict]) -> 'IntegrationItemBatch':
+        items = items if isinstance(items, list) else list(items)
+        return cls(_arrow_columns({field: [item.get(field) for item in items] for field in cls.FIELDS}))
+
+    def _sealed(self):
+        import pyarrow as pa
+
+        if self._pending['id'] or self._table is None:
+            chunk = _arrow_columns(self._pending)
+            self._table = chunk if self._table is None else pa.concat_tables([self._table, chunk])
+            self._pending = {field: [] for field in self.FIELDS}
+        return self._table
+
+    def append(self, item: IntegrationItem) -> None:
+        self.extend((item,))
+
+    def extend(self, items: Iterable[IntegrationItem]) -> None:
+        if self._view:
+            raise ValueError('Cannot append to a slice of an IntegrationItemBatch.')
+        items = items if isinstance(items, list) else list(items)
+        for field, column in self._pending.items():
+            column.extend([getattr(item, field) for item in items])
+
+    def __len__(self) -> int:
+        return (0 if self._table is None else self._table.num_rows) + len(self._pending['id'])
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[IntegrationItem, 'IntegrationItemBatch']:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('IntegrationItemBatch only supports contiguous slices.')
+            return IntegrationItemBatch(self._sealed().slice(start, max(0, stop - start)), view=True)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('IntegrationItemBatch index out of range')
+        return IntegrationItem(**self._sealed().slice(index, 1).to_pylist()[0])
+
+    def __iter__(self) -> Iterator[IntegrationItem]:
+        for row in self.to_dicts():
+            yield IntegrationItem(**row)
+
+    def column(self, field: str):
+        """The field's values as a pyarrow ChunkedArray, no copy"""
+        return self._sealed().column(field)
+
+    def to_dicts(self) -> List[dict]:
+        return self._sealed().to_pylist()
+
+    def to_json(self) -> bytes:
+        return dumps(self.to_dicts())
+
+    def to_arrow(self):
+        return self._sealed()
+
+    def to_arrow_ipc(self) -> bytes:
+        import pyarrow as pa
+
+        table = self.to_arrow()
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
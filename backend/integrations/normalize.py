@@ -0,0 +1,167 @@
+"""Declarative mapping of provider JSON onto IntegrationItem.
+
+A provider declares once where each IntegrationItem field comes from:
+
+    CONTACT_MAPPING = ItemMapping(
+        'hubspot_contact',
+        id=Format('{}_Contact', Path('id', default='')),
+        email=Path('properties.email'),
+        type=Const('Contact'),
+    )
+
+and ItemMapping compiles the declarations into a single generated function, so mapping a page
+of results is one loop with the field lookups inlined instead of an interpreted walk over the
+spec for every item.
+"""
+import inspect
+import time
+from typing import Any, Dict, Iterable, List
+
+from integrations.integration_item import IntegrationItem
+from metrics import NORMALIZE_SECONDS_PER_ITEM
+
+_EMPTY: dict = {}
+
+
+class Path:
+    """A dotted key path into the raw object, None (or default) as soon as a key is missing"""
+
+    __slots__ = ('keys', 'default')
+
+    def __init__(self, path: str, default: Any = None):
+        self.keys = tuple(path.split('.'))
+        self.default = default
+
+
+class First:
+    """The first of several specs with a truthy value, otherwise default"""
+
+    __slots__ = ('specs', 'default')
+
+    def __init__(self, *specs, default: Any = None):
+        self.specs = specs
+        self.default = default
+
+
+class Format:
+    """str.format of a template with the values of other specs"""
+
+    __slots__ = ('template', 'specs')
+
+    def __init__(self, template: str, *specs):
+        self.template = template
+        self.specs = specs
+
+
+class Const:
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+
+# A spec is one of the classes above, a dotted path string, or a callable taking the raw object
+Spec = Any
+
+
+class ItemMapping:
+    """Compiled mapping from one kind of raw provider object to IntegrationItem"""
+
+    def __init__(self, label: str, /, **fields: Spec):
+        # label names the mapping in the normalize_seconds_per_item metric
+        self.label = label
+        self._seconds_per_item = NORMALIZE_SECONDS_PER_ITEM.labels(label)
+        unknown = set(fields) - set(IntegrationItem.__slots__)
+        if unknown:
+            raise ValueError(f'Not IntegrationItem fields: {sorted(unknown)}')
+        self.fields = fields
+        self._one, self._page = _compile(fields)
+
+    def __call__(self, raw: dict, **fixed) -> IntegrationItem:
+        item = self._one(raw)
+        for field, value in fixed.items():
+            setattr(item, field, value)
+        return item
+
+    def map_page(self, raws: Iterable[dict], **fixed) -> List[IntegrationItem]:
+        """Maps a whole page of raw objects, fixed sets the same value on every item (e.g. a shared parent)"""
+        started = time.perf_counter()
+        items = self._page(raws)
+        if items:
+            self._seconds_per_item.observe((time.perf_counter() - started) / len(items))
+        for field, value in fixed.items():
+            for item in items:
+                setattr(item, field, value)
+        return items
+
+
+def _compile(fields: Dict[str, Spec]):
+    env = {'_new': IntegrationItem.__new__, '_Item': IntegrationItem, '_EMPTY': _EMPTY}
+
+    def bind(value) -> str:
+        name = f'_v{len(env)}'
+        env[name] = value
+        return name
+
+    def expr(spec) -> str:
+        if isinstance(spec, str):
+            spec = Path(spec)
+        if isinstance(spec, Path):
+            source = 'raw'
+            for key in spec.keys[:-1]:
+                source = f'({source}.get({key!r}) or _EMPTY)'
+            default = '' if spec.default is None else f', {bind(spec.default)}'
+            return f'{source}.get({spec.keys[-1]!r}{default})'
+        if isinstance(spec, First):
+            options = [expr(option) for option in spec.specs]
+            if spec.default is not None:
+                options.append(bind(spec.default))
+            return f'({" or ".join(options)})'
+        if isinstance(spec, Format):
+            parts = [expr(part) for part in spec.specs]
+            literals = spec.template.split('{}')
+            if len(literals) != len(parts) + 1 or any('"' in part for part in parts):
+                return f'{bind(spec.template.format)}({", ".join(parts)})'
+            # plain '{}' templates become an f-string, the literal pieces are bound so nothing needs escaping
+            pieces = [f'{{{bind(literals[0])}}}'] if literals[0] else []
+            for part, literal in zip(parts, literals[1:]):
+                pieces.append(f'{{{part}}}')
+                if literal:
+                    pieces.append(f'{{{bind(literal)}}}')
+            return 'f"' + ''.join(pieces) + '"'
+        if isinstance(spec, Const):
+            return bind(spec.value)
+        if callable(spec):
+            return f'{bind(spec)}(raw)'
+        raise TypeError(f'Unsupported mapping spec: {spec!r}')
+
+    # the item is filled slot by slot, skipping IntegrationItem.__init__ and its keyword handling.
+    # A spec object used for several fields is evaluated once per item.
+    defaults = {
+        name: parameter.default
+        for name, parameter in inspect.signature(IntegrationItem.__init__).parameters.items()
+        if name != 'self'
+    }
+    body, computed = [], {}
+    for field in IntegrationItem.__slots__:
+        if field not in fields:
+            body.append(f'item.{field} = {bind(defaults[field])}')
+        elif id(fields[field]) in computed:
+            body.append(f'item.{field} = item.{computed[id(fields[field])]}')
+        else:
+            computed[id(fields[field])] = field
+            body.append(f'item.{field} = {expr(fields[field])}')
+    body = ''.join(f'        {line}\n' for line in body)
+    source = (
+        f'def page(raws):\n'
+        f'    items = []\n'
+        f'    append = items.append\n'
+        f'    for raw in raws:\n'
+        f'        item = _new(_Item)\n'
+        f'{body}'
+        f'        append(item)\n'
+        f'    return items\n'
+    )
+    exec(compile(source, '<ItemMapping>', 'exec'), env)
+    page = env['page']
+    return lambda raw: page((raw,))[0], page
@@ -1,17 +1,21 @@
 # notion.py
 
 import json
+import os
 import secrets
-from typing import List
+from typing import AsyncIterator, Dict, List, Tuple
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
-import httpx
 import asyncio
 import base64
-import requests
 from integrations.integration_item import IntegrationItem
+from integrations.normalize import ItemMapping, Path
+from integrations.registry import LoadVariant, ProviderInterface
+from streaming import merge_async_iterators
+from upstream import upstream_request
 
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, consume_state_redis, get_and_delete_redis
+from serialization import pack, unpack
 
 CLIENT_ID = 'XXX'
 CLIENT_SECRET = 'XXX'
@@ -19,6 +23,12 @@ REDIRECT_URI = 'http://localhost:8000/integrations/notion/oauth2callback'
 authorization_url = f'https://api.notion.com/v1/oauth/authorize?client_id={CLIENT_ID}&response_type=code&owner=user&redirect_uri=http%3A%2F%2Flocalhost%3A8000%2Fintegrations%2Fnotion%2Foauth2callback'
 encoded_client_id_secret = base64.b64encode(f'{CLIENT_ID}:{CLIENT_SECRET}'.encode()).decode()
 
+# /v1/search only returns one object type per filter, so each type is scanned separately
+SEARCH_OBJECT_TYPES = ('page', 'database')
+PAGE_SIZE = 100
+# Block-children requests in flight at once during a deep load, the rate limiter still paces them
+HYDRATE_CONCURRENCY = int(os.environ.get('NOTION_HYDRATE_CONCURRENCY', 8))
+
 
 async def authorize_notion(user_id, org_id):
     state_data = {
@@ -27,7 +37,7 @@ async def authorize_notion(user_id, org_id):
         'org_id': org_id
     }
     encoded_state = json.dumps(state_data)
-    await add_key_value_redis(f'notion_state:{org_id}:{user_id}', encoded_state, expire=600)
+    await add_key_value_redis(f'notion_state:{org_id}:{user_id}', pack(state_data), expire=600)
 
     return f'{authorization_url}&state={encoded_state}'
 
@@ -42,29 +52,26 @@ async def oauth2callback_notion(request: Request):
     user_id = state_data.get('user_id')
     org_id = state_data.get('org_id')
 
-    saved_state = await get_value_redis(f'notion_state:{org_id}:{user_id}')
-
-    if not saved_state or original_state != json.loads(saved_state).get('state'):
+    if not await consume_state_redis(f'notion_state:{org_id}:{user_id}', original_state):
         raise HTTPException(status_code=400, detail='State does not match.')
 
-    async with httpx.AsyncClient() as client:
-        response, _ = await asyncio.gather(
-            client.post(
-                'https://api.notion.com/v1/oauth/token',
-                json={
-                    'grant_type': 'authorization_code',
-                    'code': code,
-                    'redirect_uri': REDIRECT_URI
-                }, 
-                headers={
-                    'Authorization': f'Basic {encoded_client_id_secret}',
-                    'Content-Type': 'application/json',
-                }
-            ),
-            delete_key_redis(f'notion_state:{org_id}:{user_id}'),
-        )
+    response = await upstream_request(
+        'notion',
+        None,
+        'POST',
+        'https://api.notion.com/v1/oauth/token',
+        json={
+            'grant_type': 'authorization_code',
+            'code': code,
+            'redirect_uri': REDIRECT_URI
+        }, 
+        headers={
+            'Authorization': f'Basic {encoded_client_id_secret}',
+            'Content-Type': 'application/json',
+        }
+    )
 
-    await add_key_value_redis(f'notion_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    await add_key_value_redis(f'notion_credentials:{org_id}:{user_id}', pack(response.json()), expire=600)
     
     close_window_script = """
     <html>
@@ -76,13 +83,12 @@ async def oauth2callback_notion(request: Request):
     return HTMLResponse(content=close_window_script)
 
 async def get_notion_credentials(user_id, org_id):
-    credentials = await get_value_redis(f'notion_credentials:{org_id}:{user_id}')
+    credentials = await get_and_delete_redis(f'notion_credentials:{org_id}:{user_id}')
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
-    credentials = json.loads(credentials)
+    credentials = unpack(credentials)
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
-    await delete_key_redis(f'notion_credentials:{org_id}:{user_id}')
 
     return credentials
 
@@ -108,56 +114,259 @@ def _recursive_dict_search(data, target_key):
 
 
 
+# Name of the title property, per database id. Rows of one database share their schema, so the
+# property is looked up once per database instead of searching every row's properties.
+TITLE_INDEX_MAX = 10000
+_title_properties = {}
+
+
+def _title_property(response_json: dict):
+    properties = response_json.get('properties') or {}
+    title = properties.get('title')
+    if title is not None and title.get('type') == 'title':
+        return title
+    parent = response_json.get('parent') or {}
+    database_id = parent.get('database_id')
+    name = _title_properties.get(database_id)
+    if name is None:
+        name = next((key for key, value in properties.items() if value.get('type') == 'title'), None)
+        if database_id is not None and name is not None:
+            if len(_title_properties) >= TITLE_INDEX_MAX:
+                _title_properties.clear()
+            _title_properties[database_id] = name
+    return properties.get(name)
+
+
+def _notion_name(response_json: dict) -> str:
+    if response_json['object'] == 'database':
+        # a database keeps its title at the top level, its properties are the column schema
+        rich_text = response_json.get('title') or []
+    else:
+        rich_text = (_title_property(response_json) or {}).get('title') or []
+    name = ''.join(part.get('plain_text') or (part.get('text') or {}).get('content') or '' for part in rich_text)
+    if not name:
+        # untitled objects keep the old behaviour of taking the first text found anywhere
+        name = _recursive_dict_search(response_json['properties'], 'content')
+        name = _recursive_dict_search(response_json, 'content') if name is None else name
+        name = 'multi_select' if name is None else name
+    return response_json['object'] + ' ' + name
+
+
+def _notion_parent_id(response_json: dict):
+    parent = response_json['parent']
+    if parent['type'] == 'workspace':
+        return None
+    return parent[parent['type']]
+
+
+NOTION_MAPPING = ItemMapping(
+    'notion',
+    id=Path('id'),
+    type=Path('object'),
+    name=_notion_name,
+    creation_time=Path('created_time'),
+    last_modified_time=Path('last_edited_time'),
+    parent_id=_notion_parent_id,
+)
+
+
 def create_integration_item_metadata_object(
     response_json: str,
 ) -> IntegrationItem:
     """creates an integration metadata object from the response"""
-    name = _recursive_dict_search(response_json['properties'], 'content')
-    parent_type = (
-        ''
-        if response_json['parent']['type'] is None
-        else response_json['parent']['type']
-    )
-    if response_json['parent']['type'] == 'workspace':
-        parent_id = None
-    else:
-        parent_id = (
-            response_json['parent'][parent_type]
+    return NOTION_MAPPING(response_json)
+
+async def fetch_items(access_token: str, object_type: str) -> AsyncIterator[list]:
+    """Pages through /v1/search for a single object type until has_more is false"""
+    body = {
+        'filter': {'property': 'object', 'value': object_type},
+        'page_size': PAGE_SIZE,
+    }
+    while True:
+        response = await upstream_request(
+            'notion',
+            access_token,
+            'POST',
+            'https://api.notion.com/v1/search',
+            idempotent=True,
+            json=body,
+            headers={
+                'Authorization': f'Bearer {access_token}',
+                'Notion-Version': '2022-06-28',
+            },
         )
 
-    name = _recursive_dict_search(response_json, 'content') if name is None else name
-    name = 'multi_select' if name is None else name
-    name = response_json['object'] + ' ' + name
-
-    integration_item_metadata = IntegrationItem(
-        id=response_json['id'],
-        type=response_json['object'],
-        name=name,
-        creation_time=response_json['created_time'],
-        last_modified_time=response_json['last_edited_time'],
-        parent_id=parent_id,
+        response_json = response.json()
+        yield response_json.get('results', [])
+        if not response_json.get('has_more') or not response_json.get('next_cursor'):
+            return
+        body['start_cursor'] = response_json['next_cursor']
+
+
+async def fetch_block_children(access_token: str, block_id: str, semaphore: asyncio.Semaphore) -> List[dict]:
+    """Returns every child block of a page or block, following start_cursor"""
+    children, params = [], {'page_size': PAGE_SIZE}
+    while True:
+        async with semaphore:
+            response = await upstream_request(
+                'notion',
+                access_token,
+                'GET',
+                f'https://api.notion.com/v1/blocks/{block_id}/children',
+                params=params,
+                headers={
+                    'Authorization': f'Bearer {access_token}',
+                    'Notion-Version': '2022-06-28',
+                },
+            )
+        response_json = response.json()
+        children.extend(response_json.get('results', []))
+        if not response_json.get('has_more') or not response_json.get('next_cursor'):
+            return children
+        params['start_cursor'] = response_json['next_cursor']
+
+
+def _child_item(block: dict, owner_id: str) -> IntegrationItem:
+    # pages and databases the search did not return, built from the block that embeds them
+    object_type = 'page' if block['type'] == 'child_page' else 'database'
+    return IntegrationItem(
+        id=block['id'],
+        type=object_type,
+        name=f"{object_type} {block[block['type']].get('title', '')}",
+        creation_time=block.get('created_time'),
+        last_modified_time=block.get('last_edited_time'),
+        parent_id=owner_id,
     )
 
-    return integration_item_metadata
 
-async def get_items_notion(credentials) -> List[IntegrationItem]:
-    """Aggregates all metadata relevant for a notion integration"""
+async def hydrate_hierarchy(access_token: str, items: Dict[str, IntegrationItem]) -> None:
+    """Fills children, directory and parent_path_or_name of every item by walking the block tree.
+
+    The walk goes one level at a time with every node of a level fetched concurrently, so it takes
+    as many rounds as the tree is deep. Pages nested in other blocks (toggles, columns) are attached
+    to the page that contains them. Items found only through the walk are added to items.
+    """
+    semaphore = asyncio.Semaphore(HYDRATE_CONCURRENCY)
+    children: Dict[str, List[str]] = {item_id: [] for item_id in items}
+
+    # database rows are pages whose parent is the database, the search already returned them
+    rows: Dict[str, List[str]] = {}
+    for item in items.values():
+        if item.parent_id in items and items[item.parent_id].type == 'database':
+            rows.setdefault(item.parent_id, []).append(item.id)
+
+    def attach(child_id: str, owner_id: str) -> None:
+        if child_id not in children[owner_id]:
+            children[owner_id].append(child_id)
+        items[child_id].parent_id = owner_id
+
+    # (block to read, page or database that owns what is found in it)
+    roots = [item for item in items.values() if item.parent_id not in items]
+    level: List[Tuple[str, str]] = [(item.id, item.id) for item in roots]
+    visited = set()
+    while level:
+        level = list({block_id: owner_id for block_id, owner_id in level if block_id not in visited}.items())
+        visited.update(block_id for block_id, _ in level)
+        fetched = await asyncio.gather(*[
+            fetch_block_children(access_token, block_id, semaphore)
+            for block_id, owner_id in level
+            if items.get(block_id) is None or items[block_id].type != 'database'
+        ])
+        fetched = iter(fetched)
+        next_level = []
+        for block_id, owner_id in level:
+            if block_id in items and items[block_id].type == 'database':
+                for row_id in rows.get(block_id, []):
+                    attach(row_id, block_id)
+                    next_level.append((row_id, row_id))
+                continue
+            for block in next(fetched):
+                if block['type'] in ('child_page', 'child_database'):
+                    if block['id'] not in items:
+                        items[block['id']] = _child_item(block, owner_id)
+                        children[block['id']] = []
+                    attach(block['id'], owner_id)
+                    next_level.append((block['id'], block['id']))
+                elif block.get('has_children'):
+                    next_level.append((block['id'], owner_id))
+        level = next_level
+
+    def fill(root_id: str, seen: set) -> None:
+        # depth first with an explicit stack, a deep workspace must not run into the recursion limit
+        stack = [(root_id, None)]
+        while stack:
+            item_id, path = stack.pop()
+            if item_id in seen:
+                continue
+            item = items[item_id]
+            item.parent_path_or_name = path
+            item.children = children[item_id]
+            item.directory = bool(item.children) or item.type == 'database'
+            seen.add(item_id)
+            child_path = item.name if path is None else f'{path}/{item.name}'
+            stack.extend((child_id, child_path) for child_id in reversed(item.children) if child_id not in seen)
+
+    seen = set()
+    # pages parented by a block were roots until the walk found the page around that block
+    for item in roots:
+        if item.parent_id not in items:
+            fill(item.id, seen)
+    # anything left is only reachable through a cycle of parents, keep it with whatever it has
+    for item_id in items.keys() - seen:
+        fill(item_id, seen)
+
+
+async def stream_items_notion(credentials, deep=False) -> AsyncIterator[IntegrationItem]:
+    """Runs the page and database scans concurrently and yields items as either scan returns a page.
+
+    With deep=True the items are held back until hydrate_hierarchy has filled in the workspace tree.
+    """
     credentials = json.loads(credentials)
-    response = requests.post(
-        'https://api.notion.com/v1/search',
-        headers={
-            'Authorization': f'Bearer {credentials.get("access_token")}',
-            'Notion-Version': '2022-06-28',
-        },
-    )
+    access_token = credentials.get('access_token')
 
-    if response.status_code == 200:
-        results = response.json()['results']
-        list_of_integration_item_metadata = []
+    scans = [fetch_items(access_token, object_type) for object_type in SEARCH_OBJECT_TYPES]
+    seen_ids, items = set(), {}
+    async for results in merge_async_iterators(scans):
+        fresh = []
         for result in results:
-            list_of_integration_item_metadata.append(
-                create_integration_item_metadata_object(result)
-            )
+            if result['id'] not in seen_ids:
+                seen_ids.add(result['id'])
+                fresh.append(result)
+        for item in NOTION_MAPPING.map_page(fresh):
+            if deep:
+                items[item.id] = item
+            else:
+                yield item
+
+    if deep:
+        await hydrate_hierarchy(access_token, items)
+        for item in items.values():
+            yield item
+
+
+async def stream_items_notion_deep(credentials) -> AsyncIterator[IntegrationItem]:
+    async for item in stream_items_notion(credentials, deep=True):
+        yield item
+
+
+async def get_items_notion(credentials, deep=False) -> List[IntegrationItem]:
+    """Aggregates all metadata relevant for a notion integration"""
+    list_of_integration_item_metadata = [item async for item in stream_items_notion(credentials, deep=deep)]
+
+    print(f'Found {len(list_of_integration_item_metadata)} Notion integration items')
+    return list_of_integration_item_metadata
+
+
+async def get_items_notion_deep(credentials) -> List[IntegrationItem]:
+    return await get_items_notion(credentials, deep=True)
+
 
-        print(list_of_integration_item_metadata)
-    return
+PROVIDER = ProviderInterface(
+    authorize=authorize_notion,
+    oauth2callback=oauth2callback_notion,
+    credentials=get_notion_credentials,
+    load=get_items_notion,
+    stream=stream_items_notion,
+    # deep=true also walks the block tree to fill in children, directory and parent_path_or_name
+    variants={'deep': LoadVariant('notion_deep', stream=stream_items_notion_deep, load=get_items_notion_deep)},
+)
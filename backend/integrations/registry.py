@@ -0,0 +1,85 @@
+# registry.py
+
+import importlib
+import os
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from integrations.integration_item import IntegrationItem
+
+# provider name -> module defining its PROVIDER interface. Nothing here imports the modules: a provider's module
+# is imported by the first request that uses it, so a worker only pays for the providers it serves.
+PROVIDER_MODULES = {
+    'airtable': 'integrations.airtable',
+    'notion': 'integrations.notion',
+    'hubspot': 'integrations.hubspot',
+}
+# Comma separated providers this deployment serves, all of them by default. The others get no routes.
+ENABLED_PROVIDERS = [
+    name.strip() for name in os.environ.get('ENABLED_PROVIDERS', ','.join(PROVIDER_MODULES)).split(',') if name.strip()
+]
+# Import the enabled providers at startup instead of on first use, trading startup time for first-request latency
+PRELOAD_PROVIDERS = os.environ.get('PRELOAD_PROVIDERS', '').lower() in ('1', 'true', 'yes')
+
+_unknown = [name for name in ENABLED_PROVIDERS if name not in PROVIDER_MODULES]
+if _unknown:
+    raise ValueError(f'ENABLED_PROVIDERS names unknown providers: {", ".join(_unknown)}')
+
+
+@dataclass(frozen=True)
+class LoadVariant:
+    """Another kind of load of a provider, chosen with a boolean field of its /load route (e.g. deep=true)"""
+    namespace: str  # cache, coalescing and metrics namespace, apart from the provider's plain loads
+    stream: Callable[..., AsyncIterator[IntegrationItem]]
+    # list loader for non-streamed requests, through the result cache. Without one the variant is always
+    # streamed live and never cached.
+    load: Optional[Callable[[str], Awaitable[List[IntegrationItem]]]] = None
+    # the stream takes the route's record_fields as a second argument
+    projection: bool = False
+
+
+@dataclass(frozen=True)
+class ProviderInterface:
+    """What an integration module exposes as PROVIDER, main.py builds the provider's routes from it"""
+    authorize: Callable[[str, str], Awaitable]
+    oauth2callback: Callable
+    credentials: Callable[[str, str], Awaitable]
+    load: Callable[[str], Awaitable[List[IntegrationItem]]]
+    stream: Callable[[str], AsyncIterator[IntegrationItem]]
+    # (credentials, user_id, org_id): the items added, changed or removed since the account's last incremental load
+    stream_delta: Optional[Callable[[str, str, str], AsyncIterator[IntegrationItem]]] = None
+    variants: Dict[str, LoadVariant] = field(default_factory=dict)
+    # (credentials, user_id, org_id) -> the credentials to load with, e.g. a token kept fresh server side
+    prepare_credentials: Optional[Callable[[str, Optional[str], Optional[str]], Awaitable[str]]] = None
+    # awaited at shutdown, if the provider was used
+    close: Optional[Callable[[], Awaitable]] = None
+
+
+_loaded: Dict[str, ProviderInterface] = {}
+
+
+def get_provider(name: str) -> ProviderInterface:
+    """The interface of an enabled provider, importing its module on first use"""
+    interface = _loaded.get(name)
+    if interface is None:
+        if name not in ENABLED_PROVIDERS:
+            raise HTTPException(status_code=404, detail='Unknown integration.')
+        interface = _loaded[name] = importlib.import_module(PROVIDER_MODULES[name]).PROVIDER
+    return interface
+
+
+def preload_providers() -> None:
+    for name in ENABLED_PROVIDERS:
+        get_provider(name)
+
+
+def loaded_providers() -> List[str]:
+    return list(_loaded)
+
+
+async def close_providers() -> None:
+    for interface in list(_loaded.values()):
+        if interface.close is not None:
+            await interface.close()
@@ -0,0 +1,348 @@
+import asyncio
+import base64
+import concurrent.futures
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import AsyncIterator, Iterable, List, Optional
+
+from fastapi import HTTPException
+
+from serialization import dumps, loads
+from vector_index import VECTOR_INDEX_MAX_LIMIT, VECTOR_INDEX_PATH, delete_vectors, search_vectors, update_vectors
+from watermarks import DELTA_REMOVED
+
+# Every loaded item is kept in a local SQLite database, so finding things never needs another crawl.
+# Set ITEM_INDEX_PATH to '' to turn the index off.
+ITEM_INDEX_PATH = os.environ.get('ITEM_INDEX_PATH', 'item_index.db')
+# Items written per transaction
+ITEM_INDEX_BATCH_SIZE = int(os.environ.get('ITEM_INDEX_BATCH_SIZE', 500))
+# Batches a load may have waiting for the writer before it waits too, bounds the memory of a slow disk
+ITEM_INDEX_MAX_PENDING = int(os.environ.get('ITEM_INDEX_MAX_PENDING', 8))
+ITEM_INDEX_MAX_LIMIT = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    org_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    id TEXT NOT NULL,
+    type TEXT,
+    name TEXT,
+    email TEXT,
+    parent_id TEXT,
+    parent_path_or_name TEXT,
+    data BLOB NOT NULL,
+    indexed_at REAL NOT NULL,
+    UNIQUE (org_id, user_id, provider, id)
+);
+CREATE INDEX IF NOT EXISTS items_parent ON items (org_id, user_id, parent_id);
+CREATE INDEX IF NOT EXISTS items_type ON items (org_id, user_id, type);
+CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+    name, email, type, parent_path_or_name,
+    content='items', content_rowid='rowid', prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS items_ai AFTER INSERT ON items BEGIN
+    INSERT INTO items_fts (rowid, name, email, type, parent_path_or_name)
+    VALUES (new.rowid, new.name, new.email, new.type, new.parent_path_or_name);
+END;
+CREATE TRIGGER IF NOT EXISTS items_ad AFTER DELETE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, name, email, type, parent_path_or_name)
+    VALUES ('delete', old.rowid, old.name, old.email, old.type, old.parent_path_or_name);
+END;
+CREATE TRIGGER IF NOT EXISTS items_au AFTER UPDATE ON items BEGIN
+    INSERT INTO items_fts (items_fts, rowid, name, email, type, parent_path_or_name)
+    VALUES ('delete', old.rowid, old.name, old.email, old.type, old.parent_path_or_name);
+    INSERT INTO items_fts (rowid, name, email, type, parent_path_or_name)
+    VALUES (new.rowid, new.name, new.email, new.type, new.parent_path_or_name);
+END;
+"""
+
+_UPSERT = """
+INSERT INTO items (org_id, user_id, provider, id, type, name, email, parent_id, parent_path_or_name, data, indexed_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (org_id, user_id, provider, id) DO UPDATE SET
+    type = excluded.type, name = excluded.name, email = excluded.email, parent_id = excluded.parent_id,
+    parent_path_or_name = excluded.parent_path_or_name, data = excluded.data, indexed_at = excluded.indexed_at
+"""
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# sqlite3 connections belong to the thread that opened them: all writes go through one thread, which also
+# keeps them in order, and reads get a connection per thread of the default executor
+_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='item-index')
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_stats = {'indexed': 0, 'removed': 0, 'pruned': 0, 'batches': 0, 'failed_batches': 0, 'searches': 0}
+
+
+def _connection() -> sqlite3.Connection:
+    global _schema_ready
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = _local.connection = sqlite3.connect(ITEM_INDEX_PATH, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')  # searches keep reading while a batch is written
+        connection.execute('PRAGMA synchronous=NORMAL')
+        with _schema_lock:
+            if not _schema_ready:
+                connection.executescript(_SCHEMA)
+                _schema_ready = True
+    return connection
+
+
+def _row(org_id: str, user_id: str, provider: str, item: dict, now: float) -> tuple:
+    return (
+        org_id, user_id, provider, item['id'], item.get('type'), item.get('name'), item.get('email'),
+        item.get('parent_id'), item.get('parent_path_or_name'), dumps(item), now,
+    )
+
+
+def _rowids(connection: sqlite3.Connection, org_id: str, user_id: str, provider: str, ids: List[str]) -> dict:
+    rows = connection.execute(
+        f'SELECT id, rowid FROM items WHERE org_id = ? AND user_id = ? AND provider = ? AND id IN ({", ".join("?" * len(ids))})',
+        (org_id, user_id, provider, *ids),
+    )
+    return dict(rows.fetchall())
+
+
+def _write_batch(org_id: str, user_id: str, provider: str, items: List[dict]) -> None:
+    connection = _connection()
+    now = time.time()
+    kept = [item for item in items if item.get('delta') != DELTA_REMOVED]
+    upserts = [_row(org_id, user_id, provider, item, now) for item in kept]
+    removals = [(org_id, user_id, provider, item['id']) for item in items if item.get('delta') == DELTA_REMOVED]
+    removed_rowids = []
+    with connection:
+        if upserts:
+            connection.executemany(_UPSERT, upserts)
+        if removals:
+            if VECTOR_INDEX_PATH:
+                removed_rowids = list(_rowids(connection, org_id, user_id, provider, [row[3] for row in removals]).values())
+            connection.executemany('DELETE FROM items WHERE org_id = ? AND user_id = ? AND provider = ? AND id = ?', removals)
+    if VECTOR_INDEX_PATH:
+        # the vectors follow the committed rows, an item whose vector failed to be written gets it on its next load
+        if kept:
+            rowids = _rowids(connection, org_id, user_id, provider, [item['id'] for item in kept])
+            kept = [item for item in kept if item['id'] in rowids]
+            update_vectors(org_id, user_id, [rowids[item['id']] for item in kept], kept)
+        delete_vectors(org_id, user_id, removed_rowids)
+    _stats['indexed'] += len(upserts)
+    _stats['removed'] += len(removals)
+    _stats['batches'] += 1
+
+
+def _prune(org_id: str, user_id: str, provider: str, before: float, types: List[str]) -> None:
+    # whatever a complete load did not write again no longer exists upstream. Only the item types the load
+    # returned are pruned, so a plain Airtable load keeps the records a records load indexed.
+    condition = (
+        'org_id = ? AND user_id = ? AND provider = ? AND indexed_at < ?'
+        f' AND type IN ({", ".join("?" * len(types))})'
+    )
+    args = (org_id, user_id, provider, before, *types)
+    with _connection() as connection:
+        rowids = [row[0] for row in connection.execute(f'SELECT rowid FROM items WHERE {condition}', args)] if VECTOR_INDEX_PATH else []
+        cursor = connection.execute(f'DELETE FROM items WHERE {condition}', args)
+    if VECTOR_INDEX_PATH:
+        delete_vectors(org_id, user_id, rowids)
+    _stats['pruned'] += cursor.rowcount
+
+
+def _logged(future: concurrent.futures.Future) -> None:
+    if future.exception() is not None:
+        _stats['failed_batches'] += 1
+        print(f'Writing to the item index failed: {future.exception()!r}')
+
+
+class _Indexer:
+    """Batches one load's items and hands the batches to the writer thread without waiting for them"""
+
+    def __init__(self, provider: str, user_id: str, org_id: str):
+        self.provider, self.user_id, self.org_id = provider, user_id, org_id
+        self.started = time.time()
+        self.batch = []
+        self.pending = []
+        self.types = set()
+
+    async def add(self, item) -> None:
+        item = item if isinstance(item, dict) else item.to_dict()
+        self.types.add(item.get('type'))
+        self.batch.append(item)
+        if len(self.batch) >= ITEM_INDEX_BATCH_SIZE:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.batch:
+            self.pending.append(self._submit(_write_batch, self.org_id, self.user_id, self.provider, self.batch))
+            self.batch = []
+        self.pending = [future for future in self.pending if not future.done()]
+        if len(self.pending) > ITEM_INDEX_MAX_PENDING:
+            await asyncio.wrap_future(self.pending.pop(0))
+
+    def finish(self, complete: bool) -> None:
+        if self.batch:
+            self._submit(_write_batch, self.org_id, self.user_id, self.provider, self.batch)
+            self.batch = []
+        if complete and self.types:
+            # queued behind the batches, the writer runs in order
+            self._submit(_prune, self.org_id, self.user_id, self.provider, self.started, sorted(self.types, key=str))
+
+    @staticmethod
+    def _submit(function, *args) -> concurrent.futures.Future:
+        future = _writer.submit(function, *args)
+        future.add_done_callback(_logged)
+        return future
+
+
+def _enabled(user_id: Optional[str], org_id: Optional[str]) -> bool:
+    return bool(ITEM_INDEX_PATH and user_id and org_id)
+
+
+async def index_stream(
+    provider: str, user_id: Optional[str], org_id: Optional[str], items: AsyncIterator, complete: bool = True
+) -> AsyncIterator:
+    """Passes items through while writing them to the index of the account.
+
+    complete=False for incremental loads: their removed items are deleted, but items they did not mention are kept.
+    Loads without user_id and org_id are not indexed.
+    """
+    if not _enabled(user_id, org_id):
+        async for item in items:
+            yield item
+        return
+    indexer = _Indexer(provider, user_id, org_id)
+    finished = False
+    try:
+        async for item in items:
+            yield item
+            await indexer.add(item)
+        finished = True
+    finally:
+        indexer.finish(complete and finished)
+
+
+async def index_items(provider: str, user_id: Optional[str], org_id: Optional[str], items: Iterable) -> None:
+    """Writes a complete load's result to the index of the account, in the background"""
+    if not _enabled(user_id, org_id):
+        return
+    indexer = _Indexer(provider, user_id, org_id)
+    for item in items:
+        await indexer.add(item)
+    indexer.finish(complete=True)
+
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(dumps(values)).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> list:
+    try:
+        return loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+
+def _match_expression(query: str) -> str:
+    # every word is matched as a prefix, so 'acme pro' finds 'Acme Projects'; quoting keeps FTS5 syntax out
+    tokens = _TOKEN.findall(query)
+    if not tokens:
+        raise HTTPException(status_code=400, detail='The query has no searchable words.')
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _search(
+    org_id: str, user_id: str, query: Optional[str], provider: Optional[str], item_type: Optional[str],
+    parent_id: Optional[str], limit: int, cursor: Optional[list],
+) -> dict:
+    conditions, args = ['items.org_id = ?', 'items.user_id = ?'], [org_id, user_id]
+    for column, value in (('provider', provider), ('type', item_type), ('parent_id', parent_id)):
+        if value is not None:
+            conditions.append(f'items.{column} = ?')
+            args.append(value)
+
+    if query is not None:
+        # best matches first, the cursor is the (rank, rowid) of the last item sent
+        select = 'SELECT items.rowid, items.data, items_fts.rank FROM items_fts JOIN items ON items.rowid = items_fts.rowid'
+        conditions.insert(0, 'items_fts MATCH ?')
+        args.insert(0, _match_expression(query))
+        if cursor is not None:
+            conditions.append('(items_fts.rank > ? OR (items_fts.rank = ? AND items.rowid > ?))')
+            args.extend([cursor[0], cursor[0], cursor[1]])
+        order = 'items_fts.rank, items.rowid'
+    else:
+        select = 'SELECT items.rowid, items.data, NULL FROM items'
+        if cursor is not None:
+            conditions.append('items.rowid > ?')
+            args.append(cursor[0])
+        order = 'items.rowid'
+
+    sql = f'{select} WHERE {" AND ".join(conditions)} ORDER BY {order} LIMIT ?'
+    rows = _connection().execute(sql, args + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        rowid, _, rank = rows[-1]
+        next_cursor = _encode_cursor([rank, rowid] if query is not None else [rowid])
+    _stats['searches'] += 1
+    return {'items': [loads(data) for _, data, _ in rows], 'next_cursor': next_cursor}
+
+
+async def search_items(
+    org_id: str,
+    user_id: str,
+    query: Optional[str] = None,
+    provider: Optional[str] = None,
+    item_type: Optional[str] = None,
+    parent_id: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+) -> dict:
+    """Items of an account that match query (full text, words as prefixes) and the given filters.
+
+    Returns {'items': [...], 'next_cursor': ...}; pass next_cursor back for the following page until it is None.
+    """
+    if not ITEM_INDEX_PATH:
+        raise HTTPException(status_code=404, detail='The item index is disabled.')
+    if not 1 <= limit <= ITEM_INDEX_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f'limit must be between 1 and {ITEM_INDEX_MAX_LIMIT}.')
+    decoded = None if cursor is None else _decode_cursor(cursor)
+    return await asyncio.to_thread(_search, org_id, user_id, query, provider, item_type, parent_id, limit, decoded)
+
+
+def _similar(org_id: str, user_id: str, query: str, limit: int) -> dict:
+    matches = search_vectors(org_id, user_id, query, limit)
+    if not matches:
+        return {'items': [], 'scores': []}
+    rows = _connection().execute(
+        f'SELECT rowid, data FROM items WHERE org_id = ? AND user_id = ? AND rowid IN ({", ".join("?" * len(matches))})',
+        (org_id, user_id, *(rowid for rowid, _ in matches)),
+    )
+    data = dict(rows.fetchall())
+    # a match pruned since the query ran has no row any more
+    matches = [(rowid, score) for rowid, score in matches if rowid in data]
+    return {'items': [loads(data[rowid]) for rowid, _ in matches], 'scores': [round(score, 4) for _, score in matches]}
+
+
+async def similar_items(org_id: str, user_id: str, query: str, limit: int = 10) -> dict:
+    """Items of an account closest to query by meaning rather than exact words, best first.
+
+    Returns {'items': [...], 'scores': [...]}, scores being the cosine similarities of their vectors (see vector_index.py).
+    """
+    if not ITEM_INDEX_PATH or not VECTOR_INDEX_PATH:
+        raise HTTPException(status_code=404, detail='The vector index is disabled.')
+    if not 1 <= limit <= VECTOR_INDEX_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f'limit must be between 1 and {VECTOR_INDEX_MAX_LIMIT}.')
+    if not query.strip():
+        raise HTTPException(status_code=400, detail='The query is empty.')
+    return await asyncio.to_thread(_similar, org_id, user_id, query, limit)
+
+
+def item_index_stats() -> dict:
+    return dict(_stats)
+
+
+def close_item_index() -> None:
+    # lets the queued batches finish before the worker exits
+    _writer.shutdown(wait=True)
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+from integrations.integration_item import IntegrationItem
+from redis_client import add_key_value_redis, delete_key_redis, get_value_redis
+from resilience import ProviderUnavailable
+from serialization import dumps, pack, unpack
+
+# Results younger than LOAD_CACHE_TTL are served as is. Older ones are served straight away
+# for another LOAD_CACHE_STALE_TTL seconds while a background load refreshes them.
+LOAD_CACHE_TTL = int(os.environ.get('LOAD_CACHE_TTL', 300))
+LOAD_CACHE_STALE_TTL = int(os.environ.get('LOAD_CACHE_STALE_TTL', 3600))
+# Results bigger than this are not cached at all, so one huge account cannot crowd out the rest of Redis
+LOAD_CACHE_MAX_BYTES = int(os.environ.get('LOAD_CACHE_MAX_BYTES', 8 * 1024 * 1024))
+
+Loader = Callable[[str], Awaitable[List[IntegrationItem]]]
+Streamer = Callable[[str], AsyncIterator[IntegrationItem]]
+# awaited with the serialized items of every result fetched from the provider, not with cached ones
+OnFetched = Optional[Callable[[List[dict]], Awaitable]]
+
+_stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'too_large': 0, 'fallbacks': 0}
+_refreshing = {}
+
+
+def cache_key(provider: str, credentials: str) -> str:
+    access_token = json.loads(credentials).get('access_token') or ''
+    digest = hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+    return f'load_cache:{provider}:{digest}'
+
+
+async def _store(key: str, items: List[dict]) -> None:
+    payload = pack({'fetched_at': time.time(), 'items': items})
+    if len(payload) > LOAD_CACHE_MAX_BYTES:
+        _stats['too_large'] += 1
+        return
+    await add_key_value_redis(key, payload, expire=LOAD_CACHE_TTL + LOAD_CACHE_STALE_TTL)
+
+
+async def _load_and_store(key: str, credentials: str, loader: Loader, on_fetched: OnFetched = None) -> List[dict]:
+    items = [item.to_dict() for item in await loader(credentials)]
+    await _store(key, items)
+    if on_fetched is not None:
+        await on_fetched(items)
+    return items
+
+
+async def _refresh(key: str, credentials: str, loader: Loader, on_fetched: OnFetched = None) -> None:
+    try:
+        await _load_and_store(key, credentials, loader, on_fetched)
+        _stats['refreshes'] += 1
+    except Exception as e:
+        print(f'Background refresh of {key} failed: {e!r}')
+    finally:
+        _refreshing.pop(key, None)
+
+
+async def _fallback(key: str, error: ProviderUnavailable) -> Optional[List[dict]]:
+    # while a provider is failing, a cached result of any age (up to its expiry) beats an error
+    cached = await get_value_redis(key)
+    if cached is None:
+        return None
+    _stats['fallbacks'] += 1
+    print(f'Serving the cached {key} because the provider failed: {error.detail}')
+    return unpack(cached)['items']
+
+
+def _schedule_refresh(key: str, credentials: str, loader: Loader, on_fetched: OnFetched = None) -> None:
+    # one background refresh per key at a time, however many stale hits arrive meanwhile
+    if key not in _refreshing:
+        _refreshing[key] = asyncio.create_task(_refresh(key, credentials, loader, on_fetched))
+
+
+async def cached_load(
+    provider: str, credentials: str, loader: Loader, refresh: bool = False, on_fetched: OnFetched = None
+) -> List[dict]:
+    """Runs loader through the Redis result cache and returns the serialized IntegrationItems.
+
+    on_fetched gets the items whenever loader ran, including the background refresh of a stale hit.
+    """
+    key = cache_key(provider, credentials)
+    cached = None if refresh else await get_value_redis(key)
+    if cached is None:
+        _stats['misses'] += 1
+        try:
+            return await _load_and_store(key, credentials, loader, on_fetched)
+        except ProviderUnavailable as e:
+            items = await _fallback(key, e) if refresh else None
+            if items is None:
+                raise
+            return items
+
+    cached = unpack(cached)
+    if time.time() - cached['fetched_at'] < LOAD_CACHE_TTL:
+        _stats['hits'] += 1
+    else:
+        _stats['stale_hits'] += 1
+        _schedule_refresh(key, credentials, loader, on_fetched)
+    return cached['items']
+
+
+async def cached_stream(
+    provider: str, credentials: str, streamer: Streamer, refresh: bool = False
+) -> AsyncIterator[IntegrationItem]:
+    """Streaming counterpart of cached_load, a miss is streamed live and cached once it completes"""
+    key = cache_key(provider, credentials)
+    cached = None if refresh else await get_value_redis(key)
+    if cached is not None:
+        cached = unpack(cached)
+        if time.time() - cached['fetched_at'] < LOAD_CACHE_TTL:
+            _stats['hits'] += 1
+        else:
+            _stats['stale_hits'] += 1
+            _schedule_refresh(key, credentials, lambda c: _collect(streamer(c)))
+        for item in cached['items']:
+            yield IntegrationItem(**item)
+        return
+
+    _stats['misses'] += 1
+    items, size, streamed = [], 0, False
+    try:
+        async for item in streamer(credentials):
+            streamed = True
+            yield item
+            if items is not None:
+                items.append(item.to_dict())
+                size += len(dumps(items[-1]))
+                if size > LOAD_CACHE_MAX_BYTES:
+                    # stop buffering as soon as the result is known to be too big to cache
+                    _stats['too_large'] += 1
+                    items = None
+    except ProviderUnavailable as e:
+        # once items went out the client gets a partial result instead, see streaming.py
+        fallback = await _fallback(key, e) if refresh and not streamed else None
+        if fallback is None:
+            raise
+        for item in fallback:
+            yield IntegrationItem(**item)
+        return
+    if items is not None:
+        await _store(key, items)
+
+
+async def _collect(items: AsyncIterator[IntegrationItem]) -> List[IntegrationItem]:
+    return [item async for item in items]
+
+
+async def invalidate_load_cache(provider: str, credentials: str) -> None:
+    await delete_key_redis(cache_key(provider, credentials))
+
+
+def load_cache_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+import time
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import HTTPException
+
+from integrations.integration_item import IntegrationItem
+from item_index import index_stream
+from metrics import observe_stream
+from redis_client import (
+    add_key_value_redis,
+    delete_key_redis,
+    get_value_redis,
+    key_exists_redis,
+    run_script_redis,
+)
+from serialization import pack, unpack
+from upstream import track_upstream_pages
+
+# Items per result chunk, each chunk is one Redis key the client fetches separately
+JOB_CHUNK_SIZE = int(os.environ.get('LOAD_JOB_CHUNK_SIZE', 1000))
+# Jobs this worker runs at once, the rest wait as 'queued'
+JOB_CONCURRENCY = int(os.environ.get('LOAD_JOB_CONCURRENCY', 4))
+# Jobs an org may have queued or running at once, across all workers
+JOB_MAX_PER_ORG = int(os.environ.get('LOAD_JOB_MAX_PER_ORG', 2))
+# A job still running after this long is cancelled, and its org slot is freed even if its worker died
+JOB_TIMEOUT = int(os.environ.get('LOAD_JOB_TIMEOUT', 3600))
+# How long status and results are kept after a job finishes
+JOB_RESULT_TTL = int(os.environ.get('LOAD_JOB_RESULT_TTL', 3600))
+# Minimum seconds between two status writes while a job is running
+JOB_STATUS_INTERVAL = float(os.environ.get('LOAD_JOB_STATUS_INTERVAL', 1))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+Streamer = Callable[[str], AsyncIterator[IntegrationItem]]
+
+# KEYS[1] is a sorted set of the org's active job ids scored by their deadline.
+# Drops entries past their deadline, then adds ARGV[1] unless the org is already at ARGV[3] jobs.
+_CLAIM_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[4])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+_RELEASE_SLOT_SCRIPT = """
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+_semaphore = None
+_tasks = {}
+
+
+def _status_key(job_id: str) -> str:
+    return f'load_job:{job_id}'
+
+
+def _chunk_key(job_id: str, chunk: int) -> str:
+    return f'load_job:{job_id}:chunk:{chunk}'
+
+
+def _cancel_key(job_id: str) -> str:
+    return f'load_job:{job_id}:cancel'
+
+
+def _slots_key(org_id: str) -> str:
+    return f'load_jobs_active:{org_id}'
+
+
+def _size_key(provider: str, credentials: str) -> str:
+    # item count of the account's last finished job, the basis of the ETA
+    access_token = json.loads(credentials).get('access_token') or ''
+    return f'load_job_size:{provider}:{hashlib.sha256(access_token.encode("utf-8")).hexdigest()}'
+
+
+async def _write_status(status: dict) -> None:
+    await add_key_value_redis(_status_key(status['job_id']), pack(status), expire=JOB_TIMEOUT + JOB_RESULT_TTL)
+
+
+async def get_load_job(job_id: str) -> dict:
+    status = await get_value_redis(_status_key(job_id))
+    if status is None:
+        raise HTTPException(status_code=404, detail='Unknown or expired load job.')
+    return unpack(status)
+
+
+async def start_load_job(provider: str, credentials: str, streamer: Streamer, user_id: str, org_id: str) -> dict:
+    """Queues a background crawl of one account and returns its initial status straight away"""
+    global _semaphore
+    job_id = secrets.token_urlsafe(16)
+    now = time.time()
+    claimed = await run_script_redis(
+        _CLAIM_SLOT_SCRIPT,
+        keys=[_slots_key(org_id)],
+        args=[job_id, now + JOB_TIMEOUT, JOB_MAX_PER_ORG, now, JOB_TIMEOUT],
+    )
+    if not claimed:
+        raise HTTPException(status_code=429, detail=f'This org already has {JOB_MAX_PER_ORG} load jobs in progress.')
+
+    expected = await get_value_redis(_size_key(provider, credentials))
+    status = {
+        'job_id': job_id,
+        'provider': provider,
+        'user_id': user_id,
+        'org_id': org_id,
+        'status': QUEUED,
+        'pages': 0,
+        'items': 0,
+        'chunks': 0,
+        'expected_items': None if expected is None else int(expected),
+        'eta_seconds': None,
+        'created_at': now,
+        'started_at': None,
+        'finished_at': None,
+        'error': None,
+    }
+    await _write_status(status)
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
+    _tasks[job_id] = asyncio.create_task(_run(status, credentials, streamer))
+    # let the task enter _run, a task cancelled before its first step would never record that it was cancelled
+    await asyncio.sleep(0)
+    return status
+
+
+async def _run(status: dict, credentials: str, streamer: Streamer) -> None:
+    job_id = status['job_id']
+    try:
+        async with _semaphore:
+            if await key_exists_redis(_cancel_key(job_id)):
+                raise asyncio.CancelledError
+            status['status'] = RUNNING
+            status['started_at'] = time.time()
+            await _write_status(status)
+            await asyncio.wait_for(_crawl(status, credentials, streamer), timeout=JOB_TIMEOUT)
+        status['status'] = SUCCEEDED
+        await add_key_value_redis(_size_key(status['provider'], credentials), status['items'])
+    except asyncio.CancelledError:
+        status['status'] = CANCELLED
+    except asyncio.TimeoutError:
+        status['status'] = FAILED
+        status['error'] = f'Load job ran longer than {JOB_TIMEOUT} seconds.'
+    except HTTPException as e:
+        status['status'] = FAILED
+        status['error'] = e.detail
+    except Exception as e:
+        status['status'] = FAILED
+        status['error'] = repr(e)
+    finally:
+        _tasks.pop(job_id, None)
+        status['finished_at'] = time.time()
+        status['eta_seconds'] = None
+        # shielded so a job cancelled at shutdown still records why it stopped
+        await asyncio.shield(_finish(status))
+
+
+async def _finish(status: dict) -> None:
+    await _write_status(status)
+    await run_script_redis(_RELEASE_SLOT_SCRIPT, keys=[_slots_key(status['org_id'])], args=[status['job_id']])
+    await delete_key_redis(_cancel_key(status['job_id']))
+
+
+async def _crawl(status: dict, credentials: str, streamer: Streamer) -> None:
+    job_id = status['job_id']
+    # counts the pages of this job only, the crawl's own tasks inherit the context
+    progress = track_upstream_pages()
+    chunk, last_write = [], time.time()
+    items = index_stream(status['provider'], status['user_id'], status['org_id'], streamer(credentials))
+    async for item in observe_stream(status['provider'], items):
+        chunk.append(item.to_dict())
+        status['items'] += 1
+        if len(chunk) >= JOB_CHUNK_SIZE:
+            await _flush(job_id, status, chunk)
+            chunk = []
+        if time.time() - last_write >= JOB_STATUS_INTERVAL:
+            last_write = time.time()
+            status['pages'] = progress['pages']
+            status['eta_seconds'] = _eta(status)
+            await _write_status(status)
+            # a cancel sent to another worker only reaches this one through Redis
+            if await key_exists_redis(_cancel_key(job_id)):
+                raise asyncio.CancelledError
+    if chunk:
+        await _flush(job_id, status, chunk)
+    status['pages'] = progress['pages']
+
+
+async def _flush(job_id: str, status: dict, items: list) -> None:
+    await add_key_value_redis(
+        _chunk_key(job_id, status['chunks']), pack(items), expire=JOB_TIMEOUT + JOB_RESULT_TTL
+    )
+    status['chunks'] += 1
+
+
+def _eta(status: dict) -> Optional[float]:
+    # only known when an earlier job of the same account tells how many items to expect
+    expected, done = status['expected_items'], status['items']
+    elapsed = time.time() - status['started_at']
+    if not expected or not done or done >= expected:
+        return None
+    return round((expected - done) * elapsed / done, 1)
+
+
+async def get_load_job_results(job_id: str, chunk: int) -> dict:
+    """Returns one chunk of a job's items, chunks are readable while the job is still running"""
+    status = await get_load_job(job_id)
+    if chunk < 0 or chunk >= status['chunks']:
+        raise HTTPException(status_code=404, detail=f'Load job {job_id} has no chunk {chunk} yet.')
+    items = await get_value_redis(_chunk_key(job_id, chunk))
+    if items is None:
+        raise HTTPException(status_code=404, detail='Load job results expired.')
+    more = chunk + 1 < status['chunks'] or status['status'] in (QUEUED, RUNNING)
+    return {'chunk': chunk, 'items': unpack(items), 'next_chunk': chunk + 1 if more else None}
+
+
+async def cancel_load_job(job_id: str) -> dict:
+    status = await get_load_job(job_id)
+    if status['status'] in FINISHED:
+        return status
+    task = _tasks.get(job_id)
+    if task is not None:
+        task.cancel()
+    else:
+        await add_key_value_redis(_cancel_key(job_id), 1, expire=JOB_TIMEOUT)
+    status['status'] = 'cancelling'
+    return status
+
+
+async def close_load_jobs() -> None:
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,234 @@
+import asyncio
+import base64
+import hashlib
+import os
+import secrets
+import time
+from typing import AsyncIterator, List, Optional
+
+from fastapi import HTTPException
+
+from integrations.integration_item import IntegrationItem
+from redis_client import add_key_value_redis, get_value_redis, get_values_redis
+from serialization import dumps, loads, pack, unpack
+
+# Items per stored chunk of a materialized result, a page reads only the chunks it overlaps
+LOAD_PAGE_CHUNK_SIZE = int(os.environ.get('LOAD_PAGE_CHUNK_SIZE', 500))
+# How long a materialized result can be paged through after its load started
+LOAD_PAGE_TTL = int(os.environ.get('LOAD_PAGE_TTL', 900))
+# How long a page request waits for the load to reach it, after that it returns the items there are so far
+LOAD_PAGE_WAIT_SECONDS = float(os.environ.get('LOAD_PAGE_WAIT_SECONDS', 30))
+LOAD_PAGE_DEFAULT_LIMIT = 100
+LOAD_PAGE_MAX_LIMIT = 1000
+
+# loads materializing in this worker, by result id. Other workers follow them through Redis.
+_loads = {}
+
+
+class _Materialization:
+    """State of a load being written to Redis chunk by chunk"""
+
+    def __init__(self, result_id: str, owner: str):
+        self.result_id = result_id
+        self.owner = owner
+        self.buffer = []  # the chunk being filled
+        self.chunks = 0
+        self.items = 0
+        self.complete = False
+        self.error = None
+        self.progress = asyncio.Event()
+        self.task = None
+
+    def notify(self) -> None:
+        self.progress.set()
+        self.progress = asyncio.Event()
+
+    def meta(self) -> dict:
+        return {
+            'owner': self.owner,
+            'chunks': self.chunks,
+            'items': self.chunks * LOAD_PAGE_CHUNK_SIZE if not self.complete else self.items,
+            'complete': self.complete,
+            'error': self.error,
+        }
+
+
+def _meta_key(result_id: str) -> str:
+    return f'load_result:{result_id}'
+
+
+def _chunk_key(result_id: str, chunk: int) -> str:
+    return f'load_result:{result_id}:chunk:{chunk}'
+
+
+def _owner(credentials: str) -> str:
+    # a cursor only pages through results loaded with the same credentials
+    return hashlib.sha256(credentials.encode('utf-8')).hexdigest()
+
+
+def compact(item: dict) -> dict:
+    """Drops the fields that are None, which most IntegrationItem fields are for most providers"""
+    return {key: value for key, value in item.items() if value is not None}
+
+
+def project(item: dict, fields: Optional[List[str]]) -> dict:
+    if not fields:
+        return item
+    # the id is always kept, without it a page of items cannot be matched to anything
+    return {key: item[key] for key in ('id', *fields) if key in item}
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Comma separated field names from a form parameter"""
+    if not fields:
+        return None
+    return [name.strip() for name in fields.split(',') if name.strip()]
+
+
+def _encode_cursor(result_id: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(dumps([result_id, offset])).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        result_id, offset = loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(result_id), int(offset)
+    except Exception:
+        raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+
+async def _write_chunk(materialization: _Materialization) -> None:
+    await add_key_value_redis(
+        _chunk_key(materialization.result_id, materialization.chunks), pack(materialization.buffer), expire=LOAD_PAGE_TTL
+    )
+    materialization.chunks += 1
+    materialization.buffer = []
+    await add_key_value_redis(_meta_key(materialization.result_id), pack(materialization.meta()), expire=LOAD_PAGE_TTL)
+
+
+async def _materialize(materialization: _Materialization, items: AsyncIterator[IntegrationItem]) -> None:
+    try:
+        async for item in items:
+            materialization.buffer.append(compact(item.to_dict()))
+            materialization.items += 1
+            if len(materialization.buffer) >= LOAD_PAGE_CHUNK_SIZE:
+                await _write_chunk(materialization)
+            materialization.notify()
+        if materialization.buffer:
+            await _write_chunk(materialization)
+        materialization.complete = True
+    except HTTPException as e:
+        materialization.error = e.detail
+    except Exception as e:
+        materialization.error = repr(e)
+    finally:
+        await asyncio.shield(
+            add_key_value_redis(_meta_key(materialization.result_id), pack(materialization.meta()), expire=LOAD_PAGE_TTL)
+        )
+        _loads.pop(materialization.result_id, None)
+        materialization.notify()
+
+
+async def _read_chunks(result_id: str, first: int, last: int) -> List[dict]:
+    if last < first:
+        return []
+    chunks = await get_values_redis([_chunk_key(result_id, chunk) for chunk in range(first, last + 1)])
+    if any(chunk is None for chunk in chunks):
+        raise HTTPException(status_code=404, detail='This result has expired, load it again.')
+    return [item for chunk in chunks for item in unpack(chunk)]
+
+
+async def _slice(result_id: str, chunks: int, buffer: List[dict], offset: int, limit: int) -> List[dict]:
+    # chunks are the items written to Redis so far, buffer the ones after them still in this worker
+    # a wait that timed out can leave offset past everything written, then the page starts at the buffer
+    first = min(offset // LOAD_PAGE_CHUNK_SIZE, chunks)
+    last = min((offset + limit - 1) // LOAD_PAGE_CHUNK_SIZE, chunks - 1)
+    items = await _read_chunks(result_id, first, last) + (buffer if last == chunks - 1 or first == chunks else [])
+    start = offset - first * LOAD_PAGE_CHUNK_SIZE
+    return items[start:start + limit]
+
+
+async def _page(result_id: str, owner: str, offset: int, limit: int) -> tuple:
+    """Waits until the load has limit items past offset, has finished, or LOAD_PAGE_WAIT_SECONDS passed.
+
+    Returns the page and the total number of items, None while the load is still running.
+    """
+    deadline = time.monotonic() + LOAD_PAGE_WAIT_SECONDS
+    while True:
+        remaining = deadline - time.monotonic()
+        materialization = _loads.get(result_id)
+        if materialization is not None:
+            if materialization.owner != owner:
+                raise HTTPException(status_code=404, detail='Unknown or expired cursor.')
+            if materialization.error is not None:
+                raise HTTPException(status_code=502, detail=materialization.error)
+            available = materialization.chunks * LOAD_PAGE_CHUNK_SIZE + len(materialization.buffer)
+            if available >= offset + limit or materialization.complete or remaining <= 0:
+                # taken before awaiting anything, so the chunks and the buffer match
+                chunks, buffer = materialization.chunks, list(materialization.buffer)
+                total = materialization.items if materialization.complete else None
+                return await _slice(result_id, chunks, buffer, offset, limit), total
+            progress = materialization.progress
+            try:
+                await asyncio.wait_for(progress.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        meta = await get_value_redis(_meta_key(result_id))
+        if meta is None:
+            raise HTTPException(status_code=404, detail='Unknown or expired cursor.')
+        meta = unpack(meta)
+        if meta['owner'] != owner:
+            raise HTTPException(status_code=404, detail='Unknown or expired cursor.')
+        if meta['error'] is not None:
+            raise HTTPException(status_code=502, detail=meta['error'])
+        if meta['complete'] or meta['items'] >= offset + limit or remaining <= 0:
+            return await _slice(result_id, meta['chunks'], [], offset, limit), meta['items'] if meta['complete'] else None
+        # the load runs in another worker, which only reports whole chunks
+        await asyncio.sleep(min(0.25, remaining))
+
+
+async def paged_load(
+    credentials: str,
+    items: AsyncIterator[IntegrationItem],
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[List[str]] = None,
+) -> dict:
+    """One page of a load result, in a stable order, with None fields dropped and projected to fields.
+
+    Without a cursor this starts materializing items in the background and answers as soon as the first page
+    is there; with a cursor items is not used. Returns {'items', 'next_cursor', 'complete', 'total'}, total is
+    only known once the load has finished.
+    """
+    limit = LOAD_PAGE_DEFAULT_LIMIT if limit is None else limit
+    if not 1 <= limit <= LOAD_PAGE_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f'limit must be between 1 and {LOAD_PAGE_MAX_LIMIT}.')
+    owner = _owner(credentials)
+    if cursor is None:
+        result_id, offset = secrets.token_urlsafe(16), 0
+        materialization = _loads[result_id] = _Materialization(result_id, owner)
+        # written up front so the cursor of the first page works in any worker, whether a chunk was written or not
+        await add_key_value_redis(_meta_key(result_id), pack(materialization.meta()), expire=LOAD_PAGE_TTL)
+        materialization.task = asyncio.create_task(_materialize(materialization, items))
+    else:
+        result_id, offset = _decode_cursor(cursor)
+
+    page, total = await _page(result_id, owner, offset, limit)
+    end = offset + len(page)
+    return {
+        'items': [project(item, fields) for item in page],
+        'next_cursor': None if total is not None and end >= total else _encode_cursor(result_id, end),
+        'complete': total is not None,
+        'total': total,
+    }
+
+
+async def close_load_pages() -> None:
+    tasks = [materialization.task for materialization in _loads.values() if materialization.task is not None]
+    # a task cancelled before it ever ran never reaches the finally of _materialize that forgets it
+    _loads.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,13 +1,28 @@
-from fastapi import FastAPI, Form, Request
-from fastapi.middleware.cors import CORSMiddleware
-
-from integrations.airtable import authorize_airtable, get_items_airtable, oauth2callback_airtable, get_airtable_credentials
-
-from integrations.notion import authorize_notion, get_items_notion, oauth2callback_notion, get_notion_credentials
-
-from integrations.hubspot import authorize_hubspot, get_hubspot_credentials, get_items_hubspot, oauth2callback_hubspot
+from typing import Optional
 
-app = FastAPI()
+from fastapi import FastAPI, Form, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+
+from bulk_load import bulk_load, parse_accounts
+from compression import CompressionMiddleware
+from coalesce import coalesce_key, coalesce_stats, coalesced, coalesced_stream
+from http_client import close_http_clients, http_client_stats, start_http_clients
+from item_index import close_item_index, index_items, index_stream, item_index_stats, search_items, similar_items
+from load_jobs import cancel_load_job, close_load_jobs, get_load_job, get_load_job_results, start_load_job
+from load_cache import cached_load, cached_stream, invalidate_load_cache, load_cache_stats
+from load_pages import close_load_pages, compact, paged_load, parse_fields, project
+from metrics import mark_worker_dead, metrics_payload, observe_load, observe_stream
+from serialization import FastJSONResponse, dumps, json_bytes_response
+from streaming import ndjson_response
+from resilience import resilience_stats
+from upstream import upstream_stats
+from vector_index import vector_index_stats
+from integrations.integration_item import IntegrationItemBatch
+# the integrations themselves (airtable.py, notion.py, hubspot.py) are only imported when first used, see registry.py
+from integrations.registry import ENABLED_PROVIDERS, PRELOAD_PROVIDERS, close_providers, get_provider, preload_providers
+
+app = FastAPI(default_response_class=FastJSONResponse)  # orjson when installed, see serialization.py
 
 origins = [
     "http://localhost:3000",  # React app address
@@ -21,75 +36,248 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.get('/')
-def read_root():
-    return {'Ping': 'Pong'}
-
-
-# Airtable
-@app.post('/integrations/airtable/authorize')
-async def authorize_airtable_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_airtable(user_id, org_id)
-
-@app.get('/integrations/airtable/oauth2callback')
-async def oauth2callback_airtable_integration(request: Request):
-    return await oauth2callback_airtable(request)
-
-@app.post('/integrations/airtable/credentials')
-async def get_airtable_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_airtable_credentials(user_id, org_id)
-
-@app.post('/integrations/airtable/load')
-async def get_airtable_items(credentials: str = Form(...)):
-    return await get_items_airtable(credentials)
-
-
-# Notion
-@app.post('/integrations/notion/authorize')
-async def authorize_notion_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_notion(user_id, org_id)
-
-@app.get('/integrations/notion/oauth2callback')
-async def oauth2callback_notion_integration(request: Request):
-    return await oauth2callback_notion(request)
+# brotli or gzip, whichever the browser prefers; streamed NDJSON is flushed line by line
+app.add_middleware(CompressionMiddleware, minimum_size=1000)
 
-@app.post('/integrations/notion/credentials')
-async def get_notion_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_notion_credentials(user_id, org_id)
+@app.on_event('startup')
+async def startup():
+    start_http_clients()
+    if PRELOAD_PROVIDERS:
+        preload_providers()
 
-@app.post('/integrations/notion/load')
-async def get_notion_items(credentials: str = Form(...)):
-    return await get_items_notion(credentials)
+@app.on_event('shutdown')
+async def shutdown():
+    await close_load_jobs()
+    await close_load_pages()
+    await close_providers()
+    await close_http_clients()
+    close_item_index()
+    mark_worker_dead()
 
+@app.get('/')
+def read_root():
+    return {'Ping': 'Pong'}
 
-
-# HubSpot
-@app.post('/integrations/hubspot/authorize')
-async def authorize_hubspot_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await authorize_hubspot(user_id, org_id)
-
- # Here we are. After the "CONNECT TO HUBSPOT" BUTTON WAS CLICKED, WE HAVE reached this endpoint where we have a function authorize_hubspot_integration() and we are unpacking the user_id and org_id which from the form data which was passed along with the post request when we pressed the "CONNECT TO HUBSPOT" button. Using this user_id and org_id as functional parameters we are calling another function authorize_hubspot().
-
- #If we go to the import statement at the top, then we can see that this function has been imported from the "integrations/hubspot.py" file. Now its time to go and see what this function does. 
-
-
-
-#this redirect url is responsible for invoking the below function that will exchange the authorisation_code in return for access token and refresh token. the argument that the oauth2callback function takes is the response url that hubspot has sent after being verified by the user
-@app.get('/integrations/hubspot/oauth2callback')
-async def oauth2callback_hubspot_integration(request: Request):
-    return await oauth2callback_hubspot(request)
-
-
-
-#now again we are here from frontend because handleWindowClosed function sent a post request to this endpoint. Now lets go and see whats happening inside the get_hubspot_credentials() function which again takes 2 functional args ---> user_id and org_id 
-@app.post('/integrations/hubspot/credentials')
-async def get_hubspot_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
-    return await get_hubspot_credentials(user_id, org_id)
-
-
-
-@app.post('/integrations/hubspot/load')  # changed from /hubspot/get_hubspot_items---> /hubspot/load
-async def load_slack_data_integration(credentials: str = Form(...)):
-    return await get_items_hubspot(credentials)
-
-# we came from data-form.js with the credentials and since the endpoint type was "hubspot" we reached this endpoint. This is calling a function get_items_hubspot and passing the credentials as a functional argument. So lets go to that function inside hubspot.py. 
+@app.get('/metrics')
+def read_metrics():
+    # Prometheus exposition format, aggregated across workers when PROMETHEUS_MULTIPROC_DIR is set
+    body, content_type = metrics_payload()
+    return Response(body, media_type=content_type)
+
+@app.get('/stats/http')
+def read_http_stats():
+    return http_client_stats()
+
+@app.get('/stats/upstream')
+def read_upstream_stats():
+    return upstream_stats()
+
+@app.get('/stats/resilience')
+def read_resilience_stats():
+    return resilience_stats()
+
+@app.get('/stats/load_cache')
+def read_load_cache_stats():
+    return load_cache_stats()
+
+@app.get('/stats/coalesce')
+def read_coalesce_stats():
+    return coalesce_stats()
+
+@app.get('/stats/item_index')
+def read_item_index_stats():
+    return item_index_stats()
+
+@app.get('/stats/vector_index')
+def read_vector_index_stats():
+    return vector_index_stats()
+
+@app.get('/integrations/items/search')
+async def search_items_integration(
+    org_id: str, user_id: str, q: str, provider: Optional[str] = None, type: Optional[str] = None,
+    limit: int = 50, cursor: Optional[str] = None,
+):
+    # full text over name, email, type and parent_path_or_name of every item loaded for the account, words match as prefixes
+    return await search_items(org_id, user_id, q, provider=provider, item_type=type, limit=limit, cursor=cursor)
+
+@app.get('/integrations/items/similar')
+async def similar_items_integration(org_id: str, user_id: str, q: str, limit: int = 10):
+    # the account's items nearest to q by cosine similarity of their character n-grams, so near misses and typos match too
+    return await similar_items(org_id, user_id, q, limit=limit)
+
+@app.get('/integrations/items')
+async def list_items_integration(
+    org_id: str, user_id: str, provider: Optional[str] = None, type: Optional[str] = None,
+    parent_id: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None,
+):
+    # the indexed items of the account filtered by provider, type and/or parent, in the order they were first indexed
+    return await search_items(org_id, user_id, provider=provider, item_type=type, parent_id=parent_id, limit=limit, cursor=cursor)
+
+@app.post('/integrations/{provider}/load/invalidate')
+async def invalidate_load_cache_integration(provider: str, credentials: str = Form(...)):
+    interface = get_provider(provider)
+    await invalidate_load_cache(provider, credentials)
+    for variant in interface.variants.values():
+        if variant.load is not None:
+            await invalidate_load_cache(variant.namespace, credentials)
+    return {'invalidated': True}
+
+@app.post('/integrations/{provider}/load/jobs')
+async def start_load_job_integration(provider: str, credentials: str = Form(...), user_id: str = Form(...), org_id: str = Form(...)):
+    # for accounts too big to load within one request: returns a job id, poll /integrations/load/jobs/{job_id}
+    interface = get_provider(provider)
+    if interface.prepare_credentials is not None:
+        credentials = await interface.prepare_credentials(credentials, user_id, org_id)
+    return await start_load_job(provider, credentials, interface.stream, user_id, org_id)
+
+@app.post('/integrations/load/bulk')
+async def bulk_load_integration(accounts: str = Form(...), refresh: bool = Form(False), fields: Optional[str] = Form(None)):
+    # accounts is a JSON array of {provider, credentials, user_id, org_id}: they are loaded concurrently, fairly across orgs,
+    # and each account's result (or error) is sent as one NDJSON line as soon as it finishes, see bulk_load.py
+    async def load(account):
+        provider, credentials = account['provider'], account['credentials']
+        user_id, org_id = account.get('user_id'), account.get('org_id')
+        interface = get_provider(provider)
+        if interface.prepare_credentials is not None:
+            credentials = await interface.prepare_credentials(credentials, user_id, org_id)
+        return await _indexed_load(provider, credentials, interface.load, refresh, user_id, org_id)
+    return ndjson_response(bulk_load(parse_accounts(accounts), load, parse_fields(fields)))
+
+@app.get('/integrations/load/jobs/{job_id}')
+async def get_load_job_integration(job_id: str):
+    return await get_load_job(job_id)
+
+@app.get('/integrations/load/jobs/{job_id}/results')
+async def get_load_job_results_integration(job_id: str, chunk: int = 0):
+    return await get_load_job_results(job_id, chunk)
+
+@app.delete('/integrations/load/jobs/{job_id}')
+async def cancel_load_job_integration(job_id: str):
+    return await cancel_load_job(job_id)
+
+def _items_response(items, format, fields=None):
+    # format=arrow sends the items as one Arrow IPC stream instead of a JSON array
+    if format == 'arrow':
+        return Response(IntegrationItemBatch.from_dicts(items).to_arrow_ipc(), media_type='application/vnd.apache.arrow.stream')
+    # fields (comma separated) keeps only those fields of each item, and drops the ones that are None
+    if fields:
+        projection = parse_fields(fields)
+        items = [project(compact(item), projection) for item in items]
+    # encoded straight to bytes, returning the list would send every item through jsonable_encoder first
+    return json_bytes_response(dumps(items))
+
+async def _load_response(credentials, items, stream, format, fields, limit, cursor):
+    # items is a lazy stream, nothing is crawled unless the response reads it
+    if limit is not None or cursor is not None:
+        # one page of a result materialized server side, pass next_cursor back (with the same credentials) for the next one
+        if format != 'json':
+            raise HTTPException(status_code=400, detail='Paged loads are only available as JSON.')
+        return json_bytes_response(dumps(await paged_load(credentials, items, limit, cursor, parse_fields(fields))))
+    if stream:
+        return ndjson_response(items)
+    return _items_response([item.to_dict() async for item in items], format, fields)
+
+async def _coalesced_load(provider, credentials, loader, refresh, on_fetched=None):
+    # identical loads already running in this or another worker share their result instead of crawling again
+    return await observe_load(provider, coalesced(
+        coalesce_key(provider, credentials, refresh),
+        lambda: cached_load(provider, credentials, loader, refresh=refresh, on_fetched=on_fetched),
+    ))
+
+async def _indexed_load(provider, credentials, loader, refresh, user_id, org_id, index_as=None):
+    # loads made for a known account are also written to its item index (see item_index.py). Only results fetched
+    # from the provider are: cache hits and results shared by another request were indexed when they were fetched.
+    async def index(items):
+        await index_items(index_as or provider, user_id, org_id, items)
+    return await _coalesced_load(provider, credentials, loader, refresh, index)
+
+def _require_account(user_id, org_id):
+    if not user_id or not org_id:
+        raise HTTPException(status_code=400, detail='user_id and org_id are required for incremental loads.')
+
+
+async def _load_integration(
+    provider, credentials, stream, refresh, format, incremental, user_id, org_id, fields, limit, cursor, variant_flags, record_fields,
+):
+    interface = get_provider(provider)
+    selected = [name for name, selected in variant_flags.items() if selected]
+    unknown = [name for name in selected if name not in interface.variants]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f'{provider} has no {unknown[0]} load.')
+    variant = interface.variants[selected[0]] if selected else None
+    if variant is not None and variant.load is None and not stream and limit is None and cursor is None:
+        # without a list loader the whole result would be collected into one response, it has no size bound
+        raise HTTPException(status_code=400, detail=f'The {selected[0]} load of {provider} is only available streamed (stream=true) or paged (limit).')
+    namespace = provider if variant is None else variant.namespace
+    # pages are tied to the credentials the browser sent, prepare_credentials may swap in a token that is refreshed between two pages
+    client_credentials = credentials
+    if interface.prepare_credentials is not None:
+        credentials = await interface.prepare_credentials(credentials, user_id, org_id)
+
+    if variant is not None and variant.load is None:
+        # a variant without a list loader is always streamed live
+        streamer = variant.stream(credentials, parse_fields(record_fields)) if variant.projection else variant.stream(credentials)
+        items = index_stream(provider, user_id, org_id, observe_stream(namespace, streamer))
+    elif incremental:
+        if interface.stream_delta is None:
+            raise HTTPException(status_code=400, detail=f'{provider} has no incremental load.')
+        _require_account(user_id, org_id)
+        items = index_stream(provider, user_id, org_id, observe_stream(namespace, interface.stream_delta(credentials, user_id, org_id)), complete=False)
+    elif stream or limit is not None or cursor is not None:
+        streamer = interface.stream if variant is None else variant.stream
+        # overlapping streamed loads share one crawl too, callers that join late replay what it streamed so far
+        # like _indexed_load, only what is streamed from the provider itself gets indexed
+        shared = coalesced_stream(
+            coalesce_key(namespace, credentials, 'stream', refresh),
+            lambda: cached_stream(namespace, credentials, lambda c: index_stream(provider, user_id, org_id, streamer(c)), refresh=refresh),
+        )
+        items = observe_stream(namespace, shared)
+    else:
+        # repeated loads of the same account are answered from the redis cache (see load_cache.py), and loads that overlap share one crawl (see coalesce.py)
+        loader = interface.load if variant is None else variant.load
+        items = await _indexed_load(namespace, credentials, loader, refresh, user_id, org_id, index_as=provider)
+        return _items_response(items, format, fields)
+    return await _load_response(client_credentials, items, stream, format, fields, limit, cursor)
+
+
+def _add_provider_routes(provider):
+    # the four routes of a provider; the first request to any of them imports its integration module
+
+    async def authorize_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await get_provider(provider).authorize(user_id, org_id)
+
+    async def oauth2callback_integration(request: Request):
+        return await get_provider(provider).oauth2callback(request)
+
+    async def get_credentials_integration(user_id: str = Form(...), org_id: str = Form(...)):
+        return await get_provider(provider).credentials(user_id, org_id)
+
+    async def load_integration(
+        credentials: str = Form(...),
+        stream: bool = Form(False), # opt-in: items are sent one JSON object per line as each page arrives
+        refresh: bool = Form(False), # skip the cached result and crawl again
+        format: str = Form('json'), # 'json' or 'arrow'
+        incremental: bool = Form(False), # only the items added/changed/removed since the last incremental load of this account
+        user_id: Optional[str] = Form(None), # with org_id, the items also land in the account's item index (see item_index.py)
+        org_id: Optional[str] = Form(None),
+        fields: Optional[str] = Form(None), # comma separated, e.g. 'id,name,email': only these fields, and none that are None
+        limit: Optional[int] = Form(None), # opt-in paging: at most this many items, plus a next_cursor to send back for the rest
+        cursor: Optional[str] = Form(None),
+        deep: bool = Form(False), # notion: also walk the block tree to fill in children, directory and parent_path_or_name
+        records: bool = Form(False), # airtable: every record of every table as well
+        record_fields: Optional[str] = Form(None), # airtable: comma separated record fields to fetch, the primary field by default
+    ):
+        return await _load_integration(
+            provider, credentials, stream, refresh, format, incremental, user_id, org_id, fields, limit, cursor,
+            {'deep': deep, 'records': records}, record_fields,
+        )
+
+    app.add_api_route(f'/integrations/{provider}/authorize', authorize_integration, methods=['POST'], name=f'authorize_{provider}_integration')
+    app.add_api_route(f'/integrations/{provider}/oauth2callback', oauth2callback_integration, methods=['GET'], name=f'oauth2callback_{provider}_integration')
+    app.add_api_route(f'/integrations/{provider}/credentials', get_credentials_integration, methods=['POST'], name=f'get_{provider}_credentials_integration')
+    app.add_api_route(f'/integrations/{provider}/load', load_integration, methods=['POST'], name=f'load_{provider}_integration')
+
+
+# Airtable, Notion and HubSpot, or whichever of them ENABLED_PROVIDERS lists
+for provider in ENABLED_PROVIDERS:
+    _add_provider_routes(provider)
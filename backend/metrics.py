@@ -0,0 +1,130 @@
+import functools
+import os
+import re
+import time
+from typing import AsyncIterator, Awaitable, List, TypeVar
+from urllib.parse import urlsplit
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+# With several uvicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers
+# (before they start): every worker then writes its samples there and /metrics aggregates all of them.
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+# At most this many distinct endpoint labels per provider, anything beyond is counted as 'other'
+MAX_ENDPOINTS_PER_PROVIDER = int(os.environ.get('METRICS_MAX_ENDPOINTS_PER_PROVIDER', 20))
+
+T = TypeVar('T')
+
+UPSTREAM_SECONDS = Histogram(
+    'upstream_request_seconds', 'Latency of single upstream API attempts', ['provider', 'endpoint'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+UPSTREAM_RESPONSES = Counter(
+    'upstream_responses_total', 'Upstream API attempts by response status, "error" for transport failures',
+    ['provider', 'endpoint', 'status'],
+)
+UPSTREAM_PAGES = Counter('upstream_pages_total', 'Successful upstream responses, one per page fetched', ['provider', 'endpoint'])
+UPSTREAM_HEDGES = Counter(
+    'upstream_hedges_total', 'Hedged upstream requests by whether the duplicate answered first ("won") or not',
+    ['provider', 'endpoint', 'outcome'],
+)
+# the worst state any live worker is in
+BREAKER_STATE = Gauge(
+    'upstream_breaker_state', 'Circuit breaker state per provider: 0 closed, 1 half open, 2 open', ['provider'],
+    multiprocess_mode='livemax',
+)
+BREAKER_OPENS = Counter(
+    'upstream_breaker_opens_total', 'Times a circuit breaker opened and started failing requests fast', ['provider'],
+)
+BREAKER_REJECTIONS = Counter(
+    'upstream_breaker_rejections_total', 'Upstream requests failed fast by an open circuit breaker', ['provider'],
+)
+LOAD_ITEMS = Histogram(
+    'load_items', 'Items returned per load', ['provider'],
+    buckets=(0, 10, 100, 1000, 10_000, 50_000, 100_000, 250_000, 1_000_000),
+)
+LOAD_SECONDS = Histogram(
+    'load_seconds', 'Duration of loads', ['provider'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+LOADS_IN_FLIGHT = Gauge('loads_in_flight', 'Loads currently running', ['provider'], multiprocess_mode='livesum')
+REDIS_SECONDS = Histogram(
+    'redis_command_seconds', 'Latency of Redis calls made through redis_client', ['command'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5),
+)
+NORMALIZE_SECONDS_PER_ITEM = Histogram(
+    'normalize_seconds_per_item', 'Time to map one raw provider object to an IntegrationItem, measured per page',
+    ['mapping'], buckets=(1e-7, 5e-7, 1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 1e-4, 1e-3),
+)
+
+# plain words and API versions stay, anything else in a path (ids of bases, pages, blocks...) becomes {id}
+_STATIC_SEGMENT = re.compile(r'[a-z_\-]+|v\d+|oauth2')
+_endpoints = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def _template(path: str) -> str:
+    return '/'.join(segment if not segment or _STATIC_SEGMENT.fullmatch(segment) else '{id}' for segment in path.split('/'))
+
+
+def endpoint_label(provider: str, url: str) -> str:
+    """Bounded endpoint label for an upstream URL, e.g. /v0/meta/bases/{id}/tables"""
+    endpoint = _template(urlsplit(url).path)
+    seen = _endpoints.setdefault(provider, set())
+    if endpoint not in seen:
+        if len(seen) >= MAX_ENDPOINTS_PER_PROVIDER:
+            return 'other'
+        seen.add(endpoint)
+    return endpoint
+
+
+async def observe_load(provider: str, load: Awaitable[List[T]]) -> List[T]:
+    """Awaits a load while counting it as in flight, then records its duration and item count"""
+    LOADS_IN_FLIGHT.labels(provider).inc()
+    started = time.perf_counter()
+    try:
+        items = await load
+    finally:
+        LOADS_IN_FLIGHT.labels(provider).dec()
+    LOAD_SECONDS.labels(provider).observe(time.perf_counter() - started)
+    LOAD_ITEMS.labels(provider).observe(len(items))
+    return items
+
+
+async def observe_stream(provider: str, items: AsyncIterator[T]) -> AsyncIterator[T]:
+    """Streaming counterpart of observe_load, the load lasts until the stream is exhausted or closed"""
+    LOADS_IN_FLIGHT.labels(provider).inc()
+    started, count, completed = time.perf_counter(), 0, False
+    try:
+        async for item in items:
+            count += 1
+            yield item
+        completed = True
+    finally:
+        LOADS_IN_FLIGHT.labels(provider).dec()
+        if completed:
+            LOAD_SECONDS.labels(provider).observe(time.perf_counter() - started)
+            LOAD_ITEMS.labels(provider).observe(count)
+
+
+def metrics_payload() -> tuple:
+    """Returns the exposition body and its content type for /metrics"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead() -> None:
+    # drops this worker's live gauges from the aggregate once it exits
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -1,17 +1,167 @@
+import functools
 import os
+import time
 import redis.asyncio as redis
+from redis.exceptions import ResponseError
 from kombu.utils.url import safequote
 
+from metrics import REDIS_SECONDS
+
 redis_host = safequote(os.environ.get('REDIS_HOST', 'localhost'))
-redis_client = redis.Redis(host=redis_host, port=6379, db=0)
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+
+# redis-py switches to the hiredis reply parser on its own whenever the hiredis package is installed
+redis_pool = redis.BlockingConnectionPool(
+    host=redis_host,
+    port=6379,
+    db=0,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_keepalive=True,
+    health_check_interval=30,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+def _timed(command):
+    # records the latency of every call into the redis_command_seconds histogram
+    def decorate(function):
+        @functools.wraps(function)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                REDIS_SECONDS.labels(command).observe(time.perf_counter() - started)
+        return timed
+    return decorate
 
+@_timed('set')
 async def add_key_value_redis(key, value, expire=None):
-    await redis_client.set(key, value)
-    if expire:
-        await redis_client.expire(key, expire)
+    await redis_client.set(key, value, ex=expire)
 
+@_timed('set_nx')
+async def add_key_value_if_absent_redis(key, value, expire=None):
+    # SET NX, True only for the caller that actually wrote the key
+    return bool(await redis_client.set(key, value, ex=expire, nx=True))
+
+@_timed('set_pipeline')
+async def add_key_values_redis(mapping, expire=None):
+    # one round trip for several SETs, each with its own expiry
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=expire)
+        await pipe.execute()
+
+@_timed('get')
 async def get_value_redis(key):
     return await redis_client.get(key)
 
+@_timed('mget')
+async def get_values_redis(keys):
+    return await redis_client.mget(keys)
+
+@_timed('delete')
 async def delete_key_redis(key):
     await redis_client.delete(key)
+
+@_timed('getdel')
+async def get_and_delete_redis(key):
+    try:
+        return await redis_client.getdel(key)
+    except ResponseError:
+        # servers older than 6.2 have no GETDEL, a MULTI/EXEC keeps it atomic and one round trip
+        async with redis_client.pipeline(transaction=True) as pipe:
+            value, _ = await pipe.get(key).delete(key).execute()
+        return value
+
+@_timed('rpush')
+async def append_list_redis(key, value, expire=None):
+    # RPUSH and EXPIRE in one round trip, the expiry restarts with every append
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.rpush(key, value)
+        if expire is not None:
+            pipe.expire(key, expire)
+        await pipe.execute()
+
+@_timed('lrange')
+async def get_list_range_redis(key, start=0, end=-1):
+    return await redis_client.lrange(key, start, end)
+
+@_timed('exists')
+async def key_exists_redis(key):
+    return bool(await redis_client.exists(key))
+
+@_timed('publish')
+async def publish_redis(channel, message):
+    # returns how many subscribers received the message
+    return await redis_client.publish(channel, message)
+
+def pubsub_redis():
+    return redis_client.pubsub()
+
+_scripts = {}
+
+@_timed('evalsha')
+async def run_script_redis(script, keys, args):
+    # EVALSHA with a one-time SCRIPT LOAD instead of shipping the script body on every call
+    registered = _scripts.get(script)
+    if registered is None or registered.registered_client is not redis_client:
+        registered = _scripts[script] = redis_client.register_script(script)
+    return await registered(keys=keys, args=args)
+
+_DELETE_IF_VALUE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_EXPIRE_IF_VALUE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+async def extend_key_if_value_redis(key, value, expire):
+    """Restarts the expiry of key only while it still holds value, False once it does not"""
+    return bool(await run_script_redis(_EXPIRE_IF_VALUE_SCRIPT, [key], [value, expire]))
+
+async def delete_key_if_value_redis(key, value):
+    """Deletes key only while it still holds value, e.g. a lock that may have expired and been taken by someone else"""
+    return bool(await run_script_redis(_DELETE_IF_VALUE_SCRIPT, [key], [value]))
+
+# KEYS[1] holds the JSON state written by authorize_*, KEYS[2:] are consumed along with it.
+# Nothing is deleted unless the 'state' field matches ARGV[1].
+_CONSUME_STATE_SCRIPT = """
+local saved = redis.call('GET', KEYS[1])
+if not saved then
+    return nil
+end
+-- values written by serialization.pack start with 0xC1 followed by msgpack, anything else is JSON
+local ok, decoded
+if string.byte(saved, 1) == 0xC1 then
+    ok, decoded = pcall(cmsgpack.unpack, string.sub(saved, 2))
+else
+    ok, decoded = pcall(cjson.decode, saved)
+end
+if not ok or type(decoded) ~= 'table' or decoded['state'] ~= ARGV[1] then
+    return nil
+end
+local values = {saved}
+for i = 2, #KEYS do
+    values[i] = redis.call('GET', KEYS[i]) or false
+end
+redis.call('DEL', unpack(KEYS))
+return values
+"""
+
+async def consume_state_redis(state_key, expected_state, *extra_keys):
+    """Verifies an OAuth state and deletes it, plus extra_keys, in one round trip.
+
+    Returns [saved_state, *extra_values], or None when the state is missing or does not match.
+    """
+    return await run_script_redis(_CONSUME_STATE_SCRIPT, [state_key, *extra_keys], [expected_state])
@@ -0,0 +1,263 @@
+import asyncio
+import collections
+import math
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from fastapi import HTTPException
+
+from http_client import READ_TIMEOUT
+from metrics import BREAKER_OPENS, BREAKER_REJECTIONS, BREAKER_STATE, UPSTREAM_HEDGES
+
+# An idempotent request still unanswered after its endpoint's p95 latency gets a duplicate, the first answer wins
+HEDGE_ENABLED = os.environ.get('UPSTREAM_HEDGE', 'true').lower() == 'true'
+HEDGE_QUANTILE = float(os.environ.get('UPSTREAM_HEDGE_QUANTILE', 0.95))
+HEDGE_MIN_DELAY = float(os.environ.get('UPSTREAM_HEDGE_MIN_DELAY', 0.05))
+HEDGE_MAX_DELAY = float(os.environ.get('UPSTREAM_HEDGE_MAX_DELAY', 5))
+# At most this share of an endpoint's requests is hedged, so a slow provider never gets much more load than usual
+HEDGE_BUDGET = float(os.environ.get('UPSTREAM_HEDGE_BUDGET', 0.1))
+# Latencies kept per endpoint, and how many an endpoint needs before it is hedged or gets its own timeout
+LATENCY_WINDOW = int(os.environ.get('UPSTREAM_LATENCY_WINDOW', 200))
+LATENCY_MIN_SAMPLES = int(os.environ.get('UPSTREAM_LATENCY_MIN_SAMPLES', 20))
+# An idempotent attempt gives up after this many times its endpoint's p99 latency, within the bounds.
+# Until the endpoint has enough samples the bound is the client's read timeout.
+TIMEOUT_MULTIPLIER = float(os.environ.get('UPSTREAM_TIMEOUT_MULTIPLIER', 4))
+TIMEOUT_MIN = float(os.environ.get('UPSTREAM_TIMEOUT_MIN', 2))
+TIMEOUT_MAX = float(os.environ.get('UPSTREAM_TIMEOUT_MAX', READ_TIMEOUT))
+# A provider's breaker opens when at least BREAKER_FAILURE_RATIO of its last BREAKER_WINDOW attempts failed
+# (transport errors, timeouts and 5xx), and lets one probe through after BREAKER_COOLDOWN seconds
+BREAKER_WINDOW = int(os.environ.get('UPSTREAM_BREAKER_WINDOW', 20))
+BREAKER_MIN_CALLS = int(os.environ.get('UPSTREAM_BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATIO = float(os.environ.get('UPSTREAM_BREAKER_FAILURE_RATIO', 0.5))
+BREAKER_COOLDOWN = float(os.environ.get('UPSTREAM_BREAKER_COOLDOWN', 30))
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class ProviderUnavailable(HTTPException):
+    """The provider itself failed (down, timing out, 5xx) or its breaker is open, as opposed to a rejected request.
+
+    Loads that fail with it fall back to the cached result, if there is one.
+    """
+
+    def __init__(self, provider: str, detail: str, status_code: int = 502, retry_after: Optional[float] = None):
+        headers = {'Retry-After': str(math.ceil(retry_after))} if retry_after is not None else None
+        super().__init__(status_code=status_code, detail=detail, headers=headers)
+        self.provider = provider
+
+
+class _Endpoint:
+    """Recent latencies of one provider endpoint, and how many of its requests were hedged"""
+
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        p95 = self.quantile(HEDGE_QUANTILE)
+        return None if p95 is None else min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95))
+
+    def timeout(self) -> float:
+        p99 = self.quantile(0.99)
+        return TIMEOUT_MAX if p99 is None else min(TIMEOUT_MAX, max(TIMEOUT_MIN, p99 * TIMEOUT_MULTIPLIER))
+
+    def stats(self) -> dict:
+        return {
+            'samples': len(self.latencies),
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(HEDGE_QUANTILE),
+            'hedge_delay': self.hedge_delay(),
+            'timeout': self.timeout(),
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'timeouts': self.timeouts,
+        }
+
+
+class CircuitBreaker:
+    """Per provider and per worker: closed -> open when too many recent attempts failed, open -> half open once
+    the cooldown has passed, then closed again if the single probe let through succeeds, open if it fails."""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = CLOSED
+        self.outcomes = collections.deque(maxlen=BREAKER_WINDOW)  # True for every attempt that succeeded
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        BREAKER_STATE.labels(provider).set(_STATE_VALUES[CLOSED])
+
+    def _set(self, state: str) -> None:
+        self.state = state
+        BREAKER_STATE.labels(self.provider).set(_STATE_VALUES[state])
+        if state == OPEN:
+            self.opened += 1
+            self.opened_at = time.monotonic()
+            BREAKER_OPENS.labels(self.provider).inc()
+        elif state == CLOSED:
+            self.outcomes.clear()
+
+    def _reject(self) -> None:
+        self.rejected += 1
+        BREAKER_REJECTIONS.labels(self.provider).inc()
+        retry_after = max(0.0, self.opened_at + BREAKER_COOLDOWN - time.monotonic())
+        raise ProviderUnavailable(
+            self.provider, f'{self.provider} is unavailable, retry later.', status_code=503, retry_after=retry_after
+        )
+
+    def allow(self) -> None:
+        """Raises ProviderUnavailable when the request must not reach the provider"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                self._reject()
+            self._set(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self.probing:
+                self._reject()
+            self.probing = True
+
+    def record(self, succeeded: bool) -> None:
+        if self.state == HALF_OPEN:
+            self.probing = False
+            self._set(CLOSED if succeeded else OPEN)
+            return
+        self.outcomes.append(succeeded)
+        failures = self.outcomes.count(False)
+        if (
+            self.state == CLOSED and len(self.outcomes) >= BREAKER_MIN_CALLS
+            and failures >= BREAKER_FAILURE_RATIO * len(self.outcomes)
+        ):
+            self._set(OPEN)
+
+    def abandon(self) -> None:
+        # the attempt was cancelled before it had an outcome, another request gets to probe
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            'state': self.state,
+            'recent_failures': self.outcomes.count(False),
+            'recent_attempts': len(self.outcomes),
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
+
+
+_endpoints = {}
+_breakers = {}
+
+
+def _endpoint(provider: str, endpoint: str) -> _Endpoint:
+    tracker = _endpoints.get((provider, endpoint))
+    if tracker is None:
+        tracker = _endpoints[(provider, endpoint)] = _Endpoint()
+    return tracker
+
+
+def breaker(provider: str) -> CircuitBreaker:
+    state = _breakers.get(provider)
+    if state is None:
+        state = _breakers[provider] = CircuitBreaker(provider)
+    return state
+
+
+async def _timed(tracker: _Endpoint, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    timeout = tracker.timeout()
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(send(), timeout=timeout)
+    except asyncio.TimeoutError:
+        tracker.timeouts += 1
+        raise httpx.ReadTimeout(f'No response within {timeout:.2f} seconds')
+    finally:
+        # a request cancelled because its hedge won still counts, with the time it had taken so far, so
+        # the window keeps seeing the slow requests it hedged instead of only the winners
+        tracker.latencies.append(time.perf_counter() - started)
+
+
+async def _hedged(
+    provider: str,
+    endpoint: str,
+    tracker: _Endpoint,
+    send: Callable[[], Awaitable[httpx.Response]],
+    take_token: Callable[[], Awaitable[bool]],
+) -> httpx.Response:
+    delay = tracker.hedge_delay() if HEDGE_ENABLED else None
+    primary = asyncio.ensure_future(_timed(tracker, send))
+    hedge = None
+    pending = {primary}
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            # only hedged within the budget and when the rate limit has a token to spare right now
+            if not done and tracker.hedges < HEDGE_BUDGET * tracker.requests and await take_token():
+                tracker.hedges += 1
+                hedge = asyncio.ensure_future(_timed(tracker, send))
+                pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if hedge is not None:
+                    tracker.hedge_wins += task is hedge
+                    UPSTREAM_HEDGES.labels(provider, endpoint, 'won' if task is hedge else 'lost').inc()
+                return task.result()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def resilient_send(
+    provider: str,
+    endpoint: str,
+    send: Callable[[], Awaitable[httpx.Response]],
+    idempotent: bool,
+    take_token: Callable[[], Awaitable[bool]],
+) -> httpx.Response:
+    """One attempt at an upstream request through the provider's circuit breaker.
+
+    Idempotent requests also get their endpoint's timeout and are hedged: a duplicate goes out once the endpoint's
+    p95 latency has passed, if take_token gets it a rate limit token, and whichever answers first is returned.
+    """
+    state = breaker(provider)
+    state.allow()
+    tracker = _endpoint(provider, endpoint)
+    tracker.requests += 1
+    try:
+        response = await (_hedged(provider, endpoint, tracker, send, take_token) if idempotent else send())
+    except httpx.TransportError:
+        state.record(False)
+        raise
+    except BaseException:
+        state.abandon()
+        raise
+    state.record(response.status_code < 500)
+    return response
+
+
+def resilience_stats() -> dict:
+    return {
+        'breakers': {provider: state.stats() for provider, state in _breakers.items()},
+        'endpoints': {
+            provider: {endpoint: tracker.stats() for (p, endpoint), tracker in _endpoints.items() if p == provider}
+            for provider in {p for p, _ in _endpoints}
+        },
+    }
@@ -0,0 +1,72 @@
+import json
+from datetime import datetime
+from typing import Any
+
+from fastapi.responses import JSONResponse, Response
+
+# orjson and msgpack are optional, every function here falls back to the stdlib json module without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 0xc1 is never used by msgpack, so it tells msgpack values apart from the JSON written before
+# (or by workers without msgpack installed)
+MSGPACK_MARKER = b'\xc1'
+
+
+def _default(value: Any) -> Any:
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is not None:
+        return to_dict()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(value: Any) -> bytes:
+    """JSON-encodes value to bytes, IntegrationItems included, without going through jsonable_encoder"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def pack(value: Any) -> bytes:
+    """Encodes a value for Redis, msgpack when available, JSON otherwise"""
+    if msgpack is not None:
+        return MSGPACK_MARKER + msgpack.packb(value, default=_default, use_bin_type=True)
+    return dumps(value)
+
+
+def unpack(data) -> Any:
+    """Decodes what pack wrote, whichever encoding was used"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data[:1] == MSGPACK_MARKER:
+        if msgpack is None:
+            raise RuntimeError('A msgpack value was read from Redis but msgpack is not installed.')
+        return msgpack.unpackb(data[1:], raw=False)
+    return loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def json_bytes_response(body: bytes, status_code: int = 200) -> Response:
+    # for bodies that are already encoded, FastAPI hands a Response through untouched
+    return Response(body, status_code=status_code, media_type='application/json')
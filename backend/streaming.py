@@ -0,0 +1,57 @@
+import asyncio
+from typing import AsyncIterator, List
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from integrations.integration_item import IntegrationItem
+from serialization import dumps
+
+_DONE = object()
+
+
+async def merge_async_iterators(iterators: List[AsyncIterator]) -> AsyncIterator:
+    """Yields values from several async iterators as soon as any of them produces one"""
+    queue = asyncio.Queue(maxsize=len(iterators))
+
+    async def drain(iterator):
+        try:
+            async for value in iterator:
+                await queue.put((value, None))
+        except Exception as e:
+            await queue.put((_DONE, e))
+        else:
+            await queue.put((_DONE, None))
+
+    tasks = [asyncio.create_task(drain(iterator)) for iterator in iterators]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            value, error = await queue.get()
+            if error is not None:
+                raise error
+            if value is _DONE:
+                remaining -= 1
+                continue
+            yield value
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _ndjson_lines(items: AsyncIterator[IntegrationItem]) -> AsyncIterator[bytes]:
+    try:
+        async for item in items:
+            yield dumps(item) + b'\n'
+    except HTTPException as e:
+        # the 200 is long gone: the lines so far are a partial result, and the last line says so. Provider outages
+        # and rejected requests (an expired token, a 4xx from the provider) alike.
+        yield dumps({'error': e.detail, 'status_code': e.status_code, 'partial': True}) + b'\n'
+
+
+def ndjson_response(items: AsyncIterator[IntegrationItem]) -> StreamingResponse:
+    """Streams IntegrationItems to the client one JSON object per line as they are produced.
+
+    When the load fails mid-stream, the last line is {"error", "status_code", "partial": true}.
+    """
+    return StreamingResponse(_ndjson_lines(items), media_type='application/x-ndjson')
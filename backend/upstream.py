@@ -0,0 +1,235 @@
+import asyncio
+import email.utils
+import hashlib
+import math
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+
+from http_client import get_http_client
+from metrics import UPSTREAM_PAGES, UPSTREAM_RESPONSES, UPSTREAM_SECONDS, endpoint_label
+from redis_client import add_key_value_redis, run_script_redis
+from resilience import ProviderUnavailable, resilient_send
+
+# Requests per second and burst size of each provider's per-token bucket, shared by every worker through Redis
+RATE_LIMITS = {
+    # Airtable allows 50 requests/s per token, and 5 requests/s per base (the base's scope below)
+    'airtable': (float(os.environ.get('AIRTABLE_RATE_PER_SECOND', 50)), int(os.environ.get('AIRTABLE_RATE_BURST', 50))),
+    'notion': (float(os.environ.get('NOTION_RATE_PER_SECOND', 3)), int(os.environ.get('NOTION_RATE_BURST', 3))),
+    'hubspot': (float(os.environ.get('HUBSPOT_RATE_PER_SECOND', 10)), int(os.environ.get('HUBSPOT_RATE_BURST', 100))),
+}
+# Requests per second and burst size of each scope of a token (see upstream_request), on top of the token's own bucket.
+# Airtable limits every base on its own, HubSpot's CRM search has a lower limit of its own than the rest of its API.
+SCOPE_RATE_LIMITS = {
+    'airtable': (float(os.environ.get('AIRTABLE_BASE_RATE_PER_SECOND', 5)), int(os.environ.get('AIRTABLE_BASE_RATE_BURST', 5))),
+    'hubspot': (float(os.environ.get('HUBSPOT_SEARCH_RATE_PER_SECOND', 4)), int(os.environ.get('HUBSPOT_SEARCH_RATE_BURST', 4))),
+}
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 5))
+BACKOFF_BASE = float(os.environ.get('UPSTREAM_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.environ.get('UPSTREAM_BACKOFF_MAX', 30))
+
+# Takes one token from KEYS[1] unless KEYS[2] (set after a 429) is still paused.
+# Returns 0 when a token was taken, otherwise how many milliseconds to wait before asking again.
+_ACQUIRE_SCRIPT = """
+local paused = redis.call('PTTL', KEYS[2])
+if paused > 0 then
+    return paused
+end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+if tokens < 1 then
+    return math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return 0
+"""
+
+_stats = {
+    provider: {'requests': 0, 'queued': 0, 'throttled_seconds': 0.0, 'retries': 0, 'rate_limited': 0, 'failures': 0}
+    for provider in RATE_LIMITS
+}
+
+# Set by whoever wants to count the pages a crawl fetched (see load_jobs.py), inherited by the crawl's tasks
+_progress: ContextVar[Optional[dict]] = ContextVar('upstream_progress', default=None)
+
+
+class UpstreamRejected(HTTPException):
+    """The provider answered with a 4xx, or still with a 429 once the retries ran out. The client gets a 502, the
+    provider's own status and body are kept for callers that tell the errors apart."""
+
+    def __init__(self, provider: str, response: httpx.Response):
+        super().__init__(
+            status_code=502, detail=f'{provider} request failed: {response.status_code} - {response.text[:500]}'
+        )
+        self.provider = provider
+        self.upstream_status = response.status_code
+        self.upstream_body = response.text[:500]
+
+
+def track_upstream_pages() -> dict:
+    """Counts successful upstream responses made from the current context from now on"""
+    progress = {'pages': 0}
+    _progress.set(progress)
+    return progress
+
+
+def _bucket(provider: str, access_token: Optional[str], scope: Optional[str] = None) -> str:
+    # requests made before there is an access token (the OAuth code exchange) share one app-wide bucket
+    digest = hashlib.sha256((access_token or 'app').encode('utf-8')).hexdigest()[:32]
+    return f'{provider}:{digest}' if scope is None else f'{provider}:{digest}:{scope}'
+
+
+async def _take_token(provider: str, bucket: str, scoped: bool = False) -> int:
+    rate, burst = SCOPE_RATE_LIMITS.get(provider, RATE_LIMITS[provider]) if scoped else RATE_LIMITS[provider]
+    return await run_script_redis(
+        _ACQUIRE_SCRIPT,
+        keys=[f'upstream_bucket:{bucket}', f'upstream_pause:{bucket}'],
+        args=[rate, burst, int(time.time() * 1000)],
+    )
+
+
+async def _acquire(provider: str, bucket: str, scoped: bool = False) -> None:
+    stats = _stats[provider]
+    stats['queued'] += 1
+    try:
+        while True:
+            wait_ms = await _take_token(provider, bucket, scoped)
+            if not wait_ms:
+                return
+            stats['throttled_seconds'] += wait_ms / 1000
+            await asyncio.sleep(wait_ms / 1000)
+    finally:
+        stats['queued'] -= 1
+
+
+async def _pause(bucket: str, seconds: float) -> None:
+    # every worker sharing this token backs off, not just the one that saw the 429
+    await add_key_value_redis(f'upstream_pause:{bucket}', 1, expire=max(1, math.ceil(seconds)))
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _hubspot_exhausted_for(response: httpx.Response) -> Optional[float]:
+    """How long to hold off when HubSpot reports its rate limit window as used up"""
+    headers = response.headers
+    if headers.get('X-HubSpot-RateLimit-Secondly-Remaining') == '0':
+        return 1.0
+    if headers.get('X-HubSpot-RateLimit-Remaining') == '0':
+        return int(headers.get('X-HubSpot-RateLimit-Interval-Milliseconds', 10000)) / 1000
+    return None
+
+
+def _backoff(attempt: int) -> float:
+    # full jitter, so workers that were throttled together do not retry together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+async def upstream_request(
+    provider: str,
+    access_token: Optional[str],
+    method: str,
+    url: str,
+    idempotent: Optional[bool] = None,
+    scope: Optional[str] = None,
+    **kwargs,
+) -> httpx.Response:
+    """Sends a request to a provider API through its shared rate limit, retrying 429s and transient failures.
+
+    Raises an HTTPException instead of returning an error response, so callers never build partial results, and
+    its ProviderUnavailable subclass when the provider itself is failing or its circuit breaker is open.
+    Idempotent requests are also hedged and time out per endpoint, see resilience.py.
+    scope gives requests their own bucket under the token, for limits that apply per resource (e.g. per Airtable base)
+    or per kind of request (HubSpot's search). Those requests take from both, see SCOPE_RATE_LIMITS.
+    """
+    if idempotent is None:
+        idempotent = method == 'GET'
+    client = get_http_client(provider)
+    token_bucket = _bucket(provider, access_token)
+    bucket = token_bucket if scope is None else _bucket(provider, access_token, scope)
+    stats = _stats[provider]
+    endpoint = endpoint_label(provider, url)
+    latency = UPSTREAM_SECONDS.labels(provider, endpoint)
+
+    def send():
+        stats['requests'] += 1
+        return client.request(method, url, **kwargs)
+
+    async def take_spare_token():
+        # a hedge never waits for the rate limit, it is only worth sending straight away
+        if scope is not None and await _take_token(provider, bucket, scoped=True):
+            return False
+        return not await _take_token(provider, token_bucket)
+
+    for attempt in range(MAX_RETRIES + 1):
+        if scope is not None:
+            # the scope's bucket first, so a request waiting on it does not hold one of the token's
+            await _acquire(provider, bucket, scoped=True)
+        await _acquire(provider, token_bucket)
+        started = time.perf_counter()
+        try:
+            response = await resilient_send(provider, endpoint, send, idempotent, take_spare_token)
+        except httpx.TransportError as e:
+            UPSTREAM_RESPONSES.labels(provider, endpoint, 'error').inc()
+            if not idempotent or attempt == MAX_RETRIES:
+                stats['failures'] += 1
+                raise ProviderUnavailable(provider, f'{provider} request failed: {e!r}')
+            stats['retries'] += 1
+            await asyncio.sleep(_backoff(attempt))
+            continue
+
+        latency.observe(time.perf_counter() - started)
+        UPSTREAM_RESPONSES.labels(provider, endpoint, str(response.status_code)).inc()
+
+        if provider == 'hubspot':
+            exhausted_for = _hubspot_exhausted_for(response)
+            if exhausted_for:
+                # the headers describe the token's window, whatever scope the request was in
+                await _pause(token_bucket, exhausted_for)
+
+        retryable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+        if retryable and attempt < MAX_RETRIES:
+            stats['retries'] += 1
+            delay = _retry_after(response) or _backoff(attempt)
+            if response.status_code == 429:
+                stats['rate_limited'] += 1
+                await _pause(bucket, delay)
+            else:
+                await asyncio.sleep(delay)
+            continue
+
+        if response.status_code >= 500:
+            stats['failures'] += 1
+            raise ProviderUnavailable(provider, f'{provider} request failed: {response.status_code} - {response.text[:500]}')
+        if response.status_code >= 400:
+            stats['failures'] += 1
+            raise UpstreamRejected(provider, response)
+        UPSTREAM_PAGES.labels(provider, endpoint).inc()
+        progress = _progress.get()
+        if progress is not None:
+            progress['pages'] += 1
+        return response
+
+
+def upstream_stats() -> dict:
+    return {provider: dict(stats) for provider, stats in _stats.items()}
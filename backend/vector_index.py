@@ -0,0 +1,276 @@
+import collections
+import contextlib
+import fcntl
+import functools
+import hashlib
+import os
+import re
+from typing import Iterator, List, Optional
+
+# numpy is imported by the functions that use it, so starting a worker does not pay for it until the first
+# item is vectorized or searched
+# Every item written to the item index also gets a vector, so items can be found by how close they are to a query
+# rather than by exact words. Vectors are kept per account in a memory-mapped file that all workers read.
+# Set VECTOR_INDEX_PATH to '' to turn the vector index off.
+VECTOR_INDEX_PATH = os.environ.get('VECTOR_INDEX_PATH', 'vector_index')
+# Width of the vectors. A query reads 4 bytes per dimension of every item of the account, 128 keeps 1M items at 512 MB.
+# Changing it starts new, empty files, the next load of each account fills them again.
+VECTOR_INDEX_DIMENSIONS = int(os.environ.get('VECTOR_INDEX_DIMENSIONS', 128))
+# A file is rewritten without its deleted rows once they are more than this share of it
+VECTOR_INDEX_COMPACT_RATIO = float(os.environ.get('VECTOR_INDEX_COMPACT_RATIO', 0.5))
+VECTOR_INDEX_MAX_LIMIT = 100
+
+# character n-grams of these sizes are hashed into the vector, so 'proj' is close to 'Projects' and typos still match
+NGRAM_SIZES = (3, 4)
+FIELD_WEIGHTS = {'name': 1.0, 'email': 0.75, 'parent_path_or_name': 0.5, 'type': 0.25}
+
+_DELETED = -1
+_SPACES = re.compile(r'\s+')
+_MAX_READERS = 64
+_MAX_WRITERS = 8
+
+_readers = collections.OrderedDict()  # account file -> (inode, size, memmap)
+_writers = collections.OrderedDict()  # account file -> _Positions, only used by the item index writer thread
+_stats = {'vectorized': 0, 'unchanged': 0, 'deleted': 0, 'compactions': 0, 'queries': 0}
+
+
+@functools.lru_cache(maxsize=None)
+def _row():
+    import numpy as np
+
+    # one row per item: its item index rowid (-1 once deleted) and its L2-normalized vector
+    return np.dtype([('key', '<i8'), ('vector', '<f4', (VECTOR_INDEX_DIMENSIONS,))])
+
+
+def _mix(hashes: 'np.ndarray') -> 'np.ndarray':
+    import numpy as np
+
+    # murmur3's finalizer, spreads the FNV hashes of short n-grams over all 32 bits
+    hashes = hashes ^ (hashes >> 16)
+    hashes = hashes * np.uint32(0x85EBCA6B)
+    hashes = hashes ^ (hashes >> 13)
+    hashes = hashes * np.uint32(0xC2B2AE35)
+    return hashes ^ (hashes >> 16)
+
+
+def _vectorize(texts: List[List[tuple]]) -> 'np.ndarray':
+    """texts[i] is the (text, weight) pairs of row i. Every n-gram of every text is hashed at once with array
+    arithmetic (deterministic, unlike hash(), so all workers agree), then summed into its row."""
+    import numpy as np
+
+    segments, segment_rows, segment_weights = [], [], []
+    for row, fields in enumerate(texts):
+        for text, weight in fields:
+            segments.append(f' {_SPACES.sub(" ", text.lower()).strip()} '.encode('utf-8'))
+            segment_rows.append(row)
+            segment_weights.append(weight)
+    vectors = np.zeros(len(texts) * VECTOR_INDEX_DIMENSIONS, dtype=np.float64)
+    if segments:
+        data = np.frombuffer(b''.join(segments), dtype=np.uint8).astype(np.uint32)
+        lengths = np.array([len(segment) for segment in segments])
+        segment_of = np.repeat(np.arange(len(segments)), lengths)
+        offset = np.arange(len(data)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        for size in NGRAM_SIZES:
+            count = len(data) - size + 1
+            if count <= 0:
+                continue
+            hashes = np.full(count, 0x811C9DC5, dtype=np.uint32)
+            for i in range(size):
+                hashes = (hashes ^ data[i:i + count]) * np.uint32(0x01000193)  # FNV-1a, wrapping like C
+            # n-grams running into the next text are not n-grams
+            inside = offset[:count] + size <= lengths[segment_of[:count]]
+            hashes, segments_in = _mix(hashes[inside]), segment_of[:count][inside]
+            # the top bit is the sign, so colliding n-grams cancel out on average instead of adding up
+            signs = np.where(hashes & np.uint32(0x80000000), -1.0, 1.0)
+            cells = np.array(segment_rows)[segments_in] * VECTOR_INDEX_DIMENSIONS + hashes % VECTOR_INDEX_DIMENSIONS
+            vectors += np.bincount(cells, weights=signs * np.array(segment_weights)[segments_in], minlength=len(vectors))
+    vectors = vectors.reshape(len(texts), VECTOR_INDEX_DIMENSIONS).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def vectorize_items(items: List[dict]) -> 'np.ndarray':
+    """One L2-normalized float32 row per item, from its name, email, type and parent_path_or_name"""
+    return _vectorize([
+        [(item[field], weight) for field, weight in FIELD_WEIGHTS.items() if isinstance(item.get(field), str)]
+        for item in items
+    ])
+
+
+def vectorize_query(query: str) -> 'np.ndarray':
+    return _vectorize([[(query, 1.0)]])[0]
+
+
+def _path(org_id: str, user_id: str) -> str:
+    digest = hashlib.sha256(f'{org_id}\0{user_id}'.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(VECTOR_INDEX_PATH, digest, f'vectors-{VECTOR_INDEX_DIMENSIONS}.bin')
+
+
+class _Positions:
+    """Where each key of an account's file is, as far as this worker knows"""
+
+    def __init__(self):
+        self.inode = None
+        self.rows = 0
+        self.deleted = 0
+        self.by_key = {}
+
+    def sync(self, path: str) -> None:
+        import numpy as np
+
+        # other workers may have appended rows or compacted the file since this worker last wrote to it. Rows they
+        # deleted in place are not seen, deleting them again is harmless.
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.__init__()
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.rows * _row().itemsize:
+            self.__init__()
+            self.inode = stat.st_ino
+        rows = stat.st_size // _row().itemsize
+        if rows > self.rows:
+            keys = np.fromfile(path, dtype=_row(), count=rows - self.rows, offset=self.rows * _row().itemsize)['key']
+            for row, key in enumerate(keys.tolist(), start=self.rows):
+                if key == _DELETED:
+                    self.deleted += 1
+                else:
+                    self.by_key[key] = row
+            self.rows = rows
+
+
+@contextlib.contextmanager
+def _locked(path: str) -> Iterator[_Positions]:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(os.path.join(os.path.dirname(path), 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # one writer per account across workers
+        positions = _writers.pop(path, None) or _Positions()
+        _writers[path] = positions
+        while len(_writers) > _MAX_WRITERS:
+            _writers.popitem(last=False)
+        positions.sync(path)
+        yield positions
+
+
+def _delete_rows(path: str, positions: _Positions, rows: List[int]) -> None:
+    import numpy as np
+
+    if not rows:
+        return
+    mapped = np.memmap(path, dtype=_row(), mode='r+', shape=(positions.rows,))
+    mapped['key'][rows] = _DELETED
+    # a zero vector scores 0 against every query, so searches never need to look at the keys of all rows
+    mapped['vector'][rows] = 0
+    del mapped
+    positions.deleted += len(rows)
+    _stats['deleted'] += len(rows)
+
+
+def _append(path: str, positions: _Positions, keys: List[int], vectors: 'np.ndarray') -> None:
+    import numpy as np
+
+    records = np.empty(len(keys), dtype=_row())
+    records['key'] = keys
+    records['vector'] = vectors
+    with open(path, 'ab') as f:
+        f.write(records.tobytes())
+    if positions.inode is None:
+        positions.inode = os.stat(path).st_ino
+    for row, key in enumerate(keys, start=positions.rows):
+        positions.by_key[key] = row
+    positions.rows += len(keys)
+
+
+def _compact(path: str, positions: _Positions) -> None:
+    import numpy as np
+
+    if positions.deleted <= max(1000, VECTOR_INDEX_COMPACT_RATIO * positions.rows):
+        return
+    records = np.fromfile(path, dtype=_row(), count=positions.rows)
+    records = records[records['key'] != _DELETED]
+    # readers still holding the old file keep a valid mapping of it, and map the new one on their next query
+    records.tofile(f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    positions.__init__()
+    positions.sync(path)
+    _stats['compactions'] += 1
+
+
+def update_vectors(org_id: str, user_id: str, keys: List[int], items: List[dict]) -> None:
+    """Adds or replaces the vectors of items, keys[i] being the item index rowid of items[i]. Blocking."""
+    import numpy as np
+
+    if not keys:
+        return
+    vectors = vectorize_items(items)
+    path = _path(org_id, user_id)
+    with _locked(path) as positions:
+        rows = [positions.by_key.get(key) for key in keys]
+        known = [i for i, row in enumerate(rows) if row is not None]
+        unchanged = set()
+        if known:
+            mapped = np.memmap(path, dtype=_row(), mode='r', shape=(positions.rows,))
+            same = (mapped['vector'][[rows[i] for i in known]] == vectors[known]).all(axis=1)
+            unchanged = {i for i, equal in zip(known, same.tolist()) if equal}
+            del mapped
+        # a changed item is deleted and appended, rows never change size
+        _delete_rows(path, positions, [rows[i] for i in known if i not in unchanged])
+        changed = [i for i in range(len(keys)) if i not in unchanged]
+        if changed:
+            _append(path, positions, [keys[i] for i in changed], vectors[changed])
+        _compact(path, positions)
+    _stats['vectorized'] += len(changed)
+    _stats['unchanged'] += len(unchanged)
+
+
+def delete_vectors(org_id: str, user_id: str, keys: List[int]) -> None:
+    if not keys:
+        return
+    path = _path(org_id, user_id)
+    with _locked(path) as positions:
+        rows = [positions.by_key.pop(key) for key in keys if key in positions.by_key]
+        _delete_rows(path, positions, rows)
+        _compact(path, positions)
+
+
+def _mapped(path: str) -> Optional['np.memmap']:
+    import numpy as np
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cached = _readers.get(path)
+    if cached is not None and cached[:2] == (stat.st_ino, stat.st_size):
+        _readers.move_to_end(path)
+        return cached[2]
+    rows = stat.st_size // _row().itemsize
+    if not rows:
+        return None
+    # rows deleted in place show through the shared mapping, appended rows and compactions need a new one
+    mapped = np.memmap(path, dtype=_row(), mode='r', shape=(rows,))
+    _readers[path] = (stat.st_ino, stat.st_size, mapped)
+    while len(_readers) > _MAX_READERS:
+        _readers.popitem(last=False)
+    return mapped
+
+
+def search_vectors(org_id: str, user_id: str, query: str, limit: int) -> List[tuple]:
+    """The (key, score) of the limit items of the account most similar to query, best first. Blocking."""
+    import numpy as np
+
+    mapped = _mapped(_path(org_id, user_id))
+    _stats['queries'] += 1
+    if mapped is None:
+        return []
+    scores = mapped['vector'] @ vectorize_query(query)
+    limit = min(limit, len(scores))
+    top = np.argpartition(scores, -limit)[-limit:]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    top = top[scores[top] > 0]  # deleted rows and items sharing nothing with the query score 0
+    keys = mapped['key'][top]
+    return [(key, score) for key, score in zip(keys.tolist(), scores[top].tolist()) if key != _DELETED]
+
+
+def vector_index_stats() -> dict:
+    return dict(_stats)
@@ -0,0 +1,22 @@
+from typing import Optional
+
+from redis_client import add_key_value_redis, get_value_redis
+
+# Values written to IntegrationItem.delta by incremental loads
+DELTA_ADDED = 'added'
+DELTA_CHANGED = 'changed'
+DELTA_REMOVED = 'removed'
+
+
+def watermark_key(provider: str, org_id: str, user_id: str) -> str:
+    return f'{provider}_watermark:{org_id}:{user_id}'
+
+
+async def get_watermark(provider: str, org_id: str, user_id: str) -> Optional[str]:
+    """Returns the last stored high-watermark for an account, or None before its first sync"""
+    watermark = await get_value_redis(watermark_key(provider, org_id, user_id))
+    return None if watermark is None else watermark.decode('utf-8')
+
+
+async def set_watermark(provider: str, org_id: str, user_id: str, value: str) -> None:
+    await add_key_value_redis(watermark_key(provider, org_id, user_id), value)
@@ -1,4 +1,4 @@
-import { useState } from 'react';
+import { useRef, useState } from 'react';
 import {
     Box, 
     Typography, 
@@ -6,7 +6,6 @@ import {
 } 
 
 from '@mui/material';
-import axios from 'axios';
 import { HubspotContactsDisplay } from './HubspotContactsDisplay';
 const endpointMapping = {
     'Notion': 'notion',
@@ -14,23 +13,77 @@ const endpointMapping = {
     'Hubspot': 'hubspot',
 };
 
-export const DataForm = ({ integrationType, credentials }) => {
+export const DataForm = ({ integrationType, credentials, user, org }) => {
     const [loadedData, setLoadedData] = useState(null);
+    const rowsRef = useRef([]); // every row received so far, appended in place
+    const frameRef = useRef(null);
     const endpoint = endpointMapping[integrationType]; //the endpoint is chosen from the map, if you remember from our integration.js we had passed down the integration type which we actually set inside the hubspot.js file
 
+    // publishes the rows at most once per animation frame, copying the whole array for every chunk would be quadratic on big accounts
+    const publishRows = () => {
+        if (frameRef.current === null) {
+            frameRef.current = requestAnimationFrame(() => {
+                frameRef.current = null;
+                setLoadedData(rowsRef.current.slice());
+            });
+        }
+    };
+
     const handleLoad = async () => {
         try {
             const formData = new FormData();
             formData.append('credentials', JSON.stringify(credentials));
-            const response = await axios.post(`http://localhost:8000/integrations/${endpoint}/load`, formData);
+            formData.append('stream', 'true');
+            formData.append('user_id', user);
+            formData.append('org_id', org);
             // like always when we are hitting an endpoint we are required to carry some FORMDATA required for that endpoint 
             //in our case since we loading the data from our integration (HUBSPOT) we obviously need to send credentials. As of now its in json format. So we have to stringify it (convert into string before passing it to the endpoint).
+            //user_id and org_id let the backend find this account's server side state (for hubspot: the access token it keeps refreshed for us)
+            //we also ask for the streaming mode, so the backend sends one item per line (NDJSON) as soon as each page arrives instead of one big JSON body at the end
 
             //NOW LETS GO AND SEE WHATS HAPPENING at the http://localhost:8000/integrations/${hubspot}/load endpoint
 
-            const data = response.data;
-            setLoadedData(data);
-            // Axios automatically parses JSON responses, so response.data will be a JavaScript object containing all the contact information
+            const response = await fetch(`http://localhost:8000/integrations/${endpoint}/load`, {
+                method: 'POST',
+                body: formData,
+            });
+            if (!response.ok) {
+                const error = await response.json();
+                throw { response: { data: error } };
+            }
+            // axios waits for the whole body, so we use fetch here to read the stream chunk by chunk
+
+            rowsRef.current = [];
+            setLoadedData([]);
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                const lines = buffer.split('\n');
+                buffer = lines.pop(); // the last piece may be a half received line, keep it for the next chunk
+                for (const line of lines) {
+                    if (line.trim()) {
+                        const row = JSON.parse(line);
+                        if (row.error) {
+                            // the backend failed mid-stream: the last line is the error, not a row, the rows before it are only part of the account
+                            reader.cancel();
+                            throw { response: { data: { detail: row.error } } };
+                        }
+                        rowsRef.current.push(row);
+                    }
+                }
+                if (done) {
+                    break;
+                }
+                publishRows(); // rows show up as soon as the browser paints again
+            }
+            if (frameRef.current !== null) {
+                cancelAnimationFrame(frameRef.current);
+                frameRef.current = null;
+            }
+            setLoadedData(rowsRef.current.slice());
         } catch (e) {
             alert(e?.response?.data?.detail);  //creates an alert box incase of any error
         }
@@ -64,7 +117,7 @@ export const DataForm = ({ integrationType, credentials }) => {
                 {/* A click on THIS LOAD DATA BUTTON IS what triggers the handleLoad function. Lets see what that function does */}
 
                 <Button
-                    onClick={() => setLoadedData(null)}
+                    onClick={() => { rowsRef.current = []; setLoadedData(null); }}
                     variant='contained'
                 >
                     Clear Data
@@ -68,7 +68,7 @@ export const IntegrationForm = () => {
         {/* NOW we are back from the hubspot.js file and we do have the credentials that we fetched from our redis DB. And the type that was set was "Hubspot". so this will TRIGGER THE DataForm component. So lets go to data-form.js and see how it functions over there */}
         {integrationParams?.credentials && 
         <Box sx={{mt: 2}}>
-            <DataForm integrationType={integrationParams?.type} credentials={integrationParams?.credentials} />
+            <DataForm integrationType={integrationParams?.type} credentials={integrationParams?.credentials} user={user} org={org} />
         </Box>
         }
     </Box>